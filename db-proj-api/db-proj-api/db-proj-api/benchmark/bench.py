@@ -0,0 +1,330 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Load test and benchmark for the REST API
+##
+## python bench.py run --url http://localhost:8080 --seed --label baseline
+## python bench.py compare results/<before>.json results/<after>.json
+##
+## `run` optionally seeds the database (postgresql/seed.py), then drives each
+## workload against the API from a pool of client threads and reports p50,
+## p95, p99 latency and requests/sec per endpoint. Results are written as
+## JSON to results/, so runs before and after a change can be compared.
+
+import argparse, datetime, http.client, json, os, random, sys, threading, time, urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'postgresql'))
+from seed import connect, seed
+
+SCENARIOS = ['bid_storm', 'search_mix', 'list_polling', 'cancel_fanout', 'bulk_close']
+SEARCH_WORDS = ['lamp', 'chair', 'table', 'vase', 'clock', 'painting', 'guitar']
+
+##
+## HTTP client, one keep-alive connection per worker thread
+##
+
+class Client:
+
+    def __init__(self, url):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+
+    def request(self, method, path, payload=None):
+        body = json.dumps(payload) if payload is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            # reconnect and report the failure
+            self.conn.close()
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            return 599, None
+
+        try:
+            result = json.loads(data)
+        except ValueError:
+            result = None
+        return response.status, result
+
+
+def is_error(status, result):
+    if status >= 500:
+        return True
+    return isinstance(result, dict) and result.get('status', 200) >= 500
+
+##
+## Running a workload: `requests` is a list of (endpoint label, method, path, payload)
+## tuples, executed in order by `concurrency` threads
+##
+
+def run_requests(url, requests, concurrency):
+    samples = []
+    lock = threading.Lock()
+    position = [0]
+
+    def worker():
+        client = Client(url)
+        local = []
+        while True:
+            with lock:
+                if position[0] >= len(requests):
+                    break
+                label, method, path, payload = requests[position[0]]
+                position[0] += 1
+
+            start = time.perf_counter()
+            status, result = client.request(method, path, payload)
+            local.append((label, time.perf_counter() - start, is_error(status, result)))
+
+        with lock:
+            samples.extend(local)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return summarize(samples, elapsed)
+
+
+def percentile(values, fraction):
+    # nearest rank on sorted values
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+def summarize(samples, elapsed):
+    endpoints = {}
+    for label in sorted({sample[0] for sample in samples}):
+        latencies = sorted(sample[1] for sample in samples if sample[0] == label)
+        errors = sum(1 for sample in samples if sample[0] == label and sample[2])
+        endpoints[label] = {
+            'requests': len(latencies),
+            'errors': errors,
+            'rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'max_ms': round(latencies[-1] * 1000, 2)
+        }
+    return {'duration_s': round(elapsed, 3), 'endpoints': endpoints}
+
+##
+## Workloads
+##
+
+def fetch_ids(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT a.auction_id, min(i.item_id) FROM auctions a JOIN items i ON i.auctions_auction_id = a.auction_id WHERE a.status = 'open' GROUP BY a.auction_id ORDER BY a.auction_id LIMIT 1000")
+    auctions = cur.fetchall()
+    cur.execute('SELECT users_user_id FROM buyers ORDER BY users_user_id LIMIT 1000')
+    buyers = [row[0] for row in cur.fetchall()]
+    cur.execute('SELECT users_user_id FROM sellers ORDER BY users_user_id LIMIT 1')
+    seller = cur.fetchone()[0]
+    conn.rollback()
+    return auctions, buyers, seller
+
+
+def bid_storm(args, conn, ids):
+    # everyone bids on the same hot auction, with rising amounts
+    auctions, buyers, _ = ids
+    auction_id, item_id = auctions[0]
+    cur = conn.cursor()
+    cur.execute('SELECT coalesce(current_bid, 0) FROM auctions WHERE auction_id = %s', (auction_id,))
+    base = cur.fetchone()[0]
+    conn.rollback()
+
+    requests = [('POST /auctions/bid', 'POST', '/auctions/bid', {
+        'auctions_auction_id': auction_id,
+        'items_item_id': item_id,
+        'buyers_user_id': random.choice(buyers),
+        'bid_amount': base + n + random.random()
+    }) for n in range(1, args.requests + 1)]
+    return run_requests(args.url, requests, args.concurrency)
+
+
+def search_mix(args, conn, ids):
+    requests = []
+    for _ in range(args.requests):
+        word = random.choice(SEARCH_WORDS)
+        kind = random.random()
+        if kind < 0.5:
+            requests.append(('GET /auctions/search/?q=', 'GET', f'/auctions/search/?q={word}%20{random.randint(1, 50000)}', None))
+        elif kind < 0.8:
+            requests.append(('GET /auctions/search/?title=', 'GET', f'/auctions/search/?title={word}%20{random.randint(1, 999)}', None))
+        else:
+            requests.append(('GET /auctions/search/?prefix=true', 'GET', f'/auctions/search/?q={word[:3]}&prefix=true&limit=10', None))
+    return run_requests(args.url, requests, args.concurrency)
+
+
+def list_polling(args, conn, ids):
+    requests = []
+    for _ in range(args.requests):
+        kind = random.random()
+        if kind < 0.6:
+            requests.append(('GET /auctions/list?limit=', 'GET', '/auctions/list?limit=50', None))
+        elif kind < 0.9:
+            requests.append(('GET /users/?limit=', 'GET', '/users/?limit=100', None))
+        else:
+            requests.append(('GET /auctions/list (stream)', 'GET', '/auctions/list', None))
+    return run_requests(args.url, requests, args.concurrency)
+
+
+def create_auctions(args, count, end_time):
+    # creates `count` open auctions with one item each, returns [(auction_id, item_id)]
+    client = Client(args.url)
+    created = []
+    _, _, seller = ids_cache['ids']
+    for n in range(count):
+        _, result = client.request('POST', '/auctions/', {'title': f'Bench auction {n}', 'description': 'benchmark', 'end_time': end_time, 'status': 'open'})
+        auction_id = result['results']['auction_id']
+        _, result = client.request('POST', '/auctions/add_item', {'auction_id': auction_id, 'item_name': 'bench item', 'minimum_price': 1, 'sellers_user_id': seller})
+        created.append((auction_id, result['item_id']))
+    return created
+
+
+def place_bids(args, auctions, bidders):
+    # one rising bid per bidder on each auction
+    client = Client(args.url)
+    for auction_id, item_id in auctions:
+        bids = [{'auctions_auction_id': auction_id, 'items_item_id': item_id, 'buyers_user_id': buyer, 'bid_amount': n + 1} for n, buyer in enumerate(bidders)]
+        client.request('POST', '/auctions/bids/batch', {'bids': bids})
+
+
+def cancel_fanout(args, conn, ids):
+    # auctions with `fanout` distinct bidders each, then cancelled
+    _, buyers, _ = ids
+    end_time = (datetime.datetime.now() + datetime.timedelta(days=1)).isoformat()
+    auctions = create_auctions(args, args.cancel_auctions, end_time)
+
+    place_bids(args, auctions, buyers[:args.fanout])
+
+    requests = [('PUT /auctions/cancel/<id>/', 'PUT', f'/auctions/cancel/{auction_id}/', None) for auction_id, _ in auctions]
+    return run_requests(args.url, requests, args.concurrency)
+
+
+def bulk_close(args, conn, ids):
+    # auctions with bids whose end time has passed, closed through the endpoint
+    _, buyers, _ = ids
+    end_time = (datetime.datetime.now() + datetime.timedelta(days=1)).isoformat()
+    auctions = create_auctions(args, args.close_auctions, end_time)
+    place_bids(args, auctions, buyers[:10])
+
+    # end them directly, so the expiry scheduler does not race the endpoint
+    cur = conn.cursor()
+    cur.execute("UPDATE auctions SET end_time = NOW() - INTERVAL '1 second' WHERE auction_id = ANY(%s)", ([auction_id for auction_id, _ in auctions],))
+    conn.commit()
+
+    requests = [('PUT /auctions/close/<id>/', 'PUT', f'/auctions/close/{auction_id}/', None) for auction_id, _ in auctions]
+    return run_requests(args.url, requests, args.concurrency)
+
+
+WORKLOADS = {
+    'bid_storm': bid_storm,
+    'search_mix': search_mix,
+    'list_polling': list_polling,
+    'cancel_fanout': cancel_fanout,
+    'bulk_close': bulk_close
+}
+
+ids_cache = {}
+
+##
+## Commands
+##
+
+def print_results(results):
+    for scenario, summary in results['scenarios'].items():
+        print(f'\n{scenario} ({summary["duration_s"]} s)')
+        print(f'  {"endpoint":<36} {"requests":>8} {"errors":>6} {"rps":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+        for label, stats in summary['endpoints'].items():
+            print(f'  {label:<36} {stats["requests"]:>8} {stats["errors"]:>6} {stats["rps"]:>9} {stats["p50_ms"]:>8} {stats["p95_ms"]:>8} {stats["p99_ms"]:>8}')
+
+
+def run(args):
+    conn = connect()
+    if args.seed:
+        print(f'Seeding {args.users} users, {args.auctions} auctions, {args.bids} bids')
+        seed(conn, args.users, args.auctions, args.bids)
+
+    ids_cache['ids'] = fetch_ids(conn)
+    results = {
+        'label': args.label,
+        'started_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'config': {name: value for name, value in vars(args).items() if name != 'func'},
+        'scenarios': {}
+    }
+
+    for scenario in args.scenarios:
+        print(f'Running {scenario}')
+        results['scenarios'][scenario] = WORKLOADS[scenario](args, conn, ids_cache['ids'])
+    conn.close()
+
+    print_results(results)
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f'{results["started_at"].replace(":", "")}-{args.label}.json')
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'\nResults written to {path}')
+
+
+def compare(args):
+    with open(args.before) as file:
+        before = json.load(file)
+    with open(args.after) as file:
+        after = json.load(file)
+
+    print(f'{before["label"]} -> {after["label"]}')
+    for scenario, summary in after['scenarios'].items():
+        if scenario not in before['scenarios']:
+            continue
+        print(f'\n{scenario}')
+        print(f'  {"endpoint":<36} {"rps":>18} {"p50 ms":>18} {"p95 ms":>18} {"p99 ms":>18}')
+        for label, stats in summary['endpoints'].items():
+            old = before['scenarios'][scenario]['endpoints'].get(label)
+            if old is None:
+                continue
+            cells = []
+            for key in ('rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+                change = f'{(stats[key] - old[key]) / old[key] * 100:+.0f}%' if old[key] else 'n/a'
+                cells.append(f'{stats[key]:>9} {change:>8}')
+            print(f'  {label:<36} ' + ' '.join(cells))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the auction REST API')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the workloads and store the results')
+    run_parser.add_argument('--url', default='http://localhost:8080')
+    run_parser.add_argument('--label', default='run')
+    run_parser.add_argument('--output', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results'))
+    run_parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    run_parser.add_argument('--concurrency', type=int, default=16, help='client threads')
+    run_parser.add_argument('--requests', type=int, default=2000, help='requests per workload')
+    run_parser.add_argument('--fanout', type=int, default=200, help='bidders per auction in cancel_fanout')
+    run_parser.add_argument('--cancel-auctions', type=int, default=50)
+    run_parser.add_argument('--close-auctions', type=int, default=200)
+    run_parser.add_argument('--seed', action='store_true', help='seed the database first (DB_HOST etc. as for the API)')
+    run_parser.add_argument('--users', type=int, default=10000)
+    run_parser.add_argument('--auctions', type=int, default=50000)
+    run_parser.add_argument('--bids', type=int, default=500000)
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
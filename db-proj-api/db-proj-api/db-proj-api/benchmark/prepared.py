@@ -0,0 +1,131 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Plain vs prepared execution of the registered statements
+##
+## python prepared.py --runs 2000
+##
+## Runs every statement registered in demo-proj.py (register_statement) on
+## one connection, first as plain SQL and then through PREPARE/EXECUTE, and
+## reports the mean and p50 time per execution along with the planning time
+## EXPLAIN reports for the plain query, which is the part EXECUTE skips.
+## Writes are rolled back after every execution. Keep PARAMS in sync with the
+## registered statements.
+
+import argparse, datetime, importlib.util, json, os, sys, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'postgresql'))
+from seed import connect, seed
+
+SAMPLES = {
+    'username': "SELECT username FROM users ORDER BY user_id DESC LIMIT 1",
+    'auction_id': "SELECT auction_id FROM auctions a WHERE status = 'open' AND EXISTS (SELECT 1 FROM items WHERE auctions_auction_id = a.auction_id) ORDER BY auction_id DESC LIMIT 1",
+    'item_id': "SELECT max(item_id) FROM items",
+    'buyer_id': "SELECT users_user_id FROM buyers ORDER BY users_user_id DESC LIMIT 1",
+    'seller_id': "SELECT users_user_id FROM sellers ORDER BY users_user_id DESC LIMIT 1"
+}
+
+PARAMS = {
+    'get_all_users': lambda s: (0, 100),
+    'get_user': lambda s: (s['username'],),
+    'get_open_auctions': lambda s: (0, 100),
+    'get_auction_summary': lambda s: (s['auction_id'],),
+    'add_item': lambda s: ('benchmark item', 1, s['auction_id'], s['seller_id']),
+    'place_bid': lambda s: {'auction_id': s['auction_id'], 'item_id': s['item_id'], 'buyer_id': s['buyer_id'], 'bid_amount': 10 ** 9},
+    'get_user_events': lambda s: (s['buyer_id'], 0, 100),
+    'add_user': lambda s: {'username': 'benchmark user', 'password': '', 'email': '', 'role': 'Buyer'},
+    'close_auction': lambda s: {'auction_id': s['auction_id'], 'now': datetime.datetime.now()},
+    'cancel_auction': lambda s: {'auction_id': s['auction_id'], 'message': 'benchmark'}
+}
+
+
+def load_app():
+    # the registry lives in the API module; no log file for this run
+    os.environ.setdefault('LOG_FILE', '')
+    directory = os.path.join(HERE, '..', 'python', 'app')
+    # the module imports queries.py from its own directory
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    spec = importlib.util.spec_from_file_location('demo_proj', os.path.join(directory, 'demo-proj.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def psycopg2_connect(app):
+    # a connection that keeps track of its prepared statements, like the pooled ones
+    return app.psycopg2.connect(connection_factory=app.PreparingConnection, **app.DB_CONFIG)
+
+
+def timed(conn, cur, run, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run()
+        if cur.description is not None:
+            cur.fetchall()
+        times.append(time.perf_counter() - start)
+        conn.rollback()
+    times.sort()
+    return sum(times) / len(times) * 1000, times[len(times) // 2] * 1000
+
+
+def planning_time(conn, cur, statement, params):
+    cur.execute('EXPLAIN (SUMMARY, FORMAT JSON) ' + statement.sql, params)
+    result = cur.fetchone()[0][0]['Planning Time']
+    conn.rollback()
+    return result
+
+
+def main(args):
+    app = load_app()
+
+    conn = connect()
+    if args.seed:
+        seed(conn, args.users, args.auctions, args.bids)
+    conn.close()
+
+    conn = psycopg2_connect(app)
+    cur = conn.cursor()
+    samples = {}
+    for name, query in SAMPLES.items():
+        cur.execute(query)
+        samples[name] = cur.fetchone()[0]
+    conn.rollback()
+
+    results = {}
+    print(f'{"statement":<22} {"plan ms":>8} {"plain ms":>9} {"prepared ms":>12} {"p50 plain":>10} {"p50 prep.":>10} {"saved":>7}')
+    for name, statement in app.STATEMENTS.items():
+        if name not in PARAMS:
+            print(f'{name:<22} skipped, no sample parameters')
+            continue
+        params = PARAMS[name](samples)
+
+        plan_ms = planning_time(conn, cur, statement, params)
+        plain = timed(conn, cur, lambda: cur.execute(statement.sql, params), args.runs)
+        prepared = timed(conn, cur, lambda: statement.execute(cur, params), args.runs)
+
+        saved = (plain[0] - prepared[0]) / plain[0] * 100
+        results[name] = {'planning_ms': round(plan_ms, 4), 'plain_mean_ms': round(plain[0], 4), 'prepared_mean_ms': round(prepared[0], 4),
+                         'plain_p50_ms': round(plain[1], 4), 'prepared_p50_ms': round(prepared[1], 4), 'saved_percent': round(saved, 1)}
+        print(f'{name:<22} {plan_ms:>8.3f} {plain[0]:>9.3f} {prepared[0]:>12.3f} {plain[1]:>10.3f} {prepared[1]:>10.3f} {saved:>6.1f}%')
+    conn.close()
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f'{datetime.datetime.now().isoformat(timespec="seconds").replace(":", "")}-prepared.json')
+    with open(path, 'w') as file:
+        json.dump({'runs': args.runs, 'statements': results}, file, indent=2)
+    print(f'\nResults written to {path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare plain and prepared execution of the registered statements')
+    parser.add_argument('--runs', type=int, default=1000, help='executions per statement and mode')
+    parser.add_argument('--output', default=os.path.join(HERE, 'results'))
+    parser.add_argument('--seed', action='store_true', help='seed the database first')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--auctions', type=int, default=50000)
+    parser.add_argument('--bids', type=int, default=500000)
+    main(parser.parse_args())
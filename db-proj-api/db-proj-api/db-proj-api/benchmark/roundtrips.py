@@ -0,0 +1,172 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Statement per step vs one statement per request for the write endpoints
+##
+## python roundtrips.py --runs 1000 --fanout 50
+##
+## Times what POST /users/, PUT /auctions/close/<id>/ and PUT
+## /auctions/cancel/<id>/ send to the database per request, on one
+## connection: first the way the endpoints used to do it, one statement per
+## step with separate commits, then the single statement each of them runs
+## now in autocommit (ADD_USER_STATEMENT, CLOSE_AUCTION_STATEMENT and
+## CANCEL_AUCTION_STATEMENT in queries.py). Both run as plain SQL, see
+## prepared.py for the effect of PREPARE. Every request is committed, so the
+## script works on its own users and auction and deletes them at the end.
+## Stop the API while it runs: its background jobs would close, archive or
+## deliver the benchmark auction's rows in the middle of the runs.
+##
+## The saving is one network round trip per step, so it grows with the
+## latency to the server; run it from another host (DB_HOST) to see it.
+
+import argparse, datetime, json, os, sys, time
+
+from prepared import HERE, load_app
+sys.path.insert(0, os.path.join(HERE, '..', 'postgresql'))
+from seed import connect, seed
+
+USER_PREFIX = 'roundtrip-'
+
+
+##
+## The steps of each endpoint before it was a single statement
+##
+
+def add_users_steps(conn, cur, context, username):
+    cur.execute('INSERT INTO users (username, password, email, role) VALUES (%s, %s, %s, %s) RETURNING user_id', (username, '', '', 'Buyer'))
+    user_id = cur.fetchone()[0]
+    cur.execute('INSERT INTO buyers (users_user_id, buyer_name) VALUES (%s, %s)', (user_id, username))
+    conn.commit()
+
+def close_auction_steps(conn, cur, context, username):
+    cur.execute('SELECT end_time FROM auctions WHERE auction_id = %s', (context['auction_id'],))
+    if datetime.datetime.now() > cur.fetchone()[0]:
+        cur.execute('UPDATE auctions SET status = %s WHERE auction_id = %s', ('closed', context['auction_id']))
+        conn.commit()
+        cur.execute('UPDATE auctions SET winner_user_id = current_bidder_id, winning_amount = current_bid WHERE auction_id = %s', (context['auction_id'],))
+        conn.commit()
+
+def cancel_auction_steps(conn, cur, context, username):
+    cur.execute('UPDATE auctions SET status = %s WHERE auction_id = %s', ('cancelled', context['auction_id']))
+    cur.execute('INSERT INTO notification_outbox (message_content, notification_type, sender_user_id, receiver_user_id) '
+                'SELECT DISTINCT %s, %s, NULL::bigint, buyers_users_user_id FROM bids WHERE auctions_auction_id = %s AND NOT archived',
+                (context['message'], 'Auction Cancelled', context['auction_id']))
+    conn.commit()
+
+
+##
+## The single statements of queries.py
+##
+
+def add_users_single(app, cur, context, username):
+    cur.execute(app.queries.ADD_USER_STATEMENT, {'username': username, 'password': '', 'email': '', 'role': 'Buyer'})
+    cur.fetchall()
+
+def close_auction_single(app, cur, context, username):
+    cur.execute(app.queries.CLOSE_AUCTION_STATEMENT, {'auction_id': context['auction_id'], 'now': datetime.datetime.now()})
+    cur.fetchall()
+
+def cancel_auction_single(app, cur, context, username):
+    cur.execute(app.queries.CANCEL_AUCTION_STATEMENT, {'auction_id': context['auction_id'], 'message': context['message']})
+    cur.fetchall()
+
+
+# endpoint: (steps, round trips of the steps, single statement)
+ENDPOINTS = {
+    'add_users': (add_users_steps, 3, add_users_single),
+    'close_auction': (close_auction_steps, 5, close_auction_single),
+    'cancel_auction': (cancel_auction_steps, 3, cancel_auction_single)
+}
+
+
+def create_auction(conn, cur, fanout):
+    # an auction that has ended, with one bid from each of fanout buyers
+    cur.execute('SELECT users_user_id FROM sellers ORDER BY users_user_id LIMIT 1')
+    seller_id = cur.fetchone()[0]
+    cur.execute('SELECT users_user_id FROM buyers ORDER BY users_user_id LIMIT %s', (fanout,))
+    buyers = [row[0] for row in cur.fetchall()]
+
+    cur.execute("INSERT INTO auctions (title, description, end_time, status) VALUES ('roundtrip benchmark', '', NOW() - INTERVAL '1 day', 'open') RETURNING auction_id")
+    auction_id = cur.fetchone()[0]
+    cur.execute('INSERT INTO items (item_name, minimum_price, auctions_auction_id, sellers_users_user_id) VALUES (%s, 1, %s, %s) RETURNING item_id',
+                ('roundtrip benchmark', auction_id, seller_id))
+    item_id = cur.fetchone()[0]
+    cur.execute('INSERT INTO bids (bid_amount, bid_time, items_item_id, auctions_auction_id, buyers_users_user_id) '
+                'SELECT n, NOW(), %s, %s, buyer_id FROM unnest(%s::bigint[]) WITH ORDINALITY AS b (buyer_id, n)', (item_id, auction_id, buyers))
+    cur.execute('UPDATE auctions SET current_bid = %s, current_bidder_id = %s WHERE auction_id = %s', (len(buyers), buyers[-1] if buyers else None, auction_id))
+    conn.commit()
+    return {'auction_id': auction_id, 'item_id': item_id, 'bidders': len(buyers), 'message': f'The auction {auction_id} has been cancelled.'}
+
+
+def clean_up(conn, cur, context):
+    cur.execute('DELETE FROM notification_outbox WHERE message_content = %s', (context['message'],))
+    cur.execute('DELETE FROM notifications WHERE message_content = %s', (context['message'],))
+    cur.execute('DELETE FROM bids WHERE auctions_auction_id = %s', (context['auction_id'],))
+    cur.execute('DELETE FROM items WHERE item_id = %s', (context['item_id'],))
+    cur.execute('DELETE FROM auction_summary WHERE auction_id = %s', (context['auction_id'],))
+    cur.execute('DELETE FROM bids_archive_packed WHERE auction_id = %s', (context['auction_id'],))
+    cur.execute('DELETE FROM auctions WHERE auction_id = %s', (context['auction_id'],))
+    cur.execute('DELETE FROM buyers WHERE buyer_name LIKE %s', (USER_PREFIX + '%',))
+    cur.execute('DELETE FROM users WHERE username LIKE %s', (USER_PREFIX + '%',))
+    conn.commit()
+
+
+def timed(run, runs, mode):
+    times = []
+    for i in range(runs):
+        username = f'{USER_PREFIX}{mode}-{i}'
+        start = time.perf_counter()
+        run(username)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return sum(times) / len(times) * 1000, times[len(times) // 2] * 1000, times[int(len(times) * 0.95)] * 1000
+
+
+def main(args):
+    app = load_app()
+
+    conn = connect()
+    if args.seed:
+        seed(conn, args.users, args.auctions, args.bids)
+
+    cur = conn.cursor()
+    context = create_auction(conn, cur, args.fanout)
+
+    results = {}
+    print(f'{"endpoint":<16} {"trips":>5} {"steps ms":>9} {"single ms":>10} {"p50 steps":>10} {"p50 single":>11} {"p95 steps":>10} {"p95 single":>11} {"saved":>7}')
+    try:
+        for name, (steps, trips, single) in ENDPOINTS.items():
+            conn.autocommit = False
+            before = timed(lambda username: steps(conn, cur, context, username), args.runs, 'steps')
+            conn.autocommit = True
+            after = timed(lambda username: single(app, cur, context, username), args.runs, 'single')
+
+            saved = (before[0] - after[0]) / before[0] * 100
+            results[name] = {'steps_round_trips': trips, 'single_round_trips': 1,
+                             'steps_mean_ms': round(before[0], 4), 'single_mean_ms': round(after[0], 4),
+                             'steps_p50_ms': round(before[1], 4), 'single_p50_ms': round(after[1], 4),
+                             'steps_p95_ms': round(before[2], 4), 'single_p95_ms': round(after[2], 4), 'saved_percent': round(saved, 1)}
+            print(f'{name:<16} {trips:>3}/1 {before[0]:>9.3f} {after[0]:>10.3f} {before[1]:>10.3f} {after[1]:>11.3f} {before[2]:>10.3f} {after[2]:>11.3f} {saved:>6.1f}%')
+    finally:
+        conn.autocommit = False
+        clean_up(conn, cur, context)
+        conn.close()
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(args.output, f'{datetime.datetime.now().isoformat(timespec="seconds").replace(":", "")}-roundtrips.json')
+    with open(path, 'w') as file:
+        json.dump({'runs': args.runs, 'fanout': context['bidders'], 'endpoints': results}, file, indent=2)
+    print(f'\nResults written to {path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the write endpoints run step by step and as one statement')
+    parser.add_argument('--runs', type=int, default=1000, help='requests per endpoint and mode')
+    parser.add_argument('--fanout', type=int, default=50, help='bidders notified by each cancel')
+    parser.add_argument('--output', default=os.path.join(HERE, 'results'))
+    parser.add_argument('--seed', action='store_true', help='seed the database first')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--auctions', type=int, default=50000)
+    parser.add_argument('--bids', type=int, default=500000)
+    main(parser.parse_args())
@@ -0,0 +1,110 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Plan regression check for the endpoint queries
+##
+## Runs EXPLAIN for the queries issued by python/app/demo-proj.py and fails
+## (exit status 1) if any of them scans a table with more rows than the
+## threshold sequentially, e.g. because an index from migrations/ is missing.
+##
+## python check_plans.py --seed          # seed synthetic data first (see seed.py)
+## python check_plans.py --max-seq-rows 1000
+##
+## The queries come from the API module itself, loaded the way
+## benchmark/prepared.py loads it: every registered statement with the
+## sample parameters of prepared.py, plus the module-level queries of the
+## endpoints and background jobs that are not registered.
+
+import argparse, os, sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'benchmark'))
+from prepared import PARAMS, SAMPLES, load_app
+from seed import connect, seed
+
+# sample parameter values, looked up in the seeded data
+SAMPLES = dict(SAMPLES, title="SELECT title FROM auctions ORDER BY auction_id DESC LIMIT 1")
+
+# (endpoint, query, parameters) of the queries that are not registered; the
+# streamed (unpaginated) listings read whole tables by design and are not listed
+EXTRA_QUERIES = [
+    ('search_auction (q)', lambda app, s: app.queries.search_query(s['title'], False, None, None, None, None, 50)),
+    ('search_auction (title)', lambda app, s: app.queries.search_query(None, False, None, s['title'], None, None, 50)),
+    ('get_top_auctions', lambda app, s: (app.queries.TOP_AUCTIONS_QUERY, (10,))),
+    ('get_auction_bids', lambda app, s: (app.queries.AUCTION_BIDS_QUERY, {'auction_id': s['auction_id'], 'after': 0, 'limit': 100})),
+    ('notification dispatcher', lambda app, s: (app.queries.DISPATCH_STATEMENT, (500, 'plan_check'))),
+    ('maintenance (archive)', lambda app, s: (app.queries.ARCHIVE_STATEMENT, (100,))),
+    ('maintenance (pack)', lambda app, s: (app.queries.PACK_STATEMENT, (100,))),
+]
+
+def endpoint_queries(app, samples):
+    # (endpoint, query, parameters) of everything the API sends
+    for name, statement in app.STATEMENTS.items():
+        yield name, statement.sql, PARAMS[name](samples)
+    for endpoint, query in EXTRA_QUERIES:
+        yield (endpoint,) + tuple(query(app, samples))
+
+def seq_scans(plan):
+    if plan['Node Type'] == 'Seq Scan':
+        yield plan['Relation Name']
+    for child in plan.get('Plans', []):
+        yield from seq_scans(child)
+
+def check(conn, app, max_seq_rows):
+    cur = conn.cursor()
+
+    samples = {}
+    for name, query in SAMPLES.items():
+        cur.execute(query)
+        samples[name] = cur.fetchone()[0]
+
+    cur.execute("SELECT relname, reltuples FROM pg_class WHERE relkind IN ('r', 'p')")
+    table_rows = dict(cur.fetchall())
+
+    cur.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+    has_trgm = cur.fetchone() is not None
+
+    failures = 0
+    for endpoint, query, params in endpoint_queries(app, samples):
+        if 'ILIKE' in query and not has_trgm:
+            print(f'SKIP  {endpoint}: pg_trgm is not installed')
+            continue
+
+        # EXPLAIN without ANALYZE plans the writes without running them
+        cur.execute('EXPLAIN (FORMAT JSON) ' + query, params)
+        plan = cur.fetchone()[0][0]['Plan']
+        scans = [(table, table_rows.get(table, 0)) for table in seq_scans(plan)]
+        bad = [f'{table} ({int(rows)} rows)' for table, rows in scans if rows > max_seq_rows]
+
+        if bad:
+            failures += 1
+            print(f'FAIL  {endpoint}: sequential scan on {", ".join(bad)}')
+        else:
+            print(f'OK    {endpoint}')
+
+    conn.rollback()
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fail if an endpoint query falls back to a sequential scan')
+    parser.add_argument('--max-seq-rows', type=int, default=1000, help='largest table that may be scanned sequentially')
+    parser.add_argument('--seed', action='store_true', help='seed synthetic data before checking')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--auctions', type=int, default=50000)
+    parser.add_argument('--bids', type=int, default=500000)
+    args = parser.parse_args()
+
+    app = load_app()
+
+    conn = connect()
+    if args.seed:
+        seed(conn, args.users, args.auctions, args.bids)
+
+    failures = check(conn, app, args.max_seq_rows)
+    conn.close()
+
+    if failures:
+        print(f'{failures} endpoint queries use sequential scans')
+        sys.exit(1)
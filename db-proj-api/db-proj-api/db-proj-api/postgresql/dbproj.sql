@@ -1,5 +1,7 @@
 -- Replace this by the SQL code needed to create your database
 
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 CREATE TABLE items (
 	item_id		 SERIAL,
 	item_name		 VARCHAR(512),
@@ -37,6 +39,11 @@ CREATE TABLE auctions (
 	description VARCHAR(512),
 	end_time	 TIMESTAMP,
 	status	 VARCHAR(512),
+	current_bid	 FLOAT(8),
+	current_bidder_id BIGINT,
+	winner_user_id	 BIGINT,
+	winning_amount	 FLOAT(8),
+	search_vector	 TSVECTOR GENERATED ALWAYS AS (setweight(to_tsvector('english', coalesce(title, '')), 'A') || setweight(to_tsvector('english', coalesce(description, '')), 'B')) STORED,
 	PRIMARY KEY(auction_id)
 );
 
@@ -65,7 +72,7 @@ CREATE TABLE users (
 
 CREATE TABLE notifications (
 	notification_id	 SERIAL,
-	message__content	 VARCHAR(1024),
+	message_content	 VARCHAR(1024),
 	notification_type VARCHAR(512),
 	sender_user_id	 BIGINT,
 	receiver_user_id	 BIGINT,
@@ -86,6 +93,11 @@ ALTER TABLE auction_board ADD CONSTRAINT auction_board_fk1 FOREIGN KEY (auctions
 ALTER TABLE message_box ADD CONSTRAINT message_box_fk1 FOREIGN KEY (users_user_id) REFERENCES users(user_id);
 ALTER TABLE notifications ADD CONSTRAINT notifications_fk1 FOREIGN KEY (users_user_id) REFERENCES users(user_id);
 
+-- search indexes: full text for /auctions/search/?q=, trigram for the title/description substring filters
+CREATE INDEX auctions_search_idx ON auctions USING GIN (search_vector);
+CREATE INDEX auctions_title_trgm_idx ON auctions USING GIN (title gin_trgm_ops);
+CREATE INDEX auctions_description_trgm_idx ON auctions USING GIN (description gin_trgm_ops);
+
 
 INSERT INTO USERS VALUES (100, 'buyer1','password1', 'buyer1@gmail.com', 'Buyer');
 INSERT INTO USERS VALUES (200, 'seller1','password2','seller1@gmail.com', 'Seller');
@@ -0,0 +1,31 @@
+#!/bin/sh
+# ITCS 3160-0002, Spring 2024
+# Marco Vieira, marco.vieira@charlotte.edu
+# University of North Carolina at Charlotte
+
+#
+# Applies the pending migrations in migrations/ in version order.
+# Each file runs in its own transaction and is recorded in schema_migrations,
+# so running this script again only applies the new ones.
+#
+# Connection settings come from the usual libpq variables, e.g.
+#   PGHOST=localhost sh migrate.sh
+#
+
+export PGUSER="${PGUSER:-${POSTGRES_USER:-scott}}"
+export PGPASSWORD="${PGPASSWORD:-${POSTGRES_PASSWORD:-tiger}}"
+export PGDATABASE="${PGDATABASE:-${POSTGRES_DB:-dbproj}}"
+migrations="${MIGRATIONS_DIR:-$(dirname "$0")/migrations}"
+
+set -e
+
+psql -q -v ON_ERROR_STOP=1 -c "SET client_min_messages TO warning; CREATE TABLE IF NOT EXISTS schema_migrations (version VARCHAR(512) PRIMARY KEY, applied_at TIMESTAMP DEFAULT NOW())"
+
+for file in $(ls "$migrations"/*.sql | sort); do
+    version=$(basename "$file" .sql)
+    applied=$(psql -tA -c "SELECT 1 FROM schema_migrations WHERE version = '$version'")
+    if [ -z "$applied" ]; then
+        echo "-- Applying $version --"
+        { cat "$file"; echo "INSERT INTO schema_migrations (version) VALUES ('$version');"; } | psql -q -v ON_ERROR_STOP=1 --single-transaction
+    fi
+done
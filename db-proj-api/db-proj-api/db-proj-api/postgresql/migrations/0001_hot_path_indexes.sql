@@ -0,0 +1,23 @@
+-- 0001: indexes for the filters used by the endpoint queries
+--
+-- dbproj.sql only declares primary keys, so every lookup below was a
+-- sequential scan of the whole table.
+
+-- bid history of an auction, highest first (cancel_auction fan-out)
+CREATE INDEX IF NOT EXISTS bids_auction_amount_idx ON bids (auctions_auction_id, bid_amount DESC);
+
+-- bids of a buyer, per auction
+CREATE INDEX IF NOT EXISTS bids_buyer_auction_idx ON bids (buyers_users_user_id, auctions_auction_id);
+
+-- items of an auction (foreign key, also used when deleting/closing auctions)
+CREATE INDEX IF NOT EXISTS items_auction_idx ON items (auctions_auction_id);
+
+-- get_user looks users up by username, which must be unique
+ALTER TABLE users ADD CONSTRAINT users_username_key UNIQUE (username);
+
+-- only open auctions are listed or waiting to expire
+CREATE INDEX IF NOT EXISTS auctions_open_idx ON auctions (auction_id) WHERE status = 'open';
+CREATE INDEX IF NOT EXISTS auctions_open_end_time_idx ON auctions (end_time) WHERE status = 'open';
+
+-- a user's notifications, newest first
+CREATE INDEX IF NOT EXISTS notifications_receiver_idx ON notifications (receiver_user_id, notification_time DESC);
@@ -0,0 +1,14 @@
+-- 0002: transactional outbox for notifications
+--
+-- Endpoints write their notifications here inside their own transaction,
+-- and the API's dispatcher thread moves them into notifications in batches.
+
+CREATE TABLE notification_outbox (
+	outbox_id	 BIGSERIAL,
+	message_content	 VARCHAR(1024),
+	notification_type VARCHAR(512),
+	sender_user_id	 BIGINT,
+	receiver_user_id	 BIGINT NOT NULL,
+	created_at	 TIMESTAMP NOT NULL DEFAULT NOW(),
+	PRIMARY KEY(outbox_id)
+);
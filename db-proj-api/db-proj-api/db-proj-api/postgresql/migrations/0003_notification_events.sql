@@ -0,0 +1,5 @@
+-- 0003: catch-up reads for the user event stream
+--
+-- GET /users/<id>/events reads a user's notifications after the last id it sent.
+
+CREATE INDEX IF NOT EXISTS notifications_receiver_id_idx ON notifications (receiver_user_id, notification_id);
@@ -0,0 +1,22 @@
+-- 0004: per-auction bid activity, kept up to date by every accepted bid
+--
+-- The high bid and its bidder stay on auctions (current_bid, current_bidder_id),
+-- where the bid endpoints already update them under the auction's row lock.
+-- The counters live here, so the bid_count index does not turn each bid's
+-- UPDATE of auctions into a non-HOT one that touches every auctions index.
+
+CREATE TABLE auction_summary (
+	auction_id	 INTEGER,
+	bid_count	 BIGINT NOT NULL DEFAULT 0,
+	last_bid_time TIMESTAMP,
+	PRIMARY KEY(auction_id)
+);
+
+ALTER TABLE auction_summary ADD CONSTRAINT auction_summary_fk1 FOREIGN KEY (auction_id) REFERENCES auctions(auction_id);
+
+-- top auctions by activity
+CREATE INDEX auction_summary_activity_idx ON auction_summary (bid_count DESC, auction_id DESC);
+
+-- bids placed before this migration
+INSERT INTO auction_summary (auction_id, bid_count, last_bid_time)
+SELECT auctions_auction_id, count(*), max(bid_time) FROM bids GROUP BY auctions_auction_id;
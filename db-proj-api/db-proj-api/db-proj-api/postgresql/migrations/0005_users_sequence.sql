@@ -0,0 +1,6 @@
+-- 0005: move the users id sequence past the users inserted by dbproj.sql
+--
+-- dbproj.sql inserts its sample users with explicit ids, so new users (and
+-- bulk imports in particular) would otherwise collide with them.
+
+SELECT setval('users_user_id_seq', greatest((SELECT max(user_id) FROM users), 1));
@@ -0,0 +1,106 @@
+-- 0006: partition bids and notifications
+--
+-- bids is split on a new archived flag. bids_live holds the bids of open
+-- auctions, the only ones the bid and cancel endpoints read (they filter on
+-- NOT archived, so only bids_live is scanned however much history there is),
+-- and the API's maintenance job moves the bids of closed and cancelled
+-- auctions to bids_archive, where they are only read for bid history.
+--
+-- notifications is split by month of notification_time. The maintenance job
+-- creates the partitions of the coming months; rows of a month without a
+-- partition go to notifications_default until it does. Old months can be
+-- detached or dropped whole.
+--
+-- Both tables are rebuilt and their rows copied, which takes a while on a
+-- large database.
+
+---------- bids ----------
+
+ALTER TABLE bids RENAME TO bids_unpartitioned;
+ALTER SEQUENCE bids_bid_id_seq OWNED BY NONE;
+
+CREATE TABLE bids (
+	bid_id		 INTEGER NOT NULL DEFAULT nextval('bids_bid_id_seq'),
+	bid_amount		 FLOAT(8),
+	bid_time		 TIMESTAMP,
+	items_item_id	 INTEGER NOT NULL,
+	buyers_users_user_id BIGINT NOT NULL,
+	auctions_auction_id INTEGER NOT NULL,
+	archived		 BOOL NOT NULL DEFAULT false
+) PARTITION BY LIST (archived);
+
+ALTER SEQUENCE bids_bid_id_seq OWNED BY bids.bid_id;
+
+CREATE TABLE bids_live PARTITION OF bids FOR VALUES IN (false);
+-- written once and never updated, so its pages are packed full. This is not
+-- compression: every column of bids is fixed width, and PostgreSQL only
+-- compresses variable-length values. 0007 moves these rows on into
+-- compressed arrays.
+CREATE TABLE bids_archive PARTITION OF bids FOR VALUES IN (true) WITH (fillfactor = 100);
+
+INSERT INTO bids (bid_id, bid_amount, bid_time, items_item_id, buyers_users_user_id, auctions_auction_id, archived)
+SELECT b.bid_id, b.bid_amount, b.bid_time, b.items_item_id, b.buyers_users_user_id, b.auctions_auction_id, a.status IN ('closed', 'cancelled')
+FROM bids_unpartitioned b JOIN auctions a ON a.auction_id = b.auctions_auction_id;
+
+DROP TABLE bids_unpartitioned;
+
+-- a partitioned table's primary key must include the partition key
+ALTER TABLE bids ADD PRIMARY KEY (bid_id, archived);
+ALTER TABLE bids ADD CONSTRAINT bids_fk1 FOREIGN KEY (items_item_id) REFERENCES items(item_id);
+ALTER TABLE bids ADD CONSTRAINT bids_fk2 FOREIGN KEY (buyers_users_user_id) REFERENCES buyers(users_user_id);
+ALTER TABLE bids ADD CONSTRAINT fk_bids_auction_id FOREIGN KEY (auctions_auction_id) REFERENCES auctions(auction_id);
+
+-- the indexes of 0001 are only needed on the live bids
+CREATE INDEX bids_auction_amount_idx ON bids_live (auctions_auction_id, bid_amount DESC);
+CREATE INDEX bids_buyer_auction_idx ON bids_live (buyers_users_user_id, auctions_auction_id);
+
+-- bid history of an archived auction
+CREATE INDEX bids_archive_auction_idx ON bids_archive (auctions_auction_id, bid_id);
+
+---------- notifications ----------
+
+ALTER TABLE notifications RENAME TO notifications_unpartitioned;
+ALTER SEQUENCE notifications_notification_id_seq OWNED BY NONE;
+
+CREATE TABLE notifications (
+	notification_id	 INTEGER NOT NULL DEFAULT nextval('notifications_notification_id_seq'),
+	message_content	 VARCHAR(1024),
+	notification_type VARCHAR(512),
+	sender_user_id	 BIGINT,
+	receiver_user_id	 BIGINT,
+	notification_time TIMESTAMP NOT NULL DEFAULT NOW(),
+	is_read		 BOOL,
+	users_user_id	 BIGINT NOT NULL
+) PARTITION BY RANGE (notification_time);
+
+ALTER SEQUENCE notifications_notification_id_seq OWNED BY notifications.notification_id;
+
+CREATE TABLE notifications_default PARTITION OF notifications DEFAULT;
+
+-- one partition per month that has notifications, and for this month and the next two
+DO $$
+DECLARE
+	month TIMESTAMP;
+BEGIN
+	FOR month IN
+		SELECT DISTINCT date_trunc('month', notification_time) FROM notifications_unpartitioned WHERE notification_time IS NOT NULL
+		UNION
+		SELECT generate_series(date_trunc('month', NOW()), date_trunc('month', NOW()) + INTERVAL '2 months', INTERVAL '1 month')
+	LOOP
+		EXECUTE format('CREATE TABLE %I PARTITION OF notifications FOR VALUES FROM (%L) TO (%L)',
+		               'notifications_' || to_char(month, 'YYYY_MM'), month, month + INTERVAL '1 month');
+	END LOOP;
+END $$;
+
+INSERT INTO notifications (notification_id, message_content, notification_type, sender_user_id, receiver_user_id, notification_time, is_read, users_user_id)
+SELECT notification_id, message_content, notification_type, sender_user_id, receiver_user_id, coalesce(notification_time, NOW()), is_read, users_user_id
+FROM notifications_unpartitioned;
+
+DROP TABLE notifications_unpartitioned;
+
+ALTER TABLE notifications ADD PRIMARY KEY (notification_id, notification_time);
+ALTER TABLE notifications ADD CONSTRAINT notifications_fk1 FOREIGN KEY (users_user_id) REFERENCES users(user_id);
+
+-- created on every partition (see 0001 and 0003)
+CREATE INDEX notifications_receiver_idx ON notifications (receiver_user_id, notification_time DESC);
+CREATE INDEX notifications_receiver_id_idx ON notifications (receiver_user_id, notification_id);
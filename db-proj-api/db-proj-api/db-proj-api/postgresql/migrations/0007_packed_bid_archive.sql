@@ -0,0 +1,24 @@
+-- 0007: compress the archived bids
+--
+-- PostgreSQL only compresses variable-length values, and every column of
+-- bids is fixed width, so the rows of bids_archive are stored as they are
+-- whatever its storage settings. bids_archive_packed keeps the archived bids
+-- of an auction in one row, as one array per column. Arrays are
+-- variable-length, so TOAST compresses them once the row is larger than
+-- toast_tuple_target; at its lowest setting (128 bytes) that is any auction
+-- with more than a handful of bids. A packed row also drops the per-row
+-- header and index entries of every bid.
+--
+-- The API's maintenance job packs the auctions that are in bids_archive
+-- (queries.PACK_STATEMENT) and the bid history endpoint unnests the arrays,
+-- so bids_archive only holds the bids archived since the last run. The
+-- arrays are in bid_id order.
+
+CREATE TABLE bids_archive_packed (
+	auction_id	 INTEGER PRIMARY KEY REFERENCES auctions(auction_id),
+	bid_ids	 INTEGER[] NOT NULL,
+	bid_amounts	 FLOAT(8)[] NOT NULL,
+	bid_times	 TIMESTAMP[] NOT NULL,
+	item_ids	 INTEGER[] NOT NULL,
+	buyer_ids	 BIGINT[] NOT NULL
+) WITH (toast_tuple_target = 128);
@@ -0,0 +1,11 @@
+#!/bin/sh
+# ITCS 3160-0002, Spring 2024
+# Marco Vieira, marco.vieira@charlotte.edu
+# University of North Carolina at Charlotte
+
+#
+# Lets streaming replicas (e.g. db-replica in docker-compose-python-psql.yml)
+# connect with the database user and password.
+#
+
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
@@ -0,0 +1,102 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Seeds the database created by dbproj.sql with synthetic users, auctions,
+## items, bids and notifications, generated server-side with generate_series.
+## The bids of closed auctions go straight to the archive (see migrations/0006).
+##
+## python seed.py --users 10000 --auctions 50000 --bids 500000
+
+import argparse, os, psycopg2
+
+# 1 in OPEN_EVERY seeded auctions is open, the rest are closed history
+OPEN_EVERY = 20
+
+SEED_STATEMENTS = [
+    # users, numbered after the existing ones (dbproj.sql inserts fixed ids)
+    """
+    INSERT INTO users (user_id, username, password, email, role)
+    SELECT base.id + g, 'seed_user_' || (base.id + g), 'password', 'seed_user_' || (base.id + g) || '@example.com',
+           CASE WHEN g %% 10 = 0 THEN 'Seller' ELSE 'Buyer' END
+    FROM (SELECT coalesce(max(user_id), 0) AS id FROM users) base, generate_series(1, %(users)s) g
+    """,
+    "SELECT setval('users_user_id_seq', (SELECT max(user_id) FROM users))",
+    "INSERT INTO sellers (seller_name, users_user_id) SELECT username, user_id FROM users WHERE role = 'Seller' ON CONFLICT DO NOTHING",
+    "INSERT INTO buyers (buyer_name, users_user_id) SELECT username, user_id FROM users WHERE role = 'Buyer' ON CONFLICT DO NOTHING",
+    """
+    INSERT INTO auctions (title, description, end_time, status)
+    SELECT 'Seed ' || (ARRAY['lamp', 'chair', 'table', 'vase', 'clock', 'painting', 'guitar'])[1 + g %% 7] || ' ' || g,
+           'seed auction ' || md5(g::text),
+           NOW() + (g %% 10000) * INTERVAL '1 minute',
+           CASE WHEN g %% %(open_every)s = 0 THEN 'open' ELSE 'closed' END
+    FROM generate_series(1, %(auctions)s) g
+    """,
+    """
+    INSERT INTO items (item_name, minimum_price, auctions_auction_id, sellers_users_user_id)
+    SELECT 'item ' || a.auction_id, 1, a.auction_id, s.ids[1 + a.auction_id %% array_length(s.ids, 1)]
+    FROM auctions a, (SELECT array_agg(users_user_id) AS ids FROM sellers) s
+    WHERE NOT EXISTS (SELECT 1 FROM items i WHERE i.auctions_auction_id = a.auction_id)
+    """,
+    """
+    INSERT INTO bids (bid_amount, bid_time, items_item_id, auctions_auction_id, buyers_users_user_id, archived)
+    SELECT g, NOW() - g * INTERVAL '1 second', it.item_ids[k], it.auction_ids[k], b.ids[1 + g %% array_length(b.ids, 1)], it.archived[k]
+    FROM (SELECT array_agg(i.item_id ORDER BY i.item_id) AS item_ids, array_agg(i.auctions_auction_id ORDER BY i.item_id) AS auction_ids,
+                 array_agg(a.status <> 'open' ORDER BY i.item_id) AS archived
+          FROM items i JOIN auctions a ON a.auction_id = i.auctions_auction_id) it,
+         (SELECT array_agg(users_user_id) AS ids FROM buyers) b,
+         generate_series(1, %(bids)s) g,
+         LATERAL (SELECT 1 + (g::bigint * 7919) %% array_length(it.item_ids, 1) AS k) pick
+    """,
+    # keep the per-auction high bid in line with the bids just inserted
+    """
+    UPDATE auctions a SET current_bid = top.bid_amount, current_bidder_id = top.buyers_users_user_id
+    FROM (SELECT DISTINCT ON (auctions_auction_id) auctions_auction_id, bid_amount, buyers_users_user_id
+          FROM bids ORDER BY auctions_auction_id, bid_amount DESC) top
+    WHERE a.auction_id = top.auctions_auction_id
+    """,
+    """
+    INSERT INTO auction_summary (auction_id, bid_count, last_bid_time)
+    SELECT auctions_auction_id, count(*), max(bid_time) FROM bids GROUP BY auctions_auction_id
+    ON CONFLICT (auction_id) DO UPDATE SET bid_count = EXCLUDED.bid_count, last_bid_time = EXCLUDED.last_bid_time
+    """,
+    """
+    INSERT INTO notifications (message_content, notification_type, sender_user_id, receiver_user_id, notification_time, users_user_id)
+    SELECT 'Your bid has been outbid in auction ' || auctions_auction_id, 'Outbid', NULL, buyers_users_user_id, bid_time, buyers_users_user_id
+    FROM bids WHERE bid_id %% 4 = 0
+    """,
+]
+
+def connect():
+    return psycopg2.connect(
+        user = os.environ.get('DB_USER', 'scott'),
+        password = os.environ.get('DB_PASSWORD', 'tiger'),
+        host = os.environ.get('DB_HOST', 'localhost'),
+        port = os.environ.get('DB_PORT', '5432'),
+        database = os.environ.get('DB_NAME', 'dbproj')
+    )
+
+def seed(conn, users, auctions, bids):
+    values = {'users': users, 'auctions': auctions, 'bids': bids, 'open_every': OPEN_EVERY}
+    cur = conn.cursor()
+    for statement in SEED_STATEMENTS:
+        cur.execute(statement, values)
+    conn.commit()
+
+    # fresh statistics, otherwise the planner still thinks the tables are empty
+    conn.autocommit = True
+    cur.execute('ANALYZE')
+    conn.autocommit = False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Seed dbproj with synthetic data')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--auctions', type=int, default=50000)
+    parser.add_argument('--bids', type=int, default=500000)
+    args = parser.parse_args()
+
+    conn = connect()
+    seed(conn, args.users, args.auctions, args.bids)
+    conn.close()
+    print(f'Seeded {args.users} users, {args.auctions} auctions and {args.bids} bids')
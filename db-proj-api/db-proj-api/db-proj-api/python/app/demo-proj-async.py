@@ -0,0 +1,868 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Asyncio variant of demo-proj.py
+##
+## The users, auctions, bids and close/cancel endpoints of demo-proj.py, with
+## the same routes and JSON responses, served from one event loop per process
+## instead of one thread per request. A request waiting on PostgreSQL holds a
+## coroutine rather than an OS thread, so a process keeps many slow clients
+## open at once. It uses Quart (the Flask API on asyncio) and psycopg 3 with
+## its async connection pool, which are only needed for this variant:
+##
+##   pip install quart uvicorn "psycopg[binary]" psycopg_pool
+##   uvicorn --host 0.0.0.0 --port 5000 --workers 4 demo-proj-async:app
+##
+## or SERVER_MODE=async in docker-compose-python-psql.yml. The settings are
+## the environment variables of demo-proj.py that apply here.
+##
+## The SQL is shared with demo-proj.py through queries.py. psycopg prepares
+## a query on a connection after it has run a few times, so there is no
+## statement registry. Connections are in autocommit mode and the
+## endpoints that write more than once open a transaction. Not served here:
+## the bulk imports, the event stream and the stats endpoints; and there is
+## no response cache, request coalescing, admission control, replica routing
+## or content negotiation (responses are always JSON). Auction expiry,
+## notification dispatch and the bid archive run as tasks of the event loop.
+
+import quart
+import asyncio, base64, json, logging, os
+from datetime import datetime, timedelta
+
+import psycopg, psycopg.sql
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+
+import queries
+
+app = quart.Quart(__name__)
+
+StatusCodes = {
+    'success': 200,
+    'api_error': 400,
+    'internal_error': 500,
+    'unavailable': 503
+}
+
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(), format='%(asctime)s [%(levelname)s]:  %(message)s', datefmt='%H:%M:%S')
+logger = logging.getLogger('logger')
+
+
+##########################################################
+## DATABASE ACCESS
+##########################################################
+
+DB_CONFIG = {
+    'user': os.environ.get('DB_USER', 'scott'),
+    'password': os.environ.get('DB_PASSWORD', 'tiger'),
+    'host': os.environ.get('DB_HOST', 'db'),
+    'port': os.environ.get('DB_PORT', '5432'),
+    'dbname': os.environ.get('DB_NAME', 'dbproj')
+}
+
+POOL_CONFIG = {
+    'min_size': int(os.environ.get('DB_POOL_MIN', 2)),
+    'max_size': int(os.environ.get('DB_POOL_MAX', 20)),
+    'timeout': float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+    'max_idle': float(os.environ.get('DB_POOL_MAX_IDLE', 300))
+}
+
+DB_READY_TIMEOUT = float(os.environ.get('DB_READY_TIMEOUT', 20))
+
+STREAM_CHUNK_ROWS = int(os.environ.get('STREAM_CHUNK_ROWS', 1000))
+
+# opened by every serving process when it starts (see start_serving)
+pool = None
+
+def db_connection():
+    # async context manager: a pooled connection, given back on exit
+    return pool.connection()
+
+@app.errorhandler(PoolTimeout)
+async def pool_exhausted(error):
+    logger.error(f'{quart.request.method} {quart.request.path} - error: {error}')
+    response = {'status': StatusCodes['unavailable'], 'errors': str(error)}
+    return quart.jsonify(response), StatusCodes['unavailable']
+
+
+##
+## List endpoints return either one keyset page (?after=<id>&limit=<n>) or,
+## without those arguments, the whole list streamed a chunk at a time.
+##
+
+LIST_DEFAULT_LIMIT = 100
+LIST_MAX_LIMIT = 1000
+
+USER_COLUMNS = ('user_id', 'username', 'password', 'email', 'role')
+AUCTION_COLUMNS = ('auction_id', 'title', 'description', 'end_time', 'status')
+
+def page_args():
+    # (after, limit) of a keyset page, or None to stream the whole list
+    args = quart.request.args
+    if 'after' not in args and 'limit' not in args:
+        return None
+    after = int(args.get('after', 0))
+    limit = int(args.get('limit', LIST_DEFAULT_LIMIT))
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return after, min(limit, LIST_MAX_LIMIT)
+
+def rows_to_dicts(columns, rows):
+    return [dict(zip(columns, row)) for row in rows]
+
+def stream_response(query, params, columns, endpoint):
+    # rows arrive from the server a chunk at a time, without a server-side cursor
+    async def generate():
+        try:
+            yield '{"status": %d, "results": [' % StatusCodes['success']
+            separator = ''
+            async with db_connection() as conn:
+                cur = conn.cursor()
+                chunk = []
+                async for row in cur.stream(query, params, size=STREAM_CHUNK_ROWS):
+                    chunk.append(app.json.dumps(dict(zip(columns, row))))
+                    if len(chunk) == STREAM_CHUNK_ROWS:
+                        yield separator + ','.join(chunk)
+                        separator, chunk = ',', []
+                if chunk:
+                    yield separator + ','.join(chunk)
+            yield ']}'
+        except (Exception, psycopg.DatabaseError) as error:
+            logger.error(f'{endpoint} - stream error: {error}')
+            yield '], "errors": %s}' % app.json.dumps(str(error))
+
+    return quart.Response(generate(), mimetype='application/json')
+
+
+##########################################################
+## ENDPOINTS
+##########################################################
+
+
+@app.route('/')
+async def landing_page():
+    return """
+
+    Hello World (Python)!  <br/>
+    <br/>
+    Check the sources for instructions on how to use the endpoints!<br/>
+    <br/>
+    ITCS 3160-002, Spring 2024<br/>
+    <br/>
+    """
+
+
+@app.route('/users/', methods=['GET'])
+async def get_all_users():
+    logger.info('GET /users')
+
+    try:
+        page = page_args()
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': f'Invalid after or limit: {error}'}
+        return quart.jsonify(response)
+
+    if page is None:
+        return stream_response(queries.USERS_QUERY, (), USER_COLUMNS, 'GET /users')
+
+    try:
+        async with db_connection() as conn:
+            cur = await conn.execute(queries.USERS_PAGE_QUERY, page)
+            rows = await cur.fetchall()
+
+        response = {'status': StatusCodes['success'], 'results': rows_to_dicts(USER_COLUMNS, rows), 'next_after': rows[-1][0] if len(rows) == page[1] else None}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'GET /users - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@app.route('/users/<username>/', methods=['GET'])
+async def get_user(username):
+    logger.info('GET /users/<username>')
+
+    try:
+        async with db_connection() as conn:
+            cur = await conn.execute(queries.USER_QUERY, (username,))
+            rows = await cur.fetchall()
+
+        row = rows[0]
+        content = {'user_id': row[0], 'username': row[1], 'password': row[2], 'email': row[3], 'role': row[4]}
+        response = {'status': StatusCodes['success'], 'results': content}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'GET /users/<username> - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@app.route('/users/', methods=['POST'])
+async def add_users():
+    logger.info('POST /users')
+    payload = await quart.request.get_json()
+
+    logger.debug(f'POST /users - payload: {payload}')
+
+    if 'username' not in payload or 'role' not in payload:
+        response = {'status': StatusCodes['api_error'], 'results': 'Required fields missing'}
+        return quart.jsonify(response)
+
+    values = {
+        'username': payload['username'],
+        'password': payload.get('password', ''),
+        'email': payload.get('email', ''),
+        'role': payload['role']
+    }
+
+    try:
+        async with db_connection() as conn:
+            await conn.execute(queries.ADD_USER_STATEMENT, values)
+        response = {'status': StatusCodes['success'], 'results': f'Inserted user {payload["username"]} with role {payload["role"]}'}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'POST /users - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@app.route('/users/<username>', methods=['PUT'])
+async def update_users(username):
+    logger.info('PUT /users/<username>')
+    payload = await quart.request.get_json()
+
+    if 'city' not in payload:
+        response = {'status': StatusCodes['api_error'], 'results': 'city is required to update'}
+        return quart.jsonify(response)
+
+    try:
+        async with db_connection() as conn:
+            cur = await conn.execute(queries.UPDATE_CITY_STATEMENT, (payload['city'], username))
+        response = {'status': StatusCodes['success'], 'results': f'Updated: {cur.rowcount}'}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(error)
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@app.route('/auctions/', methods=['POST'])
+async def create_auction():
+    logger.info('POST /auctions/')
+    payload = await quart.request.get_json()
+
+    logger.debug(f'POST /auctions/ - payload: {payload}')
+
+    for field in ('title', 'description', 'end_time', 'status'):
+        if field not in payload:
+            response = {'status': StatusCodes['api_error'], 'results': f'{field} is required'}
+            return quart.jsonify(response)
+
+    values = (payload['title'], payload['description'], payload['end_time'], payload['status'])
+
+    try:
+        async with db_connection() as conn:
+            cur = await conn.execute(queries.CREATE_AUCTION_STATEMENT, values)
+            auction_id, end_time = await cur.fetchone()
+        # the expiry task may need to wake up earlier
+        if payload['status'] == 'open':
+            expiry_wakeup.set()
+        response = {'status': StatusCodes['success'], 'results': {'auction_id': auction_id}}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'POST /auctions/ - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@app.route('/auctions/list', methods=['GET'])
+async def get_open_auctions():
+    logger.info('GET /auctions/open/')
+
+    try:
+        page = page_args()
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': f'Invalid after or limit: {error}'}
+        return quart.jsonify(response)
+
+    if page is None:
+        return stream_response(queries.OPEN_AUCTIONS_QUERY, (), AUCTION_COLUMNS, 'GET /auctions/list')
+
+    try:
+        async with db_connection() as conn:
+            cur = await conn.execute(queries.OPEN_AUCTIONS_PAGE_QUERY, page)
+            rows = await cur.fetchall()
+
+        response = {'status': StatusCodes['success'], 'results': rows_to_dicts(AUCTION_COLUMNS, rows), 'next_after': rows[-1][0] if len(rows) == page[1] else None}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'GET /auctionsopen/ - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+##
+## Search auctions (see demo-proj.py for the query forms)
+##
+
+SEARCH_DEFAULT_LIMIT = 50
+SEARCH_MAX_LIMIT = 500
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+@app.route('/auctions/search/', methods=['GET'])
+async def search_auction():
+    logger.info('GET /auctions/search/')
+
+    args = quart.request.args
+    auction_id = args.get('auction_id')
+    title = args.get('title')
+    description = args.get('description')
+    text = args.get('q')
+    prefix = args.get('prefix', 'false').lower() in ('1', 'true', 'yes')
+    cursor = args.get('cursor')
+
+    if not auction_id and not title and not description and not text:
+        response = {
+            'status': StatusCodes['api_error'],
+            'results': 'At least one search parameter (q, auction_id, title, or description) must be provided'
+        }
+        return quart.jsonify(response)
+
+    try:
+        limit = min(int(args.get('limit', SEARCH_DEFAULT_LIMIT)), SEARCH_MAX_LIMIT)
+        after = decode_cursor(cursor) if cursor else None
+        if limit < 1:
+            raise ValueError('limit must be positive')
+    except (ValueError, TypeError) as error:
+        response = {'status': StatusCodes['api_error'], 'results': f'Invalid limit or cursor: {error}'}
+        return quart.jsonify(response)
+
+    sql_query, values = queries.search_query(text, prefix, auction_id, title, description, after, limit)
+
+    try:
+        async with db_connection() as conn:
+            cur = await conn.execute(sql_query, values)
+            rows = await cur.fetchall()
+
+        columns = AUCTION_COLUMNS + ('rank',) if text else AUCTION_COLUMNS
+        response = {
+            'status': StatusCodes['success'],
+            'results': rows_to_dicts(columns, rows[:limit]),
+            'next_cursor': encode_cursor([rows[limit - 1][5], rows[limit - 1][0]]) if len(rows) > limit else None
+        }
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'GET /auctions/search/ - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+########## Auction Summary ##########
+
+TOP_DEFAULT_LIMIT = 10
+TOP_MAX_LIMIT = 100
+
+SUMMARY_COLUMNS = ('auction_id', 'title', 'status', 'end_time', 'current_bid', 'leader_user_id', 'bid_count', 'last_bid_time')
+
+@app.route('/auctions/<int:auction_id>/summary', methods=['GET'])
+async def get_auction_summary(auction_id):
+    logger.info(f'GET /auctions/{auction_id}/summary')
+
+    try:
+        async with db_connection() as conn:
+            cur = await conn.execute(queries.AUCTION_SUMMARY_QUERY, (auction_id,))
+            row = await cur.fetchone()
+
+        if row is None:
+            response = {'status': StatusCodes['api_error'], 'results': f'Auction {auction_id} does not exist'}
+        else:
+            response = {'status': StatusCodes['success'], 'results': dict(zip(SUMMARY_COLUMNS, row))}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'GET /auctions/{auction_id}/summary - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+@app.route('/auctions/top', methods=['GET'])
+async def get_top_auctions():
+    logger.info('GET /auctions/top')
+
+    try:
+        limit = min(int(quart.request.args.get('limit', TOP_DEFAULT_LIMIT)), TOP_MAX_LIMIT)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': f'Invalid limit: {error}'}
+        return quart.jsonify(response)
+
+    try:
+        async with db_connection() as conn:
+            cur = await conn.execute(queries.TOP_AUCTIONS_QUERY, (limit,))
+            rows = await cur.fetchall()
+        response = {'status': StatusCodes['success'], 'results': rows_to_dicts(SUMMARY_COLUMNS, rows)}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'GET /auctions/top - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+########## Bid History ##########
+
+BID_COLUMNS = ('bid_id', 'bid_amount', 'bid_time', 'buyer_user_id', 'item_id')
+
+@app.route('/auctions/<int:auction_id>/bids', methods=['GET'])
+async def get_auction_bids(auction_id):
+    logger.info(f'GET /auctions/{auction_id}/bids')
+
+    try:
+        after, limit = page_args() or (0, LIST_DEFAULT_LIMIT)
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': f'Invalid after or limit: {error}'}
+        return quart.jsonify(response)
+
+    try:
+        async with db_connection() as conn:
+            cur = await conn.execute(queries.AUCTION_BIDS_QUERY, {'auction_id': auction_id, 'after': after, 'limit': limit})
+            rows = await cur.fetchall()
+
+            if not rows and not after:
+                cur = await conn.execute(queries.AUCTION_EXISTS_QUERY, (auction_id,))
+                if await cur.fetchone() is None:
+                    response = {'status': StatusCodes['api_error'], 'results': f'Auction {auction_id} does not exist'}
+                    return quart.jsonify(response)
+
+        response = {'status': StatusCodes['success'], 'results': rows_to_dicts(BID_COLUMNS, rows), 'next_after': rows[-1][0] if len(rows) == limit else None}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'GET /auctions/{auction_id}/bids - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+@app.route('/auctions/add_item', methods=['POST'])
+async def add_item_to_auction():
+    logger.info('POST /auctions/add_item')
+    payload = await quart.request.get_json()
+
+    if 'auction_id' not in payload or 'item_name' not in payload or 'minimum_price' not in payload or 'sellers_user_id' not in payload:
+        response = {'status': StatusCodes['api_error'], 'results': 'Required fields missing'}
+        return quart.jsonify(response)
+
+    try:
+        async with db_connection() as conn:
+            cur = await conn.execute(queries.ADD_ITEM_STATEMENT,
+                                     (payload['item_name'], payload['minimum_price'], payload['auction_id'], payload['sellers_user_id']))
+            item_id = (await cur.fetchone())[0]
+        response = {'status': StatusCodes['success'], 'results': 'Item added successfully', 'item_id': item_id}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'POST /auctions/add_item - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+########## Bids ##########
+
+@app.route('/auctions/bid', methods=['POST'])
+async def place_bid():
+    logger.info('POST /auctions/bid')
+    payload = await quart.request.get_json()
+
+    if 'auctions_auction_id' not in payload or 'bid_amount' not in payload or 'buyers_user_id' not in payload or 'items_item_id' not in payload:
+        response = {'status': StatusCodes['api_error'], 'results': 'Required fields missing'}
+        return quart.jsonify(response)
+
+    values = {
+        'auction_id': payload['auctions_auction_id'],
+        'bid_amount': payload['bid_amount'],
+        'item_id': payload['items_item_id'],
+        'buyer_id': payload['buyers_user_id']
+    }
+
+    try:
+        # one statement, one round trip (autocommit)
+        async with db_connection() as conn:
+            cur = await conn.execute(queries.PLACE_BID_STATEMENT, values)
+            row = await cur.fetchone()
+
+        if row is None:
+            response = {'status': StatusCodes['api_error'], 'results': f'Auction {values["auction_id"]} does not exist'}
+        elif row[2] is not None:
+            response = {'status': StatusCodes['success'], 'results': 'Bid placed successfully', 'bid_id': row[2], 'outbid_user_id': row[3]}
+            if row[3] is not None and row[3] != values['buyer_id']:
+                dispatcher_wakeup.set()
+        elif row[0] != 'open':
+            response = {'status': StatusCodes['api_error'], 'results': f'Auction {values["auction_id"]} is not open'}
+        else:
+            response = {'status': StatusCodes['api_error'], 'results': 'Bid amount must be higher than current highest bid'}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'POST /auctions/bid - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+##
+## Batch bids: resolved in order against the locked auctions as in
+## demo-proj.py, with the multi-row writes sent as arrays and unnest()ed
+##
+
+BATCH_MAX_BIDS = int(os.environ.get('BATCH_MAX_BIDS', 10000))
+
+@app.route('/auctions/bids/batch', methods=['POST'])
+async def place_bids_batch():
+    logger.info('POST /auctions/bids/batch')
+    payload = await quart.request.get_json()
+
+    bids = payload.get('bids') if isinstance(payload, dict) else payload
+    if not isinstance(bids, list) or not bids:
+        response = {'status': StatusCodes['api_error'], 'results': 'A non-empty list of bids is required'}
+        return quart.jsonify(response)
+    if len(bids) > BATCH_MAX_BIDS:
+        response = {'status': StatusCodes['api_error'], 'results': f'At most {BATCH_MAX_BIDS} bids per batch'}
+        return quart.jsonify(response)
+
+    results = []
+    for index, bid in enumerate(bids):
+        if not isinstance(bid, dict) or any(field not in bid for field in ('auctions_auction_id', 'bid_amount', 'buyers_user_id', 'items_item_id')):
+            results.append({'index': index, 'status': 'rejected', 'reason': 'Required fields missing'})
+        elif isinstance(bid['bid_amount'], bool) or not isinstance(bid['bid_amount'], (int, float)):
+            results.append({'index': index, 'status': 'rejected', 'reason': 'bid_amount must be a number'})
+        elif any(isinstance(bid[field], bool) or not isinstance(bid[field], int) for field in ('auctions_auction_id', 'buyers_user_id', 'items_item_id')):
+            results.append({'index': index, 'status': 'rejected', 'reason': 'auctions_auction_id, buyers_user_id and items_item_id must be integers'})
+        else:
+            results.append(None)
+
+    try:
+        auction_ids = sorted({bid['auctions_auction_id'] for bid, result in zip(bids, results) if result is None})
+
+        async with db_connection() as conn, conn.transaction():
+            # lock the auctions in a fixed order so concurrent batches cannot deadlock
+            auctions = {}
+            if auction_ids:
+                cur = await conn.execute(queries.BATCH_LOCK_QUERY, (auction_ids,))
+                for row in await cur.fetchall():
+                    auctions[row[0]] = {'status': row[1], 'current_bid': row[2], 'current_bidder_id': row[3], 'changed': False, 'bids': 0}
+
+            accepted = []
+            notifications = []
+            for index, bid in enumerate(bids):
+                if results[index] is not None:
+                    continue
+
+                auction_id = bid['auctions_auction_id']
+                auction = auctions.get(auction_id)
+                if auction is None:
+                    results[index] = {'index': index, 'status': 'rejected', 'reason': f'Auction {auction_id} does not exist'}
+                elif auction['status'] != 'open':
+                    results[index] = {'index': index, 'status': 'rejected', 'reason': f'Auction {auction_id} is not open'}
+                elif auction['current_bid'] is not None and bid['bid_amount'] <= auction['current_bid']:
+                    results[index] = {'index': index, 'status': 'rejected', 'reason': 'Bid amount must be higher than current highest bid'}
+                else:
+                    previous_bid, previous_bidder_id = auction['current_bid'], auction['current_bidder_id']
+                    if previous_bidder_id is not None and previous_bidder_id != bid['buyers_user_id']:
+                        notifications.append((previous_bid, auction_id, bid['buyers_user_id'], previous_bidder_id))
+
+                    auction.update(current_bid=float(bid['bid_amount']), current_bidder_id=bid['buyers_user_id'], changed=True, bids=auction['bids'] + 1)
+                    results[index] = {'index': index, 'status': 'accepted', 'outbid_user_id': previous_bidder_id}
+                    accepted.append(index)
+
+            if accepted:
+                # amounts as floats: psycopg cannot send a list that mixes int and float
+                columns = [[float(bids[i]['bid_amount']) for i in accepted]] + [[bids[i][field] for i in accepted] for field in ('items_item_id', 'auctions_auction_id', 'buyers_user_id')]
+                cur = await conn.execute(queries.BATCH_STATEMENTS['bids'], columns)
+                for i, row in zip(accepted, await cur.fetchall()):
+                    results[i]['bid_id'] = row[0]
+
+                changed = [(auction_id, auction) for auction_id, auction in auctions.items() if auction['changed']]
+                await conn.execute(queries.BATCH_STATEMENTS['auctions'], ([auction_id for auction_id, _ in changed], [auction['current_bid'] for _, auction in changed],
+                                                                  [auction['current_bidder_id'] for _, auction in changed]))
+                await conn.execute(queries.BATCH_STATEMENTS['summary'], ([auction_id for auction_id, _ in changed], [auction['bids'] for _, auction in changed]))
+
+            if notifications:
+                await conn.execute(queries.BATCH_STATEMENTS['outbid'], [list(column) for column in zip(*notifications)])
+
+        if notifications:
+            dispatcher_wakeup.set()
+        response = {'status': StatusCodes['success'], 'accepted': len(accepted), 'rejected': len(bids) - len(accepted), 'results': results}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'POST /auctions/bids/batch - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+########## Close Auction ##########
+
+@app.route('/auctions/close/<int:auction_id>/', methods=['PUT'])
+async def close_auction(auction_id):
+    logger.info(f'PUT /auctions/close/{auction_id}')
+
+    current_datetime = datetime.now()
+
+    try:
+        async with db_connection() as conn:
+            cur = await conn.execute(queries.CLOSE_AUCTION_STATEMENT, {'auction_id': auction_id, 'now': current_datetime})
+            row = await cur.fetchone()
+
+        if row is None:
+            response = {'status': StatusCodes['api_error'], 'results': f'Auction {auction_id} does not exist'}
+        elif row[0]:
+            response = {'status': StatusCodes['success'], 'results': f'Auction {auction_id} closed successfully'}
+        elif row[1] != 'open':
+            response = {'status': StatusCodes['api_error'], 'results': f'Auction {auction_id} is not open'}
+        else:
+            response = {'status': StatusCodes['api_error'], 'results': 'Auction cannot be closed yet'}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'PUT /auctions/close/{auction_id} - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+########## Cancel Auction ##########
+
+@app.route('/auctions/cancel/<int:auction_id>/', methods=['PUT'])
+async def cancel_auction(auction_id):
+    logger.info(f'PUT /auctions/cancel/{auction_id}')
+
+    try:
+        async with db_connection() as conn:
+            cur = await conn.execute(queries.CANCEL_AUCTION_STATEMENT, {'auction_id': auction_id, 'message': f'The auction {auction_id} has been cancelled.'})
+            notified = (await cur.fetchone())[0]
+
+        if notified:
+            dispatcher_wakeup.set()
+        response = {'status': StatusCodes['success'], 'results': f'Auction {auction_id} cancelled successfully'}
+
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'PUT /auctions/cancel/{auction_id} - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    return quart.jsonify(response)
+
+
+########## Background Tasks ##########
+##
+## The jobs of demo-proj.py's background threads, as tasks of each serving
+## process's event loop. Expiry sleeps until the earliest end_time of an open
+## auction (or reload_interval), and is woken early by create_auction. The
+## dispatcher drains notification_outbox in batches under DISPATCH_LOCK_ID,
+## woken by the endpoints that queue notifications. The maintenance task
+## archives the bids of finished auctions, packs them into compressed arrays
+## and creates the notifications partitions under MAINTENANCE_LOCK_ID.
+##
+
+EXPIRY_CONFIG = {
+    'enabled': os.environ.get('EXPIRY_SCHEDULER', 'on') == 'on',
+    'reload_interval': float(os.environ.get('EXPIRY_RELOAD_INTERVAL', 60)),
+    'retry_interval': float(os.environ.get('EXPIRY_RETRY_INTERVAL', 5))
+}
+
+DISPATCHER_CONFIG = {
+    'enabled': os.environ.get('NOTIFICATION_DISPATCHER', 'on') == 'on',
+    'batch_size': int(os.environ.get('DISPATCHER_BATCH_SIZE', 500)),
+    'flush_interval': float(os.environ.get('DISPATCHER_FLUSH_INTERVAL', 1)),
+    'retry_interval': float(os.environ.get('DISPATCHER_RETRY_INTERVAL', 5))
+}
+
+MAINTENANCE_CONFIG = {
+    'enabled': os.environ.get('MAINTENANCE_JOB', 'on') == 'on',
+    'interval': float(os.environ.get('MAINTENANCE_INTERVAL', 300)),
+    'batch_size': int(os.environ.get('ARCHIVE_BATCH_SIZE', 100)),
+    'months_ahead': int(os.environ.get('NOTIFICATION_MONTHS_AHEAD', 2)),
+    'retry_interval': float(os.environ.get('MAINTENANCE_RETRY_INTERVAL', 60))
+}
+
+expiry_wakeup = asyncio.Event()
+dispatcher_wakeup = asyncio.Event()
+
+async def wait_for(event, timeout):
+    try:
+        await asyncio.wait_for(event.wait(), max(timeout, 0))
+    except asyncio.TimeoutError:
+        pass
+
+async def expire_auctions():
+    while True:
+        try:
+            expiry_wakeup.clear()
+            async with db_connection() as conn:
+                cur = await conn.execute(queries.EXPIRE_STATEMENT, (datetime.now(),))
+                closed = await cur.fetchall()
+                cur = await conn.execute(queries.NEXT_END_TIME_QUERY)
+                next_end_time = (await cur.fetchone())[0]
+
+            if closed:
+                logger.info(f'auction expiry - closed {len(closed)} auctions')
+            timeout = EXPIRY_CONFIG['reload_interval']
+            if next_end_time is not None:
+                timeout = min(timeout, (next_end_time - datetime.now()).total_seconds())
+            await wait_for(expiry_wakeup, timeout)
+
+        except (Exception, psycopg.DatabaseError) as error:
+            logger.error(f'auction expiry - error: {error}')
+            await asyncio.sleep(EXPIRY_CONFIG['retry_interval'])
+
+async def dispatch_notifications():
+    while True:
+        try:
+            dispatcher_wakeup.clear()
+            while True:
+                async with db_connection() as conn, conn.transaction():
+                    await conn.execute(queries.LOCK_STATEMENT, (queries.DISPATCH_LOCK_ID,))
+                    cur = await conn.execute(queries.DISPATCH_STATEMENT, (DISPATCHER_CONFIG['batch_size'], queries.EVENTS_CHANNEL))
+                    dispatched = (await cur.fetchone())[0]
+                if dispatched < DISPATCHER_CONFIG['batch_size']:
+                    break
+            await wait_for(dispatcher_wakeup, DISPATCHER_CONFIG['flush_interval'])
+
+        except (Exception, psycopg.DatabaseError) as error:
+            logger.error(f'notification dispatcher - error: {error}')
+            await asyncio.sleep(DISPATCHER_CONFIG['retry_interval'])
+
+def next_month(month):
+    return (month + timedelta(days=32)).replace(day=1)
+
+async def try_lock(conn):
+    cur = await conn.execute(queries.TRY_LOCK_STATEMENT, (queries.MAINTENANCE_LOCK_ID,))
+    return (await cur.fetchone())[0]
+
+async def create_partitions():
+    month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    months = set()
+    for _ in range(MAINTENANCE_CONFIG['months_ahead'] + 1):
+        months.add(month)
+        month = next_month(month)
+
+    async with db_connection() as conn:
+        cur = await conn.execute(queries.PARTITIONS_QUERY)
+        existing = {row[0] for row in await cur.fetchall()}
+        cur = await conn.execute(queries.UNPARTITIONED_MONTHS_QUERY)
+        months.update(row[0] for row in await cur.fetchall())
+
+        for start in sorted(months):
+            partition = f'notifications_{start:%Y_%m}'
+            if partition in existing:
+                continue
+            async with conn.transaction():
+                if not await try_lock(conn):
+                    return
+                cur = await conn.execute(queries.PARTITION_EXISTS_QUERY, (partition,))
+                if (await cur.fetchone())[0]:
+                    continue
+                for statement in queries.PARTITION_STATEMENTS:
+                    query = psycopg.sql.SQL(statement).format(partition=psycopg.sql.Identifier(partition),
+                                                              start=psycopg.sql.Literal(start), end=psycopg.sql.Literal(next_month(start)))
+                    await conn.execute(query)
+            logger.info(f'maintenance - created partition {partition}')
+
+async def move_bids(statement):
+    # bids moved by statement, batch_size auctions per transaction
+    moved = 0
+    while True:
+        async with db_connection() as conn, conn.transaction():
+            if not await try_lock(conn):
+                break
+            cur = await conn.execute(statement, (MAINTENANCE_CONFIG['batch_size'],))
+            auctions, bids = await cur.fetchone()
+        moved += bids
+        if auctions < MAINTENANCE_CONFIG['batch_size']:
+            break
+    return moved
+
+async def archive_bids():
+    archived = await move_bids(queries.ARCHIVE_STATEMENT)
+    if archived:
+        logger.info(f'maintenance - archived {archived} bids')
+
+async def pack_bids():
+    packed = await move_bids(queries.PACK_STATEMENT)
+    if packed:
+        logger.info(f'maintenance - packed {packed} bids')
+
+async def run_maintenance():
+    # the jobs fail separately, so a partition error does not stop archiving
+    while True:
+        interval = MAINTENANCE_CONFIG['interval']
+        for job in (create_partitions, archive_bids, pack_bids):
+            try:
+                await job()
+            except (Exception, psycopg.DatabaseError) as error:
+                logger.error(f'maintenance - {job.__name__} error: {error}')
+                interval = MAINTENANCE_CONFIG['retry_interval']
+        await asyncio.sleep(interval)
+
+
+##
+## Server process lifecycle: each serving process opens its own pool once the
+## database answers, and starts the background tasks on its event loop
+##
+
+_tasks = []
+
+@app.before_serving
+async def start_serving():
+    global pool
+    pool = AsyncConnectionPool(psycopg.conninfo.make_conninfo(**DB_CONFIG), kwargs={'autocommit': True}, open=False, **POOL_CONFIG)
+    await pool.open(wait=True, timeout=DB_READY_TIMEOUT)
+
+    for enabled, job in ((EXPIRY_CONFIG['enabled'], expire_auctions), (DISPATCHER_CONFIG['enabled'], dispatch_notifications),
+                         (MAINTENANCE_CONFIG['enabled'], run_maintenance)):
+        if enabled:
+            _tasks.append(asyncio.create_task(job()))
+
+@app.after_serving
+async def stop_serving():
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+    await pool.close()
+
+
+########## Readiness ##########
+@app.route('/ready', methods=['GET'])
+async def readiness():
+    try:
+        async with db_connection() as conn:
+            await conn.execute('SELECT 1')
+        response = {'status': StatusCodes['success'], 'results': 'ready'}
+        code = StatusCodes['success']
+    except (Exception, psycopg.DatabaseError) as error:
+        logger.error(f'GET /ready - error: {error}')
+        response = {'status': StatusCodes['unavailable'], 'errors': str(error)}
+        code = StatusCodes['unavailable']
+    return quart.jsonify(response), code
+
+
+##########################################################
+## MAIN
+##########################################################
+if __name__ == "__main__":
+
+    # development server; see the header for the production one (SERVER_MODE=async)
+    logger.info("\n---------------------------------------------------------------\n" +
+                "API v1.1 online: http://localhost:8080/users/\n\n")
+
+    app.run(host="0.0.0.0", port=5000, debug=True)
@@ -6,34 +6,1625 @@
 ## It is in this file that you should implement the functionalities/transactions   
 
 import flask
-import logging, psycopg2, time
+import atexit, base64, csv, functools, gzip, hashlib, heapq, io, json, logging, logging.handlers, os, psycopg2, psycopg2.extensions, psycopg2.pool, psycopg2.sql, queue, re, select, threading, time, uuid, zlib
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+
+import queries
+
+try:
+    import redis  # only needed for CACHE_BACKEND=redis
+except ImportError:
+    redis = None
+try:
+    import msgpack  # only needed for MessagePack responses
+except ImportError:
+    msgpack = None
+try:
+    import brotli  # only needed for br compression
+except ImportError:
+    brotli = None
 
 app = flask.Flask(__name__)
 
 StatusCodes = {
     'success': 200,
     'api_error': 400,
-    'internal_error': 500
+    'internal_error': 500,
+    'unavailable': 503
 }
 
+##########################################################
+## LOGGING
+##########################################################
+
+##
+## Request threads only put records on a queue; a QueueListener thread
+## formats them and writes them to the console and the (rotating) log file,
+## so log I/O never blocks a request. Every record carries the id of the
+## request that produced it (X-Request-ID, generated when missing).
+## Per-row debug output goes through row_logger, which only lets 1 in
+## LOG_ROW_SAMPLE records through.
+##
+
+LOG_CONFIG = {
+    'level': os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    'format': os.environ.get('LOG_FORMAT', 'text'),             # text or json
+    'file': os.environ.get('LOG_FILE', 'logs/log_file.log'),    # empty to log to the console only
+    'rotation': os.environ.get('LOG_ROTATION', 'size'),         # size or time
+    'max_bytes': int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024)),
+    'when': os.environ.get('LOG_ROTATE_WHEN', 'midnight'),
+    'backup_count': int(os.environ.get('LOG_BACKUP_COUNT', 5)),
+    'row_sample': int(os.environ.get('LOG_ROW_SAMPLE', 100))
+}
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'thread': record.threadName,
+            'request_id': getattr(record, 'request_id', None),
+            'message': record.getMessage()
+        }
+        return json.dumps(entry, default=str)
+
+
+class RequestIdFilter(logging.Filter):
+    # runs in the thread that logs, where the request context is available
+
+    def filter(self, record):
+        record.request_id = flask.g.get('request_id') if flask.has_request_context() else '-'
+        return True
+
+
+class SampleFilter(logging.Filter):
+    # lets 1 in every `every` records through
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = max(every, 1)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        with self._lock:
+            self._count += 1
+            return (self._count - 1) % self.every == 0
+
+
+def setup_logging():
+    if LOG_CONFIG['format'] == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(request_id)s:  %(message)s', '%H:%M:%S')
+
+    handlers = [logging.StreamHandler()]
+    if LOG_CONFIG['file']:
+        os.makedirs(os.path.dirname(LOG_CONFIG['file']) or '.', exist_ok=True)
+        if LOG_CONFIG['rotation'] == 'time':
+            handlers.append(logging.handlers.TimedRotatingFileHandler(LOG_CONFIG['file'], when=LOG_CONFIG['when'], backupCount=LOG_CONFIG['backup_count']))
+        else:
+            handlers.append(logging.handlers.RotatingFileHandler(LOG_CONFIG['file'], maxBytes=LOG_CONFIG['max_bytes'], backupCount=LOG_CONFIG['backup_count']))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_CONFIG['level'])
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # flush what is still queued
+
+setup_logging()
+logger = logging.getLogger('logger')
+row_logger = logger.getChild('rows')
+row_logger.addFilter(SampleFilter(LOG_CONFIG['row_sample']))
+
+@app.before_request
+def assign_request_id():
+    flask.g.request_id = flask.request.headers.get('X-Request-ID') or uuid.uuid4().hex
+
+@app.after_request
+def return_request_id(response):
+    if 'request_id' in flask.g:
+        response.headers['X-Request-ID'] = flask.g.request_id
+    return response
+
+
+##########################################################
+## METRICS
+##########################################################
+
+##
+## Per-route request metrics, exposed at GET /metrics in the Prometheus text
+## format. Every query goes through InstrumentedCursor, which adds its time
+## and the rows fetched to the current request (or to 'background' for the
+## scheduler and dispatcher threads). Queries slower than SLOW_QUERY_MS are
+## logged with their SQL and parameters.
+##
+## Each process keeps its own metrics; under gunicorn, scrape the workers
+## individually or read them as samples of the whole.
+##
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 250))  # 0 disables the slow query log
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class Counter:
+
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{format_labels(dict(zip(self.label_names, labels)))} {value}')
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, series in sorted(self._values.items()):
+                names = dict(zip(self.label_names, labels))
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{format_labels({**names, "le": bound})} {count}')
+                lines.append(f'{self.name}_bucket{format_labels({**names, "le": "+Inf"})} {series[-1]}')
+                lines.append(f'{self.name}_sum{format_labels(names)} {series[-2]}')
+                lines.append(f'{self.name}_count{format_labels(names)} {series[-1]}')
+        return lines
+
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Request latency', ('route', 'method', 'status'), LATENCY_BUCKETS)
+RESPONSE_BYTES = Histogram('http_response_size_bytes', 'Response body size (streamed responses are not counted)', ('route', 'method'), SIZE_BUCKETS)
+REQUEST_QUERIES = Histogram('db_queries_per_request', 'Queries executed per request', ('route', 'method'), COUNT_BUCKETS)
+REQUEST_DB_SECONDS = Histogram('db_time_per_request_seconds', 'Time spent executing queries per request', ('route', 'method'), LATENCY_BUCKETS)
+POOL_WAIT_SECONDS = Histogram('db_pool_checkout_seconds', 'Time to get a connection from the pool', ('route',), LATENCY_BUCKETS)
+CONNECT_SECONDS = Histogram('db_connect_seconds', 'Time to open a new database connection', (), LATENCY_BUCKETS)
+QUERIES = Counter('db_queries_total', 'Queries executed', ('route',))
+QUERY_SECONDS = Counter('db_query_seconds_total', 'Time spent executing queries', ('route',))
+ROWS_FETCHED = Counter('db_rows_fetched_total', 'Rows fetched from the database', ('route',))
+SLOW_QUERIES = Counter('db_slow_queries_total', 'Queries slower than SLOW_QUERY_MS', ('route',))
+STATEMENT_PREPARES = Counter('db_statement_prepares_total', 'Registered statements prepared on a connection', ('statement',))
+STATEMENT_EXECUTIONS = Counter('db_statement_executions_total', 'Registered statements executed', ('statement', 'prepared'))
+READ_ROUTING = Counter('db_read_connections_total', 'Connections handed to read-only endpoints, by where they went', ('route', 'target'))
+ADMISSION_QUEUE_SECONDS = Histogram('http_admission_queue_seconds', 'Time admitted requests waited for a slot', ('endpoint',), LATENCY_BUCKETS)
+ADMISSION_SHED = Counter('http_admission_shed_total', 'Requests answered 503 by admission control', ('endpoint', 'reason'))
+
+METRICS = [REQUEST_SECONDS, RESPONSE_BYTES, REQUEST_QUERIES, REQUEST_DB_SECONDS, POOL_WAIT_SECONDS, CONNECT_SECONDS, QUERIES, QUERY_SECONDS, ROWS_FETCHED, SLOW_QUERIES,
+           STATEMENT_PREPARES, STATEMENT_EXECUTIONS, READ_ROUTING, ADMISSION_QUEUE_SECONDS, ADMISSION_SHED]
+
+slow_query_logger = logging.getLogger('logger.slow_query')
+
+def current_route():
+    if not flask.has_request_context():
+        return 'background'
+    rule = flask.request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+def record_query(elapsed, query, params):
+    route = current_route()
+    QUERIES.inc(route)
+    QUERY_SECONDS.inc(route, amount=elapsed)
+    if flask.has_request_context():
+        flask.g.db_queries = flask.g.get('db_queries', 0) + 1
+        flask.g.db_time = flask.g.get('db_time', 0.0) + elapsed
+
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        SLOW_QUERIES.inc(route)
+        sql = query.decode() if isinstance(query, bytes) else str(query)
+        slow_query_logger.warning(f'slow query ({elapsed * 1000:.1f} ms) on {route}: {" ".join(sql.split())[:2000]} params={params!r:.1000}')
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_query(time.perf_counter() - start, query, vars)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record_query(time.perf_counter() - start, query, '<executemany>')
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            record_query(time.perf_counter() - start, sql, '<copy>')
+
+    def _rows(self, count):
+        ROWS_FETCHED.inc(current_route(), amount=count)
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self._rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        start = time.perf_counter()
+        rows = super().fetchmany(size)
+        if self.name is not None:
+            # a named cursor fetches each chunk from the server
+            record_query(time.perf_counter() - start, f'FETCH FORWARD {size} FROM {self.name}', None)
+        self._rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self._rows(len(rows))
+        return rows
+
+
+@app.before_request
+def start_request_metrics():
+    flask.g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_start' not in flask.g:
+        return response
+    route = current_route()
+    REQUEST_SECONDS.observe(time.perf_counter() - flask.g.request_start, route, flask.request.method, response.status_code)
+    REQUEST_QUERIES.observe(flask.g.get('db_queries', 0), route, flask.request.method)
+    REQUEST_DB_SECONDS.observe(flask.g.get('db_time', 0.0), route, flask.request.method)
+    if not response.is_streamed:
+        RESPONSE_BYTES.observe(response.calculate_content_length() or 0, route, flask.request.method)
+    return response
+
+
 ##########################################################
 ## DATABASE ACCESS
 ##########################################################
 
-def db_connection():
-    db = psycopg2.connect(
-        user = "scott",
-        password = "tiger",
-        host = "db",
-        port = "5432",
-        database = "dbproj"
-    )
-    
-    return db
+# connection settings, overridable from the environment (docker-compose)
+DB_CONFIG = {
+    'user': os.environ.get('DB_USER', 'scott'),
+    'password': os.environ.get('DB_PASSWORD', 'tiger'),
+    'host': os.environ.get('DB_HOST', 'db'),
+    'port': os.environ.get('DB_PORT', '5432'),
+    'database': os.environ.get('DB_NAME', 'dbproj')
+}
+
+# connection pool settings (times in seconds)
+POOL_CONFIG = {
+    'min_size': int(os.environ.get('DB_POOL_MIN', 2)),
+    'max_size': int(os.environ.get('DB_POOL_MAX', 20)),
+    'timeout': float(os.environ.get('DB_POOL_TIMEOUT', 5)),          # max wait for a free connection
+    'max_idle': float(os.environ.get('DB_POOL_MAX_IDLE', 300)),      # idle connections above min_size are closed after this
+    'check_after': float(os.environ.get('DB_POOL_CHECK_AFTER', 30))  # connections idle longer than this are pinged on checkout
+}
+
+DB_READY_TIMEOUT = float(os.environ.get('DB_READY_TIMEOUT', 20))  # seconds a starting server waits for the database
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    pass
+
+
+##
+## Thread-safe connection pool
+##
+## Connections are handed out most-recently-used first, so the ones at the
+## left of the idle queue are the oldest and the first to be evicted.
+## Connections that sat idle for a while are checked with a SELECT 1 before
+## being handed out, and broken ones are replaced transparently.
+##
+
+class ConnectionPool:
+
+    def __init__(self, connect, min_size, max_size, timeout, max_idle, check_after):
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.check_after = check_after
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (connection, last_used) pairs
+        self._in_use = 0      # checked out or being opened
+
+        self._counters = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'timeouts': 0,
+            'opened': 0,
+            'evicted': 0,
+            'failed_checks': 0
+        }
+
+        for _ in range(self.min_size):
+            self._idle.append((self._open(), time.monotonic()))
+
+    def _open(self):
+        start = time.perf_counter()
+        conn = self._connect()
+        CONNECT_SECONDS.observe(time.perf_counter() - start)
+        with self._cond:
+            self._counters['opened'] += 1
+        return conn
+
+    def _evict_idle(self):
+        # called with the lock held
+        now = time.monotonic()
+        while self._idle and len(self._idle) + self._in_use > self.min_size and now - self._idle[0][1] > self.max_idle:
+            conn, _ = self._idle.popleft()
+            conn.close()
+            self._counters['evicted'] += 1
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.check_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+
+        with self._cond:
+            while True:
+                self._evict_idle()
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._in_use < self.max_size:
+                    conn, last_used = None, None
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters['timeouts'] += 1
+                    raise PoolTimeout(f'no database connection available after {self.timeout}s')
+                waited = True
+                self._cond.wait(remaining)
+
+            self._in_use += 1
+            self._counters['checkouts'] += 1
+            if waited:
+                wait_time = time.monotonic() - start
+                self._counters['waits'] += 1
+                self._counters['wait_time_total'] += wait_time
+                self._counters['wait_time_max'] = max(self._counters['wait_time_max'], wait_time)
+
+        # opening and health checks happen outside the lock
+        try:
+            if conn is None:
+                conn = self._open()
+            elif not self._is_healthy(conn, last_used):
+                with self._cond:
+                    self._counters['failed_checks'] += 1
+                conn.close()
+                conn = self._open()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        return conn
+
+    def putconn(self, conn):
+        # never hand out a connection in the middle of a transaction
+        if not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except psycopg2.Error:
+                conn.close()
+
+        with self._cond:
+            self._in_use -= 1
+            if not conn.closed:
+                self._idle.append((conn, time.monotonic()))
+            self._evict_idle()
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                conn.close()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats.update({
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'size': self._in_use + len(self._idle),
+                'min_size': self.min_size,
+                'max_size': self.max_size
+            })
+        return stats
+
+
+##
+## Proxy returned by db_connection(): behaves like a psycopg2 connection,
+## but close() gives the connection back to the pool
+##
+
+class PooledConnection:
+
+    def __init__(self, pool, conn):
+        object.__setattr__(self, '_pool', pool)
+        object.__setattr__(self, '_conn', conn)
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise psycopg2.InterfaceError('connection already returned to the pool')
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    @property
+    def closed(self):
+        return self._conn is None or self._conn.closed
+
+    def close(self):
+        conn = self._conn
+        if conn is not None:
+            object.__setattr__(self, '_conn', None)
+            self._pool.putconn(conn)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(lambda: psycopg2.connect(connection_factory=PreparingConnection, cursor_factory=InstrumentedCursor, **DB_CONFIG), **POOL_CONFIG)
+    return _pool
+
+def db_connection(read_only=False):
+    # read_only: the caller only reads and may be served by a replica
+    if read_only and replica_set.replicas:
+        conn = replica_set.connection()
+        if conn is not None:
+            return conn
+    pool = get_pool()
+    start = time.perf_counter()
+    conn = pool.getconn()
+    POOL_WAIT_SECONDS.observe(time.perf_counter() - start, current_route())
+    return PooledConnection(pool, conn)
+
+def wait_for_database(timeout):
+    # block until the database accepts connections (it may still be starting)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            psycopg2.connect(connect_timeout=2, **DB_CONFIG).close()
+            return
+        except psycopg2.OperationalError as error:
+            if time.monotonic() >= deadline:
+                raise
+            logger.info(f'waiting for the database: {error}')
+            time.sleep(1)
+
+
+##
+## Read replicas
+##
+## DB_REPLICAS lists streaming replicas of the database (host or host:port,
+## comma separated; same user, password and database as the primary). The
+## endpoints that only read ask for db_connection(read_only=True) and get a
+## connection to the replica with the fewest connections in use, each replica
+## having its own pool. Writes, and reads when no replica is configured or
+## healthy, go to the primary.
+##
+## A replica is a little behind the primary, so a client that has just
+## written reads from the primary for pin_seconds: responses to writes set the
+## PIN_COOKIE cookie and reads that carry it skip the replicas (and the
+## response cache).
+##
+## Every check_interval a background thread measures each replica's replay
+## lag (and opens its pool the first time); one that is unreachable or more
+## than max_lag seconds behind is left out until it catches up. Requests only
+## read the outcome, so a replica that is down never makes a read wait for a
+## connect timeout. The same check reads the primary's WAL position first and
+## records, for each replica that has replayed up to it, when it was taken.
+##
+## A read that misses the response cache stores what it reads for everyone,
+## so it must not see data from before the write behind the last
+## invalidation of its entry. cache_invalidate() records when each entry or
+## namespace was invalidated (in every process, see CacheBroadcaster), and a
+## cache miss only goes to a replica that was in sync at a check taken after
+## that; the primary serves it when no replica is.
+##
+
+REPLICA_CONFIG = {
+    'hosts': [host.strip() for host in os.environ.get('DB_REPLICAS', '').split(',') if host.strip()],
+    'pin_seconds': float(os.environ.get('DB_PIN_SECONDS', 5)),
+    'max_lag': float(os.environ.get('DB_REPLICA_MAX_LAG', 10)),
+    'check_interval': float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 5))
+}
+
+PIN_COOKIE = 'db_primary_until'
+
+REPLICA_LAG_QUERY = '''
+    SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() <= pg_last_wal_replay_lsn() THEN 0
+                ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END,
+           NOT pg_is_in_recovery() OR pg_last_wal_replay_lsn() >= %s::pg_lsn
+'''
+
+class Replica:
+
+    def __init__(self, address):
+        host, _, port = address.partition(':')
+        self.name = address
+        self.config = dict(DB_CONFIG, host=host, port=port or DB_CONFIG['port'])
+        self.pool = None
+        self.healthy = False
+        self.lag = None
+        self.synced_at = None  # time.monotonic() of the last check it had replayed everything before
+
+    def connect(self):
+        return psycopg2.connect(connection_factory=PreparingConnection, cursor_factory=InstrumentedCursor, connect_timeout=2, **self.config)
+
+
+class ReplicaSet:
+
+    def __init__(self, addresses, max_lag, check_interval):
+        self.replicas = [Replica(address) for address in addresses]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.pid = None
+        self._lock = threading.Lock()
+        self._next = 0  # rotates the choice between equally busy replicas
+        self._invalidated = {}  # (namespace, key or None) -> time.monotonic() of its last invalidation
+
+    def start(self):
+        self.pid = os.getpid()
+        thread = threading.Thread(target=self._run, name='replica-checks', daemon=True)
+        thread.start()
+
+    def _run(self):
+        while True:
+            checked_at, position = self._primary_position()
+            for replica in self.replicas:
+                self._check(replica, checked_at, position)
+            self._forget_invalidations(checked_at)
+            time.sleep(self.check_interval)
+
+    def reset(self):
+        # after a fork: the pools belong to the parent process
+        with self._lock:
+            for replica in self.replicas:
+                replica.pool = None
+                replica.healthy = False
+                replica.synced_at = None
+
+    def _primary_position(self):
+        # (time, WAL position of the primary); everything committed before that time is before that position
+        checked_at = time.monotonic()
+        try:
+            conn = db_connection()
+            try:
+                cur = conn.cursor()
+                cur.execute('SELECT pg_current_wal_lsn()::text')
+                return checked_at, cur.fetchone()[0]
+            finally:
+                conn.close()
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error(f'replica checks - error: {error}')
+            return checked_at, None
+
+    def _check(self, replica, checked_at, position):
+        pool = replica.pool
+        synced = False
+        try:
+            if pool is None:
+                pool = ConnectionPool(replica.connect, **POOL_CONFIG)
+            conn = pool.getconn()
+            try:
+                cur = conn.cursor()
+                cur.execute(REPLICA_LAG_QUERY, (position,))
+                lag, synced = cur.fetchone()
+                lag = float(lag or 0)
+            finally:
+                pool.putconn(conn)
+        except (Exception, psycopg2.DatabaseError) as error:
+            lag = None
+            if replica.healthy:
+                logger.error(f'replica {replica.name} - error: {error}')
+
+        healthy = lag is not None and lag <= self.max_lag
+        if healthy != replica.healthy:
+            logger.info(f'replica {replica.name} - {"in" if healthy else "out of"} rotation (lag {lag})')
+        with self._lock:
+            replica.lag = lag
+            replica.healthy = healthy
+            if not healthy:
+                replica.synced_at = None
+            elif position is not None and synced:
+                replica.synced_at = checked_at
+            # an unreachable replica gets fresh connections once it is back
+            replica.pool = pool if lag is not None else None
+        if lag is None and pool is not None:
+            pool.closeall()
+
+    def invalidated(self, namespace, key=None):
+        # a write made this cache entry (or the whole namespace) stale
+        if self.replicas:
+            with self._lock:
+                self._invalidated[(namespace, None if key is None else str(key))] = time.monotonic()
+
+    def _forget_invalidations(self, checked_at):
+        # those before every replica's last sync no longer keep a read away
+        # from any of them; one that syncs later does so after all of them
+        with self._lock:
+            synced = [replica.synced_at for replica in self.replicas if replica.synced_at is not None]
+            oldest = min(synced, default=checked_at)
+            self._invalidated = {entry: at for entry, at in self._invalidated.items() if at >= oldest}
+
+    def connection(self):
+        # a pooled connection to the least busy healthy replica, or None
+        if pinned_to_primary():
+            READ_ROUTING.inc(current_route(), 'pinned')
+            return None
+        # a cache miss: the response is stored for everyone, so only a replica
+        # that has replayed the write behind the entry's last invalidation
+        fill = flask.has_request_context() and flask.g.get('cache_generation') is not None
+
+        with self._lock:
+            healthy = [(replica, replica.pool) for replica in self.replicas if replica.healthy]
+            if fill:
+                namespace, key = flask.g.cache_entry
+                since = max(self._invalidated.get((namespace, None), float('-inf')), self._invalidated.get((namespace, str(key)), float('-inf')))
+                healthy = [(replica, pool) for replica, pool in healthy if replica.synced_at is not None and replica.synced_at > since]
+            self._next += 1
+        if not healthy:
+            READ_ROUTING.inc(current_route(), 'cache_fill' if fill else 'primary')
+            return None
+
+        start = self._next % len(healthy)
+        healthy = healthy[start:] + healthy[:start]
+        replica, pool = min(healthy, key=lambda candidate: candidate[1].stats()['in_use'])
+        try:
+            start = time.perf_counter()
+            conn = pool.getconn()
+            POOL_WAIT_SECONDS.observe(time.perf_counter() - start, current_route())
+        except (Exception, psycopg2.DatabaseError) as error:
+            # busy or gone: the primary serves this one, the next check decides
+            logger.error(f'replica {replica.name} - error: {error}')
+            READ_ROUTING.inc(current_route(), 'primary')
+            return None
+
+        READ_ROUTING.inc(current_route(), replica.name)
+        return PooledConnection(pool, conn)
+
+    def stats(self):
+        with self._lock:
+            replicas = [(replica.name, replica.pool, replica.healthy, replica.lag, replica.synced_at) for replica in self.replicas]
+        now = time.monotonic()
+        return {name: dict(pool.stats() if pool is not None else {}, healthy=healthy, lag=lag, synced_ago=None if synced_at is None else round(now - synced_at, 3))
+                for name, pool, healthy, lag, synced_at in replicas}
+
+
+replica_set = ReplicaSet(REPLICA_CONFIG['hosts'], REPLICA_CONFIG['max_lag'], REPLICA_CONFIG['check_interval'])
+
+def pinned_to_primary():
+    # the client wrote within the last pin_seconds (see pin_writes)
+    if not flask.has_request_context():
+        return False
+    try:
+        return float(flask.request.cookies.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+@app.after_request
+def pin_writes(response):
+    if replica_set.replicas and flask.request.method not in ('GET', 'HEAD', 'OPTIONS'):
+        until = time.time() + REPLICA_CONFIG['pin_seconds']
+        response.set_cookie(PIN_COOKIE, f'{until:.3f}', max_age=REPLICA_CONFIG['pin_seconds'], httponly=True)
+    return response
+
+
+@app.errorhandler(PoolTimeout)
+def pool_exhausted(error):
+    logger.error(f'{flask.request.method} {flask.request.path} - error: {error}')
+    response = {'status': StatusCodes['unavailable'], 'errors': str(error)}
+    return flask.jsonify(response), StatusCodes['unavailable']
+
+##
+## Prepared statements
+##
+## The fixed queries of the hot endpoints are registered once with
+## register_statement() and run through execute_statement(). The first time a
+## pooled connection runs one it is sent as PREPARE, and from then on only
+## EXECUTE goes over the wire, so Postgres parses and plans it once per
+## connection instead of once per request. Every connection remembers what it
+## has prepared; one that replaces it (reconnect, eviction, recycled worker)
+## starts empty and prepares again on first use.
+##
+## PREPARED_STATEMENTS=off sends the plain SQL instead, e.g. to measure the
+## difference (see benchmark/prepared.py).
+##
+
+PREPARED_CONFIG = {
+    'enabled': os.environ.get('PREPARED_STATEMENTS', 'on') == 'on'
+}
+
+class PreparingConnection(psycopg2.extensions.connection):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()  # names of the statements prepared on this connection
+
+
+class Statement:
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.param_names = []  # for %(name)s parameters, in $n order
+        self.param_count = 0
+
+        def number(match):
+            if match.group(0) == '%%':
+                return '%'
+            if match.group(1) is None:
+                self.param_count += 1
+                return f'${self.param_count}'
+            if match.group(1) not in self.param_names:
+                self.param_names.append(match.group(1))
+                self.param_count += 1
+            return f'${self.param_names.index(match.group(1)) + 1}'
+
+        # the same statement with Postgres' $n placeholders
+        self.prepare_sql = f'PREPARE {name} AS ' + re.sub(r'%\((\w+)\)s|%s|%%', number, sql)
+
+    def execute(self, cur, params):
+        conn = cur.connection
+        if not PREPARED_CONFIG['enabled'] or not isinstance(conn, PreparingConnection):
+            STATEMENT_EXECUTIONS.inc(self.name, 'false')
+            cur.execute(self.sql, params)
+            return
+
+        if self.name not in conn.prepared:
+            cur.execute(self.prepare_sql)
+            conn.prepared.add(self.name)
+            STATEMENT_PREPARES.inc(self.name)
+
+        if self.param_names:
+            params = [params[name] for name in self.param_names]
+        STATEMENT_EXECUTIONS.inc(self.name, 'true')
+        if params:
+            cur.execute(f'EXECUTE {self.name} ({", ".join(["%s"] * len(params))})', params)
+        else:
+            cur.execute(f'EXECUTE {self.name}')
+
+
+STATEMENTS = {}
+
+def register_statement(name, sql):
+    STATEMENTS[name] = Statement(name, sql)
+
+def execute_statement(cur, name, params=()):
+    STATEMENTS[name].execute(cur, params)
+
+
+##
+## List endpoints return either one keyset page (?after=<id>&limit=<n>) or,
+## without those arguments, the whole list streamed from a server-side
+## cursor a chunk at a time, so memory does not grow with the table.
+##
+
+LIST_DEFAULT_LIMIT = 100
+LIST_MAX_LIMIT = 1000
+STREAM_CHUNK_ROWS = int(os.environ.get('STREAM_CHUNK_ROWS', 1000))
+
+def page_args():
+    # (after, limit) of a keyset page, or None to stream the whole list
+    args = flask.request.args
+    if 'after' not in args and 'limit' not in args:
+        return None
+    after = int(args.get('after', 0))
+    limit = int(args.get('limit', LIST_DEFAULT_LIMIT))
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return after, min(limit, LIST_MAX_LIMIT)
+
+def stream_response(conn, cur, columns, endpoint):
+    # cur is a named cursor that has already been executed, so query errors
+    # are reported normally; conn goes back to the pool when the stream ends,
+    # and so does the request's admission slot (not when the view returns)
+    fmt = response_format(streamed=True)
+    encoding = response_encoding(streamed=True)
+    release = release_on_close()
+
+    def finish():
+        conn.close()
+        release()
+
+    def generate():
+        try:
+            if fmt == 'json':
+                yield '{"status": %d, "results": [' % StatusCodes['success']
+            else:
+                yield '{"status": %d, "columns": %s, "results": [' % (StatusCodes['success'], app.json.dumps(columns))
+            separator = ''
+            while True:
+                rows = cur.fetchmany(STREAM_CHUNK_ROWS)
+                if not rows:
+                    break
+                if fmt == 'json':
+                    yield separator + ','.join(app.json.dumps(dict(zip(columns, row))) for row in rows)
+                else:
+                    yield separator + ','.join(app.json.dumps(row) for row in rows)
+                separator = ','
+            yield ']}'
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error(f'{endpoint} - stream error: {error}')
+            yield '], "errors": %s}' % app.json.dumps(str(error))
+        finally:
+            finish()
+
+    # the request context stays pushed while streaming, so the rows and query
+    # time of the chunks are counted under the view's route
+    body = flask.stream_with_context(generate())
+    response = flask.Response(body if encoding is None else gzip_stream(body), mimetype=FORMAT_MIMETYPES[fmt])
+    response.vary.update(('Accept', 'Accept-Encoding'))
+    if encoding is not None:
+        response.content_encoding = encoding
+    # also covers streams that are never iterated (e.g. the client went away)
+    response.call_on_close(finish)
+    return response
 
+##
+## Response encoding
+##
+## The list endpoints hand their rows to the encoders as Rows (the column
+## names and the row tuples from the cursor) and the format is picked from
+## the Accept header:
+##
+##   application/json (default)     {"results": [{"user_id": 1, ...}, ...]}
+##   application/vnd.columnar+json  {"columns": ["user_id", ...], "results": [[1, ...], ...]}
+##   application/msgpack            the columnar form as MessagePack (pip install msgpack)
+##
+## Only the default form builds a dict per row. Bodies of COMPRESS_MIN_BYTES
+## or more are compressed with br (pip install brotli) or gzip when the client
+## accepts it; streamed lists use gzip and are never MessagePack. Every
+## non-streamed GET gets an ETag, so a client polling with If-None-Match is
+## answered 304 Not Modified while the body has not changed.
+##
+
+RESPONSE_CONFIG = {
+    'compress_min_bytes': int(os.environ.get('COMPRESS_MIN_BYTES', 1024)),
+    'compress_level': int(os.environ.get('COMPRESS_LEVEL', 5))
+}
+
+COLUMNAR_MIMETYPE = 'application/vnd.columnar+json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+RESPONSE_FORMATS = {'application/json': 'json', COLUMNAR_MIMETYPE: 'columnar'}
+if msgpack is not None:
+    RESPONSE_FORMATS.update({MSGPACK_MIMETYPE: 'msgpack', 'application/x-msgpack': 'msgpack'})
+FORMAT_MIMETYPES = {'json': 'application/json', 'columnar': COLUMNAR_MIMETYPE, 'msgpack': MSGPACK_MIMETYPE}
+
+USER_COLUMNS = ('user_id', 'username', 'password', 'email', 'role')
+AUCTION_COLUMNS = ('auction_id', 'title', 'description', 'end_time', 'status')
+
+class Rows:
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+
+
+def response_format(streamed=False):
+    offers = ['application/json', COLUMNAR_MIMETYPE] if streamed else list(RESPONSE_FORMATS)
+    return RESPONSE_FORMATS[flask.request.accept_mimetypes.best_match(offers, default='application/json')]
+
+def response_encoding(streamed=False):
+    # None for an uncompressed response
+    offers = ['gzip'] if streamed or brotli is None else ['br', 'gzip']
+    return flask.request.accept_encodings.best_match(offers)
+
+def encode_body(response, fmt):
+    results = response.get('results')
+    if isinstance(results, Rows):
+        if fmt == 'json':
+            response = dict(response, results=[dict(zip(results.columns, row)) for row in results.rows])
+        else:
+            response = dict(response, columns=results.columns, results=results.rows)
+    if fmt == 'msgpack':
+        return msgpack.packb(response, default=app.json.default)
+    return app.json.dumps(response) + '\n'
+
+def finish_response(body, fmt):
+    # ETag / 304 and compression for an encoded body
+    response = flask.Response(body, mimetype=FORMAT_MIMETYPES[fmt])
+    response.vary.update(('Accept', 'Accept-Encoding'))
+    if flask.request.method == 'GET':
+        response.set_etag(hashlib.sha1(response.get_data()).hexdigest(), weak=True)
+        response.make_conditional(flask.request)
+        if response.status_code == 304:
+            return response
+
+    encoding = response_encoding()
+    if encoding is not None and response.content_length >= RESPONSE_CONFIG['compress_min_bytes']:
+        if encoding == 'br':
+            response.set_data(brotli.compress(response.get_data(), quality=RESPONSE_CONFIG['compress_level']))
+        else:
+            response.set_data(gzip.compress(response.get_data(), compresslevel=RESPONSE_CONFIG['compress_level']))
+        response.content_encoding = encoding
+    return response
+
+def negotiated_response(response):
+    # response dict -> Response in the format the client asked for
+    fmt = response_format()
+    return finish_response(encode_body(response, fmt), fmt)
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(RESPONSE_CONFIG['compress_level'], zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+##########################################################
+## CACHING
+##########################################################
+
+##
+## Read-through cache for the JSON bodies of the read endpoints
+##
+## Entries live in a namespace ('users', 'auctions', 'auction'). A write
+## endpoint either deletes one entry or invalidates a whole namespace by
+## bumping its generation, which is part of every key, so old entries are
+## never read again and simply age out. A response is stored under the
+## generation seen before the database was read, so a write that lands in
+## between cannot leave a stale entry behind.
+##
+## CACHE_BACKEND=local keeps an LRU per process, and the processes send each
+## other their invalidations (see CacheBroadcaster). CACHE_BACKEND=redis
+## shares entries and generations between processes through CACHE_URL (any
+## Redis compatible server, e.g. a local redis container).
+##
+
+CACHE_CONFIG = {
+    'backend': os.environ.get('CACHE_BACKEND', 'local'),  # local, redis or off
+    'url': os.environ.get('CACHE_URL', 'redis://localhost:6379/0'),
+    'ttl': float(os.environ.get('CACHE_TTL', 30)),
+    'max_entries': int(os.environ.get('CACHE_MAX_ENTRIES', 10000))
+}
+
+class LocalCache:
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (namespace, generation, key) -> (expires_at, value)
+        self._generations = {}
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def lookup(self, namespace, key):
+        # (generation, value or None)
+        with self._lock:
+            generation = self._generations.get(namespace, 0)
+            entry_key = (namespace, generation, key)
+            entry = self._entries.get(entry_key)
+
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[entry_key]
+                self._counters['expirations'] += 1
+                entry = None
+
+            if entry is None:
+                self._counters['misses'] += 1
+                return generation, None
+
+            self._entries.move_to_end(entry_key)
+            self._counters['hits'] += 1
+            return generation, entry[1]
+
+    def store(self, namespace, generation, key, value):
+        with self._lock:
+            if generation != self._generations.get(namespace, 0):
+                return
+            entry_key = (namespace, generation, key)
+            self._entries[entry_key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(entry_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._entries.pop((namespace, self._generations.get(namespace, 0), key), None)
+            self._counters['invalidations'] += 1
+
+    def invalidate(self, namespace):
+        with self._lock:
+            self._generations[namespace] = self._generations.get(namespace, 0) + 1
+            self._counters['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update({'backend': 'local', 'entries': len(self._entries), 'max_entries': self.max_entries})
+        return stats
+
+
+class RedisCache:
+
+    def __init__(self, url, ttl):
+        if redis is None:
+            raise RuntimeError('CACHE_BACKEND=redis requires the redis package (pip install redis)')
+        self.ttl = ttl
+        self._client = redis.Redis.from_url(url)
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def lookup(self, namespace, key):
+        generation = int(self._client.get(f'cache:{namespace}:generation') or 0)
+        value = self._client.get(f'cache:{namespace}:{generation}:{key}')
+        self._count('misses' if value is None else 'hits')
+        return generation, value
+
+    def store(self, namespace, generation, key, value):
+        if generation == int(self._client.get(f'cache:{namespace}:generation') or 0):
+            self._client.set(f'cache:{namespace}:{generation}:{key}', value, px=int(self.ttl * 1000))
+
+    def delete(self, namespace, key):
+        generation = int(self._client.get(f'cache:{namespace}:generation') or 0)
+        self._client.delete(f'cache:{namespace}:{generation}:{key}')
+        self._count('invalidations')
+
+    def invalidate(self, namespace):
+        self._client.incr(f'cache:{namespace}:generation')
+        self._count('invalidations')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        info = self._client.info('stats')
+        stats.update({'backend': 'redis', 'entries': self._client.dbsize(), 'evictions': info.get('evicted_keys'), 'expirations': info.get('expired_keys')})
+        return stats
+
+
+def create_cache():
+    if CACHE_CONFIG['backend'] == 'redis':
+        return RedisCache(CACHE_CONFIG['url'], CACHE_CONFIG['ttl'])
+    if CACHE_CONFIG['backend'] == 'local':
+        return LocalCache(CACHE_CONFIG['max_entries'], CACHE_CONFIG['ttl'])
+    return None
+
+response_cache = create_cache()
+
+def args_key():
+    # normalized query string, so ?a=1&b=2 and ?b=2&a=1 share an entry
+    return '&'.join(f'{name}={value}' for name, value in sorted(flask.request.args.items(multi=True)))
+
+def cache_lookup(namespace, key):
+    # cached response, or None; remembers the generation for cache_store()
+    flask.g.cache_generation = None
+    flask.g.cache_entry = (namespace, key)
+    if response_cache is None or pinned_to_primary():
+        return None
+    fmt = response_format()
+    try:
+        generation, body = response_cache.lookup(namespace, f'{key}|{fmt}')
+    except Exception as error:
+        logger.error(f'cache lookup - error: {error}')
+        return None
+    flask.g.cache_generation = generation
+    if body is None:
+        return None
+    return finish_response(body, fmt)
+
+def cache_store(namespace, key, response):
+    # encode the response dict (see Response encoding), caching it if it is a success
+    fmt = response_format()
+    body = encode_body(response, fmt)
+    if response_cache is not None and flask.g.get('cache_generation') is not None and response['status'] == StatusCodes['success']:
+        try:
+            response_cache.store(namespace, flask.g.cache_generation, f'{key}|{fmt}', body)
+        except Exception as error:
+            logger.error(f'cache store - error: {error}')
+    return finish_response(body, fmt)
+
+def cache_invalidate(namespace, key=None):
+    if response_cache is None:
+        return
+    cache_broadcaster.publish(namespace, key)
+    replica_set.invalidated(namespace, key)
+    invalidate_local(namespace, key)
+
+def invalidate_local(namespace, key=None):
+    # this process's cache only, see cache_invalidate
+    try:
+        if key is None:
+            response_cache.invalidate(namespace)
+        else:
+            # every format of the entry
+            for fmt in set(RESPONSE_FORMATS.values()):
+                response_cache.delete(namespace, f'{key}|{fmt}')
+    except Exception as error:
+        logger.error(f'cache invalidate - error: {error}')
+
+
+##
+## Invalidations across processes
+##
+## With CACHE_BACKEND=local each process has its own entries and generations,
+## and the production server runs one process per CPU, so a write would only
+## clear the cache of the worker that served it. Each process runs a
+## CacheBroadcaster thread that LISTENs on CACHE_CHANNEL over its own
+## connection: cache_invalidate() applies an invalidation locally and queues
+## it, the thread sends what is queued as one NOTIFY round trip, and the
+## other processes apply it to their caches as it arrives. The writes never
+## wait for it. A process that loses the connection may have missed some, so
+## it invalidates every namespace once it is listening again. With
+## CACHE_BACKEND=redis and read replicas it runs too, so that every process
+## knows what was invalidated when it picks a replica for a cache miss.
+##
+
+CACHE_BROADCAST_CONFIG = {
+    'enabled': os.environ.get('CACHE_BROADCAST', 'on') == 'on',
+    'keepalive': float(os.environ.get('CACHE_BROADCAST_KEEPALIVE', 15)),
+    'retry_interval': float(os.environ.get('CACHE_BROADCAST_RETRY_INTERVAL', 5))
+}
+
+CACHE_CHANNEL = 'cache_invalidations'
+CACHE_NAMESPACES = ('users', 'auctions', 'auction')
+
+class CacheBroadcaster:
+
+    # invalidations per NOTIFY, well under the 8000 byte payload limit
+    batch_size = 100
+
+    def __init__(self, keepalive, retry_interval):
+        self.keepalive = keepalive
+        self.retry_interval = retry_interval
+        self.pid = None
+
+        self._lock = threading.Lock()
+        self._pending = []  # (namespace, key) not sent yet
+        self._wakeup = None  # pipe, written to when _pending stops being empty
+        self._counters = {'sent': 0, 'received': 0, 'reconnects': 0, 'errors': 0}
+
+    def start(self):
+        self.pid = os.getpid()
+        self._pending = []
+        self._wakeup = os.pipe()
+        os.set_blocking(self._wakeup[1], False)
+        thread = threading.Thread(target=self._run, name='cache-broadcaster', daemon=True)
+        thread.start()
+
+    def publish(self, namespace, key):
+        if self.pid != os.getpid():
+            return
+        with self._lock:
+            wake = not self._pending
+            self._pending.append((namespace, key))
+        if wake:
+            try:
+                os.write(self._wakeup[1], b'.')
+            except BlockingIOError:
+                pass  # already awake
+
+    def _send(self, cur):
+        with self._lock:
+            pending, self._pending = list(dict.fromkeys(self._pending)), []
+        if not pending:
+            return
+        payloads = [json.dumps(pending[start:start + self.batch_size]) for start in range(0, len(pending), self.batch_size)]
+        try:
+            cur.execute('SELECT count(pg_notify(%s, payload)) FROM unnest(%s::text[]) payload', (CACHE_CHANNEL, payloads))
+        except (Exception, psycopg2.DatabaseError):
+            # sent again once the connection is back
+            with self._lock:
+                self._pending[:0] = pending
+            raise
+        with self._lock:
+            self._counters['sent'] += len(pending)
+
+    def _received(self, namespace, key):
+        # a shared cache is already invalidated, the replica routing still has to know
+        replica_set.invalidated(namespace, key)
+        if isinstance(response_cache, LocalCache):
+            invalidate_local(namespace, key)
+
+    def _listen(self):
+        conn = psycopg2.connect(**DB_CONFIG)
+        try:
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute(f'LISTEN {CACHE_CHANNEL}')
+            backend_pid = conn.get_backend_pid()
+            # anything invalidated while we were not listening
+            for namespace in CACHE_NAMESPACES:
+                self._received(namespace, None)
+
+            while True:
+                self._send(cur)
+                readable, _, _ = select.select([conn, self._wakeup[0]], [], [], self.keepalive)
+                if not readable:
+                    # nothing for a while, make sure the connection is still there
+                    cur.execute('SELECT 1')
+                if self._wakeup[0] in readable:
+                    os.read(self._wakeup[0], 4096)
+                if conn in readable:
+                    conn.poll()
+
+                received = 0
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    if notify.channel != CACHE_CHANNEL or notify.pid == backend_pid:
+                        continue  # our own, already applied when queued
+                    for namespace, key in json.loads(notify.payload):
+                        self._received(namespace, key)
+                        received += 1
+                with self._lock:
+                    self._counters['received'] += received
+        finally:
+            conn.close()
+
+    def _run(self):
+        while True:
+            try:
+                self._listen()
+            except (Exception, psycopg2.DatabaseError) as error:
+                logger.error(f'cache broadcaster - error: {error}')
+                with self._lock:
+                    self._counters['errors'] += 1
+                time.sleep(self.retry_interval)
+                with self._lock:
+                    self._counters['reconnects'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['pending'] = len(self._pending)
+        return stats
+
+
+cache_broadcaster = CacheBroadcaster(CACHE_BROADCAST_CONFIG['keepalive'], CACHE_BROADCAST_CONFIG['retry_interval'])
+
+
+##
+## Single-flight request coalescing
+##
+## Concurrent identical GETs (same route, path arguments and normalized query
+## string) on a coalesced route share one execution: the first request runs
+## the view, the others wait for it and get a copy of its response body.
+## Streamed responses cannot be shared, so waiting requests run the view
+## themselves in that case. COALESCE_ROUTES lists the view functions that
+## are coalesced.
+##
+## Only the request that runs the view goes through admission control; the
+## ones waiting for it hold no connection and take no slot, so a burst of
+## identical polls is one admitted request rather than a full queue. If the
+## first one is shed, the ones waiting for it get the same 503.
+##
+
+COALESCE_ROUTES = set(filter(None, os.environ.get('COALESCE_ROUTES', 'get_user,get_open_auctions,search_auction').split(',')))
+
+coalesced_views = set()  # names of the views wrapped by coalesce_requests
+
+class SingleFlight:
+
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._counters = {}  # route -> {'executed': n, 'coalesced': n}
+
+    def do(self, route, key, fn):
+        with self._lock:
+            counters = self._counters.setdefault(route, {'executed': 0, 'coalesced': 0})
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = SingleFlight.Call()
+                counters['executed'] += 1
+            else:
+                counters['coalesced'] += 1
+
+        if leader:
+            try:
+                call.result = fn()
+            except Exception as error:
+                call.error = error
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+        return leader, call.result
 
+    def stats(self):
+        with self._lock:
+            return {route: dict(counters) for route, counters in self._counters.items()}
 
 
+single_flight = SingleFlight()
+
+def coalesced(endpoint):
+    # this request shares the execution of identical concurrent ones
+    return endpoint in coalesced_views and endpoint in COALESCE_ROUTES and flask.request.method == 'GET'
+
+def coalesce_requests(view):
+    coalesced_views.add(view.__name__)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not coalesced(view.__name__):
+            return view(*args, **kwargs)
+
+        # requests that negotiate a different response must not share one
+        key = f'{view.__name__}:{sorted(kwargs.items())}?{args_key()}|{response_format()}|{response_encoding()}|{flask.request.headers.get("If-None-Match", "")}|{pinned_to_primary()}'
+
+        def execute():
+            response = admit(view.__name__) or flask.make_response(view(*args, **kwargs))
+            if response.is_streamed:
+                return response, None
+            return response, (response.get_data(), response.status_code, list(response.headers))
+
+        leader, (response, shared) = single_flight.do(view.__name__, key, execute)
+        if leader:
+            return response
+        if shared is None:
+            # runs the view on its own, like any other request
+            return admit(view.__name__) or view(*args, **kwargs)
+        return flask.Response(shared[0], status=shared[1], headers=shared[2])
+
+    return wrapper
+
+
+##
+## Admission control
+##
+## Every endpoint (by view function name) may run at most its limit of
+## requests at once in each process; the limits in ADMISSION_LIMITS override
+## default_limit, and 0 means unlimited. A cheap or lower priority endpoint
+## with a small limit can never hold more than that many database
+## connections, which keeps the rest of the pool for the others (by default
+## search_auction and the full listings get 4 and place_bid 16 of the 20).
+##
+## Requests over the limit wait in the endpoint's queue, in arrival order,
+## for up to queue_timeout seconds. Requests that find max_queue already
+## waiting, or whose wait runs out, are answered 503 with Retry-After straight
+## away instead of reaching the database late. ADMISSION_EXEMPT endpoints
+## hold no connection for long and are never limited. Streamed responses keep
+## their slot until the stream ends (see release_on_close). On coalesced
+## routes only the request that runs the view is admitted (see Single-flight
+## request coalescing).
+##
+
+ADMISSION_CONFIG = {
+    'enabled': os.environ.get('ADMISSION_CONTROL', 'on') == 'on',
+    'default_limit': int(os.environ.get('ADMISSION_DEFAULT_LIMIT', 8)),
+    'max_queue': int(os.environ.get('ADMISSION_MAX_QUEUE', 16)),
+    'queue_timeout': float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 2)),
+    'retry_after': int(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+}
+
+ADMISSION_LIMITS = {
+    endpoint: int(limit) for endpoint, _, limit in (
+        entry.partition(':') for entry in os.environ.get(
+            'ADMISSION_LIMITS',
+            'place_bid:16,place_bids_batch:4,search_auction:4,get_all_users:4,get_open_auctions:8,import_users:1,import_auctions:1'
+        ).split(',') if entry
+    )
+}
+
+ADMISSION_EXEMPT = {'static', 'landing_page', 'readiness', 'get_metrics', 'get_pool_stats', 'get_cache_stats',
+                    'get_event_stats', 'get_maintenance_stats', 'get_coalescing_stats', 'get_admission_stats'}
+
+class AdmissionController:
+
+    class Lane:
+        def __init__(self, limit, lock):
+            self.limit = limit
+            self.active = 0
+            self.waiting = 0
+            self.cond = threading.Condition(lock)
+            self.counters = {'admitted': 0, 'queued': 0, 'shed_queue_full': 0, 'shed_deadline': 0}
+
+    def __init__(self, limits, default_limit, max_queue, queue_timeout):
+        self.limits = limits
+        self.default_limit = default_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._lanes = {}
+
+    def _lane(self, endpoint):
+        # called with the lock held; None for an unlimited endpoint
+        lane = self._lanes.get(endpoint)
+        if lane is None:
+            limit = self.limits.get(endpoint, self.default_limit)
+            if limit <= 0:
+                return None
+            lane = self._lanes[endpoint] = AdmissionController.Lane(limit, self._lock)
+        return lane
+
+    def acquire(self, endpoint):
+        # None when admitted, otherwise why the request was shed
+        with self._lock:
+            lane = self._lane(endpoint)
+            if lane is None:
+                return None
+            if lane.active < lane.limit and lane.waiting == 0:
+                lane.active += 1
+                lane.counters['admitted'] += 1
+                return None
+            if lane.waiting >= self.max_queue:
+                lane.counters['shed_queue_full'] += 1
+                return 'queue_full'
+
+            start = time.monotonic()
+            deadline = start + self.queue_timeout
+            lane.waiting += 1
+            lane.counters['queued'] += 1
+            try:
+                while lane.active >= lane.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        lane.counters['shed_deadline'] += 1
+                        return 'deadline'
+                    lane.cond.wait(remaining)
+                lane.active += 1
+                lane.counters['admitted'] += 1
+            finally:
+                lane.waiting -= 1
+                # a slot that came free while this one gave up goes to the next in line
+                if lane.waiting and lane.active < lane.limit:
+                    lane.cond.notify()
+
+        ADMISSION_QUEUE_SECONDS.observe(time.monotonic() - start, endpoint)
+        return None
+
+    def release(self, endpoint):
+        with self._lock:
+            lane = self._lanes[endpoint]
+            lane.active -= 1
+            lane.cond.notify()
+
+    def stats(self):
+        with self._lock:
+            return {endpoint: dict(lane.counters, limit=lane.limit, active=lane.active, waiting=lane.waiting)
+                    for endpoint, lane in self._lanes.items()}
+
+
+admission_controller = AdmissionController(ADMISSION_LIMITS, ADMISSION_CONFIG['default_limit'], ADMISSION_CONFIG['max_queue'], ADMISSION_CONFIG['queue_timeout'])
+
+@app.before_request
+def admit_request():
+    endpoint = flask.request.endpoint
+    if coalesced(endpoint):
+        return None  # coalesce_requests admits only the request that runs the view
+    return admit(endpoint)
+
+def admit(endpoint):
+    # None when admitted (the slot is given back at teardown), otherwise the 503 to answer
+    if not ADMISSION_CONFIG['enabled'] or endpoint is None or endpoint in ADMISSION_EXEMPT:
+        return None
+
+    reason = admission_controller.acquire(endpoint)
+    if reason is None:
+        flask.g.admitted_endpoint = endpoint
+        return None
+
+    ADMISSION_SHED.inc(endpoint, reason)
+    logger.warning(f'{flask.request.method} {flask.request.path} - shed ({reason})')
+    response = flask.jsonify({'status': StatusCodes['unavailable'], 'errors': f'Too many concurrent requests for {endpoint}, retry later'})
+    response.status_code = StatusCodes['unavailable']
+    response.headers['Retry-After'] = str(ADMISSION_CONFIG['retry_after'])
+    return response
+
+def release_on_close():
+    # for a streamed response: takes the request's slot from teardown_request
+    # and returns a function that gives it back once, when the stream ends
+    endpoint = flask.g.pop('admitted_endpoint', None)
+
+    def release():
+        nonlocal endpoint
+        if endpoint is not None:
+            admitted, endpoint = endpoint, None
+            admission_controller.release(admitted)
+
+    return release
+
+@app.teardown_request
+def release_request(error):
+    endpoint = flask.g.pop('admitted_endpoint', None)
+    if endpoint is not None:
+        admission_controller.release(endpoint)
 
 
 ##########################################################
@@ -63,35 +1654,43 @@ def landing_page():
 ## http://localhost:8080/users/
 ##
 
+register_statement('get_all_users', queries.USERS_PAGE_QUERY)
+
 @app.route('/users/', methods=['GET'])
 def get_all_users():
     logger.info('GET /users')
 
-    conn = db_connection()
-    cur = conn.cursor()
+    try:
+        page = page_args()
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': f'Invalid after or limit: {error}'}
+        return flask.jsonify(response)
+
+    conn = db_connection(read_only=True)
 
     try:
-        cur.execute('SELECT * FROM users') #changed
+        if page is None:
+            cur = conn.cursor(name='get_all_users')
+            cur.execute(queries.USERS_QUERY)
+            return stream_response(conn, cur, USER_COLUMNS, 'GET /users')
+
+        cur = conn.cursor()
+        execute_statement(cur, 'get_all_users', (page[0], page[1]))
         rows = cur.fetchall()
 
         logger.debug('GET /users - parse')
-        Results = []
-        for row in rows:
-            logger.debug(row)
-            content = {'user_id': row[0], 'username': row[1], 'password': row[2], 'email': row[3], 'role': row[4]} #changed
-            Results.append(content)  # appending to the payload to be returned
+        if row_logger.isEnabledFor(logging.DEBUG):
+            for row in rows:
+                row_logger.debug(row)
 
-        response = {'status': StatusCodes['success'], 'results': Results}
+        response = {'status': StatusCodes['success'], 'results': Rows(USER_COLUMNS, rows), 'next_after': rows[-1][0] if len(rows) == page[1] else None}
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'GET /users - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
 
-    finally:
-        if conn is not None:
-            conn.close()
-
-    return flask.jsonify(response)
+    conn.close()
+    return negotiated_response(response)
 
 
 ##
@@ -104,17 +1703,24 @@ def get_all_users():
 ## http://localhost:8080/users/ssmith
 ##
 
+register_statement('get_user', queries.USER_QUERY)
+
 @app.route('/users/<username>/', methods=['GET'])
+@coalesce_requests
 def get_user(username):
     logger.info('GET /users/<username>')
 
-    logger.debug('username: {username}')
+    logger.debug(f'username: {username}')
 
-    conn = db_connection()
+    cached = cache_lookup('users', username)
+    if cached is not None:
+        return cached
+
+    conn = db_connection(read_only=True)
     cur = conn.cursor()
 
     try:
-        cur.execute('SELECT * FROM users where username = %s', (username,)) #change from (SELECT username, name, city FROM users)
+        execute_statement(cur, 'get_user', (username,))
         rows = cur.fetchall()
 
         row = rows[0]
@@ -133,7 +1739,7 @@ def get_user(username):
         if conn is not None:
             conn.close()
 
-    return flask.jsonify(response)
+    return cache_store('users', username, response)
 
 
 ##
@@ -145,15 +1751,17 @@ def get_user(username):
 ##
 ## curl -X POST http://localhost:8080/users/ -H 'Content-Type: application/json' -d '{"city": "London", "username": "ppopov", "name": "Peter Popov"}'
 ##
+## The user and its sellers/buyers row are inserted by one statement, so the
+## request is a single round trip that commits on its own.
+##
+
+register_statement('add_user', queries.ADD_USER_STATEMENT)
 
 @app.route('/users/', methods=['POST'])
 def add_users():
     logger.info('POST /users')
     payload = flask.request.get_json()
 
-    conn = db_connection()
-    cur = conn.cursor()
-
     logger.debug(f'POST /users - payload: {payload}')
 
     # Validate payload fields
@@ -161,30 +1769,26 @@ def add_users():
         response = {'status': StatusCodes['api_error'], 'results': 'Required fields missing'}
         return flask.jsonify(response)
 
-    # Insert user into the users table
-    statement = 'INSERT INTO users (username, password, email, role) VALUES (%s, %s, %s, %s) RETURNING user_id'
-    values = (payload['username'], payload.get('password', ''), payload.get('email', ''), payload['role'])
-
-    try:
-        cur.execute(statement, values)
-        user_id = cur.fetchone()[0]  # Get the ID of the newly inserted user
-
-        # If the user is a seller, insert them into the sellers table
-        if payload['role'] == 'Seller':
-            cur.execute('INSERT INTO sellers (users_user_id, seller_name) VALUES (%s, %s)', (user_id, payload['username']))
+    values = {
+        'username': payload['username'],
+        'password': payload.get('password', ''),
+        'email': payload.get('email', ''),
+        'role': payload['role']
+    }
 
-        # If the user is a buyer, insert them into the buyers table
-        elif payload['role'] == 'Buyer':
-            cur.execute('INSERT INTO buyers (users_user_id, buyer_name) VALUES (%s, %s)', (user_id, payload['username']))
+    conn = db_connection()
 
-        # Commit the transaction
-        conn.commit()
+    try:
+        # the statement is its own transaction, no separate commit round trip
+        conn.autocommit = True
+        cur = conn.cursor()
+        execute_statement(cur, 'add_user', values)
+        cache_invalidate('users', payload['username'])
         response = {'status': StatusCodes['success'], 'results': f'Inserted user {payload["username"]} with role {payload["role"]}'}
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'POST /users - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
-        conn.rollback()
 
     finally:
         if conn is not None:
@@ -209,9 +1813,6 @@ def update_users(username):
     logger.info('PUT /users/<username>')
     payload = flask.request.get_json()
 
-    conn = db_connection()
-    cur = conn.cursor()
-
     logger.debug(f'PUT /users/<username> - payload: {payload}')
 
     # do not forget to validate every argument, e.g.,:
@@ -219,8 +1820,11 @@ def update_users(username):
         response = {'status': StatusCodes['api_error'], 'results': 'city is required to update'}
         return flask.jsonify(response)
 
+    conn = db_connection()
+    cur = conn.cursor()
+
     # parameterized queries, good for security and performance
-    statement = 'UPDATE users SET city = %s WHERE username = %s'
+    statement = queries.UPDATE_CITY_STATEMENT
     values = (payload['city'], username)
 
     try:
@@ -229,6 +1833,7 @@ def update_users(username):
 
         # commit the transaction
         conn.commit()
+        cache_invalidate('users', username)
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(error)
@@ -248,16 +1853,14 @@ def create_auction():
     logger.info('POST /auctions/')
     payload = flask.request.get_json()
 
-    conn = db_connection()
-    cur = conn.cursor()
-
     logger.debug(f'POST /auctions/ - payload: {payload}')
 
     # validate required fields in the payload
     if 'title' not in payload:
         response = {'status': StatusCodes['api_error'], 'results': 'title is required'}
+        return flask.jsonify(response)
     if 'description' not in payload:
-        response = {'description': StatusCodes['api_error'], 'results': 'description is required'}
+        response = {'status': StatusCodes['api_error'], 'results': 'description is required'}
         return flask.jsonify(response)
     if 'end_time' not in payload:
         response = {'status': StatusCodes['api_error'], 'results': 'end_time is required'}
@@ -265,17 +1868,24 @@ def create_auction():
     if 'status' not in payload:
         response = {'status': StatusCodes['api_error'], 'results': 'status is required'}
         return flask.jsonify(response)
-    
+
+    conn = db_connection()
+    cur = conn.cursor()
+
     # prepare sql statement and values
-    statement = 'INSERT INTO auctions (title, description, end_time, status) VALUES (%s, %s, %s, %s) RETURNING auction_id'
+    statement = queries.CREATE_AUCTION_STATEMENT
     values = (payload['title'], payload['description'], payload['end_time'], payload['status'])
 
     try:
         # execute the statement and fetch newly created auction_id
         cur.execute(statement, values)
-        auction_id = cur.fetchone()[0]
+        auction_id, end_time = cur.fetchone()
         # commit transaction
         conn.commit()
+        cache_invalidate('auctions')
+        # let the expiry scheduler know when to close it
+        if payload['status'] == 'open':
+            expiry_scheduler.add(auction_id, end_time)
         #return success response with the newly created auction ID
         response = {'status': StatusCodes['success'], 'results': {'auction_id': auction_id}}
     except(Exception, psycopg2.DatabaseError) as error:
@@ -289,35 +1899,43 @@ def create_auction():
             conn.close()
     return flask.jsonify(response)
 
+register_statement('get_open_auctions', queries.OPEN_AUCTIONS_PAGE_QUERY)
+
 @app.route('/auctions/list', methods = ['GET'])
+@coalesce_requests
 def get_open_auctions():
     logger.info('GET /auctions/open/')
 
+    try:
+        page = page_args()
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': f'Invalid after or limit: {error}'}
+        return flask.jsonify(response)
+
+    if page is not None:
+        cached = cache_lookup('auctions', 'list?' + args_key())
+        if cached is not None:
+            return cached
+
     # connect to the database
-    conn = db_connection()
-    cur = conn.cursor()
+    conn = db_connection(read_only=True)
 
     try:
         # query databsae to display all open auctions
-        cur.execute('SELECT * FROM auctions WHERE status = %s', ('open',))
+        if page is None:
+            cur = conn.cursor(name='get_open_auctions')
+            cur.execute(queries.OPEN_AUCTIONS_QUERY)
+            return stream_response(conn, cur, AUCTION_COLUMNS, 'GET /auctions/list')
+
+        cur = conn.cursor()
+        execute_statement(cur, 'get_open_auctions', (page[0], page[1]))
         rows = cur.fetchall()
 
-        # parse the rows and create list of open auctions
-        open_auctions = []
-        for row in rows:
-            auction = {
-                'auction_id': row[0],
-                'title': row[1],
-                'description': row[2],
-                'end_time': row[3],
-                'status': row[4]
-            }
-            open_auctions.append(auction)
-        
         #create the response dictionary
         response = {
             'status': StatusCodes['success'],
-            'results': open_auctions
+            'results': Rows(AUCTION_COLUMNS, rows),
+            'next_after': rows[-1][0] if len(rows) == page[1] else None
         }
     except(Exception, psycopg2.DatabaseError) as error:
         logger.error(f'GET /auctionsopen/ - error: {error}')
@@ -325,12 +1943,35 @@ def get_open_auctions():
             'status': StatusCodes['internal_error'],
             'errors': str(error)
         }
-    finally:
-        if conn is not None:
-            conn.close()
-    return flask.jsonify(response)
+
+    conn.close()
+    return cache_store('auctions', 'list?' + args_key(), response)
+
+##
+## Search auctions
+##
+## http://localhost:8080/auctions/search/?q=red lamp            full text, ranked
+## http://localhost:8080/auctions/search/?q=lam&prefix=true      typeahead, last word matched as a prefix
+## http://localhost:8080/auctions/search/?title=lamp             substring match (trigram index)
+## http://localhost:8080/auctions/search/?q=lamp&limit=20&cursor=<next_cursor of the previous page>
+##
+## Full text queries use the search_vector column and its GIN index, the
+## title/description substring filters use the pg_trgm indexes, so neither
+## scans the auctions table. Pages are fetched with a keyset cursor on
+## (rank, auction_id) instead of OFFSET.
+##
+
+SEARCH_DEFAULT_LIMIT = 50
+SEARCH_MAX_LIMIT = 500
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
 
 @app.route('/auctions/search/', methods=['GET'])
+@coalesce_requests
 def search_auction():
     logger.info('GET /auctions/search/')
 
@@ -338,59 +1979,50 @@ def search_auction():
     auction_id = flask.request.args.get('auction_id')
     title = flask.request.args.get('title')
     description = flask.request.args.get('description')
+    text = flask.request.args.get('q')
+    prefix = flask.request.args.get('prefix', 'false').lower() in ('1', 'true', 'yes')
+    cursor = flask.request.args.get('cursor')
 
     # Validate that at least one search parameter is provided
-    if not auction_id and not title and not description:
+    if not auction_id and not title and not description and not text:
         response = {
             'status': StatusCodes['api_error'],
-            'results': 'At least one search parameter (auction_id, title, or description) must be provided'
+            'results': 'At least one search parameter (q, auction_id, title, or description) must be provided'
         }
         return flask.jsonify(response)
 
+    try:
+        limit = min(int(flask.request.args.get('limit', SEARCH_DEFAULT_LIMIT)), SEARCH_MAX_LIMIT)
+        after = decode_cursor(cursor) if cursor else None
+        if limit < 1:
+            raise ValueError('limit must be positive')
+    except (ValueError, TypeError) as error:
+        response = {'status': StatusCodes['api_error'], 'results': f'Invalid limit or cursor: {error}'}
+        return flask.jsonify(response)
+
+    sql_query, values = queries.search_query(text, prefix, auction_id, title, description, after, limit)
+
+    cached = cache_lookup('auctions', 'search?' + args_key())
+    if cached is not None:
+        return cached
+
     # Connect to the database
-    conn = db_connection()
+    conn = db_connection(read_only=True)
     cur = conn.cursor()
 
     try:
-        # Prepare the base SQL query and values list
-        sql_query = 'SELECT * FROM auctions WHERE'
-        conditions = []
-        values = []
-
-        # Add conditions and values based on the provided query parameters
-        if auction_id:
-            conditions.append(' auction_id = %s')
-            values.append(auction_id)
-        if title:
-            conditions.append(' title ILIKE %s')  # Case-insensitive search using ILIKE
-            values.append(f'%{title}%')
-        if description:
-            conditions.append(' description ILIKE %s')  # Case-insensitive search using ILIKE
-            values.append(f'%{description}%')
-
-        # Join conditions with AND clause to form the final SQL query
-        sql_query += ' AND '.join(conditions)
-
         # Execute the query with the specified values
         cur.execute(sql_query, values)
         rows = cur.fetchall()
 
-        # Parse the rows and create a list of auction dictionaries
-        auctions = []
-        for row in rows:
-            auction = {
-                'auction_id': row[0],
-                'title': row[1],
-                'description': row[2],
-                'end_time': row[3],
-                'status': row[4]
-            }
-            auctions.append(auction)
+        # the rank is only part of the results for full text searches
+        columns = AUCTION_COLUMNS + ('rank',) if text else AUCTION_COLUMNS
 
         # Create the response dictionary
         response = {
             'status': StatusCodes['success'],
-            'results': auctions
+            'results': Rows(columns, [row[:len(columns)] for row in rows[:limit]]),
+            'next_cursor': encode_cursor([rows[limit - 1][5], rows[limit - 1][0]]) if len(rows) > limit else None
         }
 
     except (Exception, psycopg2.DatabaseError) as error:
@@ -406,17 +2038,147 @@ def search_auction():
             conn.close()
 
     # Return the JSON response
-    return flask.jsonify(response)
+    return cache_store('auctions', 'search?' + args_key(), response)
+
+########## Auction Summary ##########
+##
+## curl http://localhost:8080/auctions/1/summary
+## curl http://localhost:8080/auctions/top?limit=10
+##
+## Both read what the bid endpoints maintain on every accepted bid: the high
+## bid and leader on auctions, the bid count and last bid time in
+## auction_summary. A summary is a primary key lookup (cached until the
+## auction changes); the top open auctions by bid count are read from the
+## auction_summary_activity_idx index.
+##
+
+TOP_DEFAULT_LIMIT = 10
+TOP_MAX_LIMIT = 100
+
+register_statement('get_auction_summary', queries.AUCTION_SUMMARY_QUERY)
+
+SUMMARY_COLUMNS = ('auction_id', 'title', 'status', 'end_time', 'current_bid', 'leader_user_id', 'bid_count', 'last_bid_time')
+
+def summary_to_dict(row):
+    return dict(zip(SUMMARY_COLUMNS, row))
+
+@app.route('/auctions/<int:auction_id>/summary', methods=['GET'])
+def get_auction_summary(auction_id):
+    logger.info(f'GET /auctions/{auction_id}/summary')
+
+    cached = cache_lookup('auction', auction_id)
+    if cached is not None:
+        return cached
+
+    conn = db_connection(read_only=True)
+    cur = conn.cursor()
+
+    try:
+        execute_statement(cur, 'get_auction_summary', (auction_id,))
+        row = cur.fetchone()
+
+        if row is None:
+            response = {'status': StatusCodes['api_error'], 'results': f'Auction {auction_id} does not exist'}
+        else:
+            response = {'status': StatusCodes['success'], 'results': summary_to_dict(row)}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /auctions/{auction_id}/summary - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+    return cache_store('auction', auction_id, response)
+
+@app.route('/auctions/top', methods=['GET'])
+@coalesce_requests
+def get_top_auctions():
+    logger.info('GET /auctions/top')
+
+    try:
+        limit = min(int(flask.request.args.get('limit', TOP_DEFAULT_LIMIT)), TOP_MAX_LIMIT)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': f'Invalid limit: {error}'}
+        return flask.jsonify(response)
+
+    conn = db_connection(read_only=True)
+    cur = conn.cursor()
+
+    try:
+        cur.execute(queries.TOP_AUCTIONS_QUERY, (limit,))
+        response = {'status': StatusCodes['success'], 'results': Rows(SUMMARY_COLUMNS, cur.fetchall())}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /auctions/top - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+    return negotiated_response(response)
+
+
+########## Bid History ##########
+##
+## curl http://localhost:8080/auctions/1/bids
+## curl "http://localhost:8080/auctions/1/bids?after=120&limit=100"
+##
+## The bids of an auction in the order they were placed, a keyset page at a
+## time (next_after is the bid_id to continue from). Bids of closed and
+## cancelled auctions are read from the archive partition, or from the packed
+## arrays once the maintenance job has packed them (see Bid Archive).
+##
+
+BID_COLUMNS = ('bid_id', 'bid_amount', 'bid_time', 'buyer_user_id', 'item_id')
+
+@app.route('/auctions/<int:auction_id>/bids', methods=['GET'])
+def get_auction_bids(auction_id):
+    logger.info(f'GET /auctions/{auction_id}/bids')
+
+    try:
+        after, limit = page_args() or (0, LIST_DEFAULT_LIMIT)
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'], 'results': f'Invalid after or limit: {error}'}
+        return flask.jsonify(response)
+
+    conn = db_connection(read_only=True)
+    cur = conn.cursor()
+
+    try:
+        cur.execute(queries.AUCTION_BIDS_QUERY, {'auction_id': auction_id, 'after': after, 'limit': limit})
+        rows = cur.fetchall()
+
+        if not rows and not after:
+            cur.execute(queries.AUCTION_EXISTS_QUERY, (auction_id,))
+            if cur.fetchone() is None:
+                response = {'status': StatusCodes['api_error'], 'results': f'Auction {auction_id} does not exist'}
+                return flask.jsonify(response)
+
+        response = {'status': StatusCodes['success'], 'results': Rows(BID_COLUMNS, rows), 'next_after': rows[-1][0] if len(rows) == limit else None}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /auctions/{auction_id}/bids - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+    return negotiated_response(response)
 
 # ADD ITEM TO AUCTION 
+register_statement('add_item', queries.ADD_ITEM_STATEMENT)
+
 @app.route('/auctions/add_item', methods=['POST'])
 def add_item_to_auction():
     logger.info('POST /auctions/add_item')
     payload = flask.request.get_json()
 
-    conn = db_connection()
-    cur = conn.cursor()
-
     logger.debug(f'POST /auctions/add_item - payload: {payload}')
 
     # Validate payload fields
@@ -424,12 +2186,15 @@ def add_item_to_auction():
         response = {'status': StatusCodes['api_error'], 'results': 'Required fields missing'}
         return flask.jsonify(response)
 
+    conn = db_connection()
+    cur = conn.cursor()
+
     try:
         # Insert item into the items table
-        cur.execute('INSERT INTO items (item_name, minimum_price, auctions_auction_id, sellers_users_user_id) VALUES (%s, %s, %s, %s) RETURNING item_id',
-                    (payload['item_name'], payload['minimum_price'], payload['auction_id'], payload['sellers_user_id']))
+        execute_statement(cur, 'add_item', (payload['item_name'], payload['minimum_price'], payload['auction_id'], payload['sellers_user_id']))
         item_id = cur.fetchone()[0]  # Get the ID of the newly inserted item
         conn.commit()
+        cache_invalidate('auction', payload['auction_id'])
 
         response = {'status': StatusCodes['success'], 'results': 'Item added successfully', 'item_id': item_id}
 
@@ -438,75 +2203,459 @@ def add_item_to_auction():
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
         conn.rollback()
 
-    conn.close()
+    finally:
+        if conn is not None:
+            conn.close()
+
     return flask.jsonify(response)
 
 ########## Outbid Notifcation Function ##########
+##
+## Bids are accepted against the current high bid kept on the auction row
+## (auctions.current_bid / current_bidder_id), so the bids table is never
+## scanned. The statement below locks the auction row, checks the amount,
+## moves the high bid, inserts the bid and queues the outbid notification in
+## a single round trip. Concurrent bidders on the same auction queue on the
+## row lock, and each one is checked against the winner before it.
+##
+
+register_statement('place_bid', queries.PLACE_BID_STATEMENT)
+
 @app.route('/auctions/bid', methods=['POST'])
 def place_bid():
     logger.info('POST /auctions/bid')
     payload = flask.request.get_json()
 
-    conn = db_connection()
-    cur = conn.cursor()
-
     logger.debug(f'POST /auctions/bid - payload: {payload}')
 
     # Validate payload fields
-    if 'auctions_auction_id' not in payload or 'bid_amount' not in payload or 'buyers_user_id' not in payload:
+    if 'auctions_auction_id' not in payload or 'bid_amount' not in payload or 'buyers_user_id' not in payload or 'items_item_id' not in payload:
         response = {'status': StatusCodes['api_error'], 'results': 'Required fields missing'}
         return flask.jsonify(response)
 
-    # Check if the bid amount is higher than the current highest bid
-    cur.execute('SELECT MAX(bid_amount) FROM bids WHERE auctions_auction_id = %s', (payload['auctions_auction_id'],))
-    current_highest_bid = cur.fetchone()[0]
+    values = {
+        'auction_id': payload['auctions_auction_id'],
+        'bid_amount': payload['bid_amount'],
+        'item_id': payload['items_item_id'],
+        'buyer_id': payload['buyers_user_id']
+    }
 
-    if current_highest_bid is None or payload['bid_amount'] > current_highest_bid:
-        statement = 'INSERT INTO bids (bid_amount, bid_time, items_item_id, auctions_auction_id, buyers_users_user_id) VALUES (%s, NOW(), %s, %s, %s)'
-        values = (payload['bid_amount'], payload['items_item_id'], payload['auctions_auction_id'], payload['buyers_user_id'])
+    conn = db_connection()
 
-        try:
-            cur.execute(statement, values)
-            conn.commit()
+    try:
+        # the statement is its own transaction, no separate commit round trip
+        conn.autocommit = True
+        cur = conn.cursor()
+        execute_statement(cur, 'place_bid', values)
+        row = cur.fetchone()
+
+        if row is None:
+            response = {'status': StatusCodes['api_error'], 'results': f'Auction {values["auction_id"]} does not exist'}
+        elif row[2] is not None:
+            response = {'status': StatusCodes['success'], 'results': 'Bid placed successfully', 'bid_id': row[2], 'outbid_user_id': row[3]}
+            cache_invalidate('auction', values['auction_id'])
+            if row[3] is not None and row[3] != values['buyer_id']:
+                notification_dispatcher.wake()
+        elif row[0] != 'open':
+            response = {'status': StatusCodes['api_error'], 'results': f'Auction {values["auction_id"]} is not open'}
+        else:
+            response = {'status': StatusCodes['api_error'], 'results': 'Bid amount must be higher than current highest bid'}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'POST /auctions/bid - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+
+    finally:
+        if conn is not None:
+            conn.close()
 
-            # Check if there are previous bids from the buyer
-            cur.execute('SELECT bid_amount FROM bids WHERE auctions_auction_id = %s AND buyers_users_user_id = %s ORDER BY bid_time DESC LIMIT 1', (payload['auctions_auction_id'], payload['buyers_user_id']))
-            previous_bid = cur.fetchone()
-            if previous_bid and previous_bid[0] < payload['bid_amount']:
-                # Notify the previous bidder that they've been outbid
-                previous_bidder_id = get_previous_bidder_id(cur, payload['auctions_auction_id'], payload['buyers_user_id'])
-                if previous_bidder_id:
-                    message_content = f'Your bid of ${previous_bid[0]} has been outbid in auction {payload["auctions_auction_id"]}'
-                    send_notification(cur, message_content, 'Outbid', payload['buyers_user_id'], previous_bidder_id)
-                    conn.commit()
+    return flask.jsonify(response)
 
-            response = {'status': StatusCodes['success'], 'results': 'Bid placed successfully'}
+########## Batch Bids ##########
+##
+## Resolve many bids in one request, e.g.
+##
+## curl -X POST http://localhost:8080/auctions/bids/batch -H 'Content-Type: application/json' -d '{"bids": [{"auctions_auction_id": 1, "bid_amount": 20, "buyers_user_id": 100, "items_item_id": 1}]}'
+##
+## Bids are resolved in the order they are sent against the current high bid
+## of each auction. The auctions involved are locked once, and the accepted
+## bids, the new high bids, the auction summaries and the outbid notifications
+## are each written with a single statement that unnest()s one array per
+## column, so the whole batch is a handful of round trips regardless of its
+## size.
+##
 
-        except (Exception, psycopg2.DatabaseError) as error:
-            logger.error(f'POST /auctions/bid - error: {error}')
-            response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
-            conn.rollback()
+BATCH_MAX_BIDS = int(os.environ.get('BATCH_MAX_BIDS', 10000))
+
+@app.route('/auctions/bids/batch', methods=['POST'])
+def place_bids_batch():
+    logger.info('POST /auctions/bids/batch')
+    payload = flask.request.get_json()
+
+    bids = payload.get('bids') if isinstance(payload, dict) else payload
+    if not isinstance(bids, list) or not bids:
+        response = {'status': StatusCodes['api_error'], 'results': 'A non-empty list of bids is required'}
+        return flask.jsonify(response)
+    if len(bids) > BATCH_MAX_BIDS:
+        response = {'status': StatusCodes['api_error'], 'results': f'At most {BATCH_MAX_BIDS} bids per batch'}
+        return flask.jsonify(response)
+
+    logger.debug(f'POST /auctions/bids/batch - {len(bids)} bids')
+
+    # validate everything in one pass before touching the database
+    results = []
+    for index, bid in enumerate(bids):
+        if not isinstance(bid, dict) or any(field not in bid for field in ('auctions_auction_id', 'bid_amount', 'buyers_user_id', 'items_item_id')):
+            results.append({'index': index, 'status': 'rejected', 'reason': 'Required fields missing'})
+        elif isinstance(bid['bid_amount'], bool) or not isinstance(bid['bid_amount'], (int, float)):
+            results.append({'index': index, 'status': 'rejected', 'reason': 'bid_amount must be a number'})
+        elif any(isinstance(bid[field], bool) or not isinstance(bid[field], int) for field in ('auctions_auction_id', 'buyers_user_id', 'items_item_id')):
+            results.append({'index': index, 'status': 'rejected', 'reason': 'auctions_auction_id, buyers_user_id and items_item_id must be integers'})
+        else:
+            results.append(None)
+
+    conn = db_connection()
+    cur = conn.cursor()
+
+    try:
+        auction_ids = sorted({bid['auctions_auction_id'] for bid, result in zip(bids, results) if result is None})
+
+        # lock the auctions in a fixed order so concurrent batches cannot deadlock
+        auctions = {}
+        if auction_ids:
+            cur.execute(queries.BATCH_LOCK_QUERY, (auction_ids,))
+            for row in cur.fetchall():
+                auctions[row[0]] = {'status': row[1], 'current_bid': row[2], 'current_bidder_id': row[3], 'changed': False, 'bids': 0}
+
+        accepted = []
+        notifications = []
+        for index, bid in enumerate(bids):
+            if results[index] is not None:
+                continue
+
+            auction_id = bid['auctions_auction_id']
+            auction = auctions.get(auction_id)
+            if auction is None:
+                results[index] = {'index': index, 'status': 'rejected', 'reason': f'Auction {auction_id} does not exist'}
+            elif auction['status'] != 'open':
+                results[index] = {'index': index, 'status': 'rejected', 'reason': f'Auction {auction_id} is not open'}
+            elif auction['current_bid'] is not None and bid['bid_amount'] <= auction['current_bid']:
+                results[index] = {'index': index, 'status': 'rejected', 'reason': 'Bid amount must be higher than current highest bid'}
+            else:
+                previous_bid, previous_bidder_id = auction['current_bid'], auction['current_bidder_id']
+                if previous_bidder_id is not None and previous_bidder_id != bid['buyers_user_id']:
+                    notifications.append((previous_bid, auction_id, bid['buyers_user_id'], previous_bidder_id))
+
+                auction.update(current_bid=float(bid['bid_amount']), current_bidder_id=bid['buyers_user_id'], changed=True, bids=auction['bids'] + 1)
+                results[index] = {'index': index, 'status': 'accepted', 'outbid_user_id': previous_bidder_id}
+                accepted.append(index)
+
+        if accepted:
+            # one array per column, the amounts as floats for float8[]
+            columns = [[float(bids[i]['bid_amount']) for i in accepted]] + [[bids[i][field] for i in accepted] for field in ('items_item_id', 'auctions_auction_id', 'buyers_user_id')]
+            cur.execute(queries.BATCH_STATEMENTS['bids'], columns)
+            for i, row in zip(accepted, cur.fetchall()):
+                results[i]['bid_id'] = row[0]
+
+            changed = [(auction_id, auction) for auction_id, auction in auctions.items() if auction['changed']]
+            cur.execute(queries.BATCH_STATEMENTS['auctions'], ([auction_id for auction_id, _ in changed], [auction['current_bid'] for _, auction in changed],
+                                                               [auction['current_bidder_id'] for _, auction in changed]))
+            cur.execute(queries.BATCH_STATEMENTS['summary'], ([auction_id for auction_id, _ in changed], [auction['bids'] for _, auction in changed]))
+
+        queue_outbid_notifications(cur, notifications)
+
+        conn.commit()
+        for auction_id, auction in auctions.items():
+            if auction['changed']:
+                cache_invalidate('auction', auction_id)
+        if notifications:
+            notification_dispatcher.wake()
+        response = {'status': StatusCodes['success'], 'accepted': len(accepted), 'rejected': len(bids) - len(accepted), 'results': results}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'POST /auctions/bids/batch - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        conn.rollback()
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+    return flask.jsonify(response)
 
+##
+## Notifications are not written to the notifications table by the
+## endpoints. They are queued in notification_outbox as part of the
+## endpoint's own transaction (a single multi-row insert) and delivered by
+## the dispatcher thread below.
+##
+
+def queue_outbid_notifications(cur, notifications):
+    # notifications: (previous_bid, auction_id, sender_user_id, receiver_user_id) tuples,
+    # the text is queries.OUTBID_MESSAGE as for a single bid
+    if notifications:
+        cur.execute(queries.BATCH_STATEMENTS['outbid'], [list(column) for column in zip(*notifications)])
+
+########## Bulk Import ##########
+##
+## curl -X POST http://localhost:8080/users/import -H 'Content-Type: text/csv' --data-binary @users.csv
+## curl -X POST http://localhost:8080/auctions/import -H 'Content-Type: application/x-ndjson' --data-binary @auctions.ndjson
+##
+## Imports users (username, password, email, role) or auctions (title,
+## description, end_time, status and optionally item_name, minimum_price,
+## sellers_user_id for its item) from a CSV file with a header row, or from
+## NDJSON (one object per line).
+##
+## The body is read as a stream: each record is checked as it arrives and
+## written straight into a temporary staging table through COPY, so memory
+## does not grow with the size of the upload. The staging rows are then
+## checked against each other and the database and fanned out into the real
+## tables with set-based inserts, all in one transaction. Rows that fail are
+## reported by line number (at most IMPORT_MAX_REJECTS of them) and skipped.
+##
+
+IMPORT_MAX_REJECTS = int(os.environ.get('IMPORT_MAX_REJECTS', 100))
+
+class ChunkReader:
+    # file-like object over an iterator of strings, read by copy_expert
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def body_lines():
+    # the request body as lines of text, read as they arrive
+    while True:
+        line = flask.request.stream.readline()
+        if not line:
+            return
+        yield line.decode('utf-8')
+
+
+def import_records():
+    # (line, record dict or None, reason) for every record in the request body
+    text = body_lines()
+    if 'json' in (flask.request.mimetype or ''):
+        for line, content in enumerate(text, 1):
+            if not content.strip():
+                continue
+            try:
+                record = json.loads(content)
+            except ValueError:
+                yield line, None, 'Invalid JSON'
+                continue
+            if isinstance(record, dict):
+                yield line, record, None
+            else:
+                yield line, None, 'Expected a JSON object'
     else:
-        response = {'status': StatusCodes['api_error'], 'results': 'Bid amount must be higher than current highest bid'}
+        reader = csv.DictReader(text)
+        for record in reader:
+            if None in record:
+                yield reader.line_num, None, 'Too many fields'
+            else:
+                yield reader.line_num, record, None
+
+
+def copy_rows(records, check, rejects):
+    # check(record) returns the staging columns or raises ValueError;
+    # yields valid rows as CSV for COPY and collects the rest in rejects
+    buffer = io.StringIO()
+    # strings are quoted, so they stay strings even when empty
+    writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC)
+    for line, record, reason in records:
+        if reason is None:
+            try:
+                row = check(record)
+            except (ValueError, TypeError) as error:
+                reason = str(error)
+        if reason is not None:
+            rejects['count'] += 1
+            if len(rejects['rows']) < IMPORT_MAX_REJECTS:
+                rejects['rows'].append({'line': line, 'reason': reason})
+            continue
+
+        writer.writerow((line,) + row)
+        if buffer.tell() >= 65536:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def staged_rejects(cur, table, rejects):
+    # adds the rows rejected in the staging table to rejects
+    cur.execute(f'SELECT count(*) FROM {table} WHERE reason IS NOT NULL')
+    rejects['count'] += cur.fetchone()[0]
+    cur.execute(f'SELECT line, reason FROM {table} WHERE reason IS NOT NULL ORDER BY line LIMIT %s', (IMPORT_MAX_REJECTS,))
+    rejects['rows'] = sorted(rejects['rows'] + [{'line': row[0], 'reason': row[1]} for row in cur.fetchall()], key=lambda row: row['line'])[:IMPORT_MAX_REJECTS]
+
+
+def text_field(record, name, required=False):
+    value = record.get(name)
+    if value is not None and not isinstance(value, str):
+        value = str(value)
+    value = value.strip() if value is not None else None
+    if required and not value:
+        raise ValueError(f'{name} is required')
+    return value or None
+
+
+def check_user(record):
+    return (text_field(record, 'username', True), text_field(record, 'password') or '', text_field(record, 'email') or '', text_field(record, 'role', True))
+
+
+def check_auction(record):
+    end_time = datetime.fromisoformat(text_field(record, 'end_time', True))
+    item = (text_field(record, 'item_name'), text_field(record, 'minimum_price'), text_field(record, 'sellers_user_id'))
+    if any(item) and not all(item):
+        raise ValueError('item_name, minimum_price and sellers_user_id go together')
+    if all(item):
+        item = (item[0], float(item[1]), int(item[2]))
+    return (text_field(record, 'title', True), text_field(record, 'description') or '', end_time.isoformat(), text_field(record, 'status') or 'open') + item
+
+
+IMPORT_USERS_STATEMENTS = [
+    # the first occurrence of a username in the file wins
+    """
+    UPDATE import_users s SET reason = 'Duplicate username in file'
+    FROM (SELECT line, row_number() OVER (PARTITION BY username ORDER BY line) AS n FROM import_users) d
+    WHERE s.line = d.line AND d.n > 1
+    """,
+    """
+    WITH inserted AS (
+        INSERT INTO users (username, password, email, role)
+        SELECT username, password, email, role FROM import_users WHERE reason IS NULL ORDER BY line
+        ON CONFLICT (username) DO NOTHING
+        RETURNING user_id, username, role
+    ),
+    new_sellers AS (
+        INSERT INTO sellers (users_user_id, seller_name) SELECT user_id, username FROM inserted WHERE role = 'Seller'
+    ),
+    new_buyers AS (
+        INSERT INTO buyers (users_user_id, buyer_name) SELECT user_id, username FROM inserted WHERE role = 'Buyer'
+    )
+    UPDATE import_users s SET reason = 'Username already exists'
+    WHERE reason IS NULL AND NOT EXISTS (SELECT 1 FROM inserted WHERE inserted.username = s.username)
+    """
+]
+
+IMPORT_AUCTIONS_STATEMENTS = [
+    """
+    UPDATE import_auctions s SET reason = 'Seller ' || s.sellers_user_id || ' does not exist'
+    WHERE s.item_name IS NOT NULL AND NOT EXISTS (SELECT 1 FROM sellers WHERE users_user_id = s.sellers_user_id)
+    """,
+    # ids are taken up front so the items can be matched to their auctions
+    "UPDATE import_auctions SET auction_id = nextval(pg_get_serial_sequence('auctions', 'auction_id')) WHERE reason IS NULL",
+    """
+    WITH new_auctions AS (
+        INSERT INTO auctions (auction_id, title, description, end_time, status)
+        SELECT auction_id, title, description, end_time, status FROM import_auctions WHERE reason IS NULL ORDER BY line
+    )
+    INSERT INTO items (item_name, minimum_price, auctions_auction_id, sellers_users_user_id)
+    SELECT item_name, minimum_price, auction_id, sellers_user_id FROM import_auctions WHERE reason IS NULL AND item_name IS NOT NULL
+    """
+]
+
+@app.route('/users/import', methods=['POST'])
+def import_users():
+    logger.info('POST /users/import')
+
+    conn = db_connection()
+    cur = conn.cursor()
+    rejects = {'count': 0, 'rows': []}
+
+    try:
+        cur.execute('CREATE TEMP TABLE import_users (line INTEGER, username TEXT, password TEXT, email TEXT, role TEXT, reason TEXT) ON COMMIT DROP')
+        cur.copy_expert('COPY import_users (line, username, password, email, role) FROM STDIN WITH (FORMAT csv)',
+                        ChunkReader(copy_rows(import_records(), check_user, rejects)))
+        for statement in IMPORT_USERS_STATEMENTS:
+            cur.execute(statement)
+
+        cur.execute('SELECT count(*) FROM import_users WHERE reason IS NULL')
+        imported = cur.fetchone()[0]
+        staged_rejects(cur, 'import_users', rejects)
+        conn.commit()
+        cache_invalidate('users')
+        response = {'status': StatusCodes['success'], 'imported': imported, 'rejected': rejects['count'], 'results': rejects['rows']}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'POST /users/import - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        conn.rollback()
+
+    finally:
+        if conn is not None:
+            conn.close()
 
-    conn.close()
     return flask.jsonify(response)
 
-def get_previous_bidder_id(cur, auction_id, current_bidder_id):
-    cur.execute('SELECT DISTINCT buyers_users_user_id FROM bids WHERE auction_id = %s AND buyers_users_user_id != %s ORDER BY bid_time DESC LIMIT 1', (auction_id, current_bidder_id))
-    row = cur.fetchone()
-    if row:
-        return row[0]
-    return None
+@app.route('/auctions/import', methods=['POST'])
+def import_auctions():
+    logger.info('POST /auctions/import')
+
+    conn = db_connection()
+    cur = conn.cursor()
+    rejects = {'count': 0, 'rows': []}
 
-def send_notification(cur, message_content, notification_type, sender_user_id, receiver_user_id):
-    statement = 'INSERT INTO notifications (message_content, notification_type, sender_user_id, receiver_user_id, notification_time) VALUES (%s, %s, %s, %s, NOW())'
-    values = (message_content, notification_type, sender_user_id, receiver_user_id)
-    cur.execute(statement, values)
+    try:
+        cur.execute('CREATE TEMP TABLE import_auctions (line INTEGER, title TEXT, description TEXT, end_time TIMESTAMP, status TEXT, '
+                    'item_name TEXT, minimum_price FLOAT(8), sellers_user_id BIGINT, auction_id INTEGER, reason TEXT) ON COMMIT DROP')
+        cur.copy_expert('COPY import_auctions (line, title, description, end_time, status, item_name, minimum_price, sellers_user_id) FROM STDIN '
+                        'WITH (FORMAT csv, FORCE_NULL (item_name, minimum_price, sellers_user_id))',
+                        ChunkReader(copy_rows(import_records(), check_auction, rejects)))
+        for statement in IMPORT_AUCTIONS_STATEMENTS:
+            cur.execute(statement)
+
+        cur.execute('SELECT count(*) FROM import_auctions WHERE reason IS NULL')
+        imported = cur.fetchone()[0]
+        staged_rejects(cur, 'import_auctions', rejects)
+
+        # open auctions that end before the scheduler's next reload
+        cur.execute("SELECT auction_id, end_time FROM import_auctions WHERE reason IS NULL AND status = 'open' AND end_time <= %s",
+                    (datetime.now() + timedelta(seconds=EXPIRY_CONFIG['reload_interval']),))
+        ending = cur.fetchall()
+        conn.commit()
+
+        cache_invalidate('auctions')
+        for auction_id, end_time in ending:
+            expiry_scheduler.add(auction_id, end_time)
+        response = {'status': StatusCodes['success'], 'imported': imported, 'rejected': rejects['count'], 'results': rejects['rows']}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'POST /auctions/import - error: {error}')
+        response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
+        conn.rollback()
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+    return flask.jsonify(response)
 
 ########## Close Auction ##########
-from datetime import datetime
+##
+## Closing and cancelling are one statement each: the auction is updated and
+## the winner recorded (or the bidders notified) in a single round trip that
+## commits on its own
+##
+
+register_statement('close_auction', queries.CLOSE_AUCTION_STATEMENT)
 
 @app.route('/auctions/close/<int:auction_id>/', methods=['PUT'])
 def close_auction(auction_id):
@@ -516,35 +2665,29 @@ def close_auction(auction_id):
     current_datetime = datetime.now()
     
     conn = db_connection()
-    cur = conn.cursor()
     
     try:
-        # Retrieve the end time of the auction from the database
-        cur.execute('SELECT end_time FROM auctions WHERE auction_id = %s', (auction_id,))
-        end_time = cur.fetchone()[0]
+        # close it if the current datetime is after its end time; the winner
+        # is the current high bidder, kept up to date by every accepted bid
+        conn.autocommit = True
+        cur = conn.cursor()
+        execute_statement(cur, 'close_auction', {'auction_id': auction_id, 'now': current_datetime})
+        row = cur.fetchone()
         
-        # Check if the current datetime is after the specified end time
-        if current_datetime > end_time:
-            cur.execute('UPDATE auctions SET status = %s WHERE auction_id = %s', ('closed', auction_id))
-            conn.commit()
-            
-            # Determine the winner based on the highest bid
-            cur.execute('SELECT buyers_users_user_id, MAX(bid_amount) FROM bids WHERE auction_id = %s GROUP BY buyers_users_user_id ORDER BY MAX(bid_amount) DESC LIMIT 1', (auction_id,))
-            winner_info = cur.fetchone()
-            winner_id, winning_amount = winner_info[0], winner_info[1]
-            
-            # Update auction details with winner information
-            cur.execute('UPDATE auctions SET winner_user_id = %s, winning_amount = %s WHERE auction_id = %s', (winner_id, winning_amount, auction_id))
-            conn.commit()
-            
+        if row is None:
+            response = {'status': StatusCodes['api_error'], 'results': f'Auction {auction_id} does not exist'}
+        elif row[0]:
+            cache_invalidate('auctions')
+            cache_invalidate('auction', auction_id)
             response = {'status': StatusCodes['success'], 'results': f'Auction {auction_id} closed successfully'}
+        elif row[1] != 'open':
+            response = {'status': StatusCodes['api_error'], 'results': f'Auction {auction_id} is not open'}
         else:
             response = {'status': StatusCodes['api_error'], 'results': 'Auction cannot be closed yet'}
         
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'PUT /auctions/close/{auction_id} - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
-        conn.rollback()
         
     finally:
         if conn is not None:
@@ -553,34 +2696,31 @@ def close_auction(auction_id):
     return flask.jsonify(response)
 
 ########## Cancel Auction ##########
+register_statement('cancel_auction', queries.CANCEL_AUCTION_STATEMENT)
+
 @app.route('/auctions/cancel/<int:auction_id>/', methods=['PUT'])
 def cancel_auction(auction_id):
     logger.info(f'PUT /auctions/cancel/{auction_id}')
 
     conn = db_connection()
-    cur = conn.cursor()
 
     try:
-        # Update the status of the auction to 'cancelled'
-        cur.execute('UPDATE auctions SET status = %s WHERE auction_id = %s', ('cancelled', auction_id))
-        conn.commit()
+        # cancel it and notify all users interested in this auction, in the same statement
+        conn.autocommit = True
+        cur = conn.cursor()
+        execute_statement(cur, 'cancel_auction', {'auction_id': auction_id, 'message': f'The auction {auction_id} has been cancelled.'})
+        notified = cur.fetchone()[0]
+        cache_invalidate('auctions')
+        cache_invalidate('auction', auction_id)
 
-        # Get all users interested in this auction
-        cur.execute('SELECT DISTINCT buyers_users_user_id FROM bids WHERE auctions_auction_id = %s', (auction_id,))
-        interested_users = cur.fetchall()
-
-        # Send notification to each interested user
-        for user_id in interested_users:
-            message_content = f'The auction {auction_id} has been cancelled.'
-            send_notification(cur, message_content, 'Auction Cancelled', sender_user_id=None, receiver_user_id=user_id[0])
-            conn.commit()
+        if notified:
+            notification_dispatcher.wake()
 
         response = {'status': StatusCodes['success'], 'results': f'Auction {auction_id} cancelled successfully'}
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'PUT /auctions/cancel/{auction_id} - error: {error}')
         response = {'status': StatusCodes['internal_error'], 'errors': str(error)}
-        conn.rollback()
 
     finally:
         if conn is not None:
@@ -589,24 +2729,716 @@ def cancel_auction(auction_id):
     return flask.jsonify(response)
 
 
+########## Auction Expiry ##########
+##
+## Closes auctions when their end_time passes, without anyone calling
+## PUT /auctions/close/<id>/. A heap holds the end times of the open
+## auctions that expire within the next reload interval; the thread sleeps
+## until the earliest one and then closes every expired auction with a
+## single UPDATE that also records the winner from the current high bid.
+## The heap is reloaded from the database every reload interval, which also
+## picks up auctions created by other processes.
+##
+
+EXPIRY_CONFIG = {
+    'enabled': os.environ.get('EXPIRY_SCHEDULER', 'on') == 'on',
+    'reload_interval': float(os.environ.get('EXPIRY_RELOAD_INTERVAL', 60)),
+    'retry_interval': float(os.environ.get('EXPIRY_RETRY_INTERVAL', 5))
+}
+
+class ExpiryScheduler:
+
+    def __init__(self, reload_interval, retry_interval):
+        self.reload_interval = reload_interval
+        self.retry_interval = retry_interval
+        self.pid = None
+
+        self._cond = threading.Condition()
+        self._heap = []  # (end_time, auction_id)
+        self._next_reload = 0
+        self._counters = {'runs': 0, 'closed': 0, 'reloads': 0, 'errors': 0}
+
+    def start(self):
+        self.pid = os.getpid()
+        self._next_reload = 0
+        thread = threading.Thread(target=self._run, name='auction-expiry', daemon=True)
+        thread.start()
+
+    def add(self, auction_id, end_time):
+        with self._cond:
+            heapq.heappush(self._heap, (end_time, auction_id))
+            self._cond.notify()
+
+    def _reload(self):
+        horizon = datetime.now() + timedelta(seconds=self.reload_interval)
+        conn = db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(queries.EXPIRING_AUCTIONS_QUERY, (horizon,))
+            heap = cur.fetchall()
+        finally:
+            conn.close()
+
+        heapq.heapify(heap)
+        with self._cond:
+            self._heap = heap
+            self._next_reload = time.monotonic() + self.reload_interval
+            self._counters['reloads'] += 1
+
+    def close_expired(self):
+        now = datetime.now()
+        conn = db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(queries.EXPIRE_STATEMENT, (now,))
+            closed = [row[0] for row in cur.fetchall()]
+            conn.commit()
+        finally:
+            conn.close()
+
+        if closed:
+            cache_invalidate('auctions')
+            for auction_id in closed:
+                cache_invalidate('auction', auction_id)
+
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                heapq.heappop(self._heap)
+            self._counters['runs'] += 1
+            self._counters['closed'] += len(closed)
+        return closed
+
+    def _run(self):
+        while True:
+            try:
+                if time.monotonic() >= self._next_reload:
+                    self._reload()
+
+                with self._cond:
+                    timeout = self._next_reload - time.monotonic()
+                    if self._heap:
+                        timeout = min(timeout, (self._heap[0][0] - datetime.now()).total_seconds())
+                    if timeout > 0:
+                        self._cond.wait(timeout)
+                    due = bool(self._heap) and self._heap[0][0] <= datetime.now()
+
+                if due:
+                    closed = self.close_expired()
+                    if closed:
+                        logger.info(f'auction expiry - closed {len(closed)} auctions')
+
+            except (Exception, psycopg2.DatabaseError) as error:
+                logger.error(f'auction expiry - error: {error}')
+                with self._cond:
+                    self._counters['errors'] += 1
+                time.sleep(self.retry_interval)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats['scheduled'] = len(self._heap)
+            stats['next_end_time'] = self._heap[0][0] if self._heap else None
+        return stats
+
+
+expiry_scheduler = ExpiryScheduler(EXPIRY_CONFIG['reload_interval'], EXPIRY_CONFIG['retry_interval'])
+
+########## Notification Dispatcher ##########
+##
+## Drains notification_outbox into notifications in batches. Each batch is a
+## single statement that deletes up to batch_size outbox rows (skipping rows
+## another process is already moving) and inserts them as notifications.
+## The thread keeps draining while batches come back full, then sleeps for
+## flush_interval or until an endpoint wakes it up after queueing.
+##
+## Every batch also NOTIFYs EVENTS_CHANNEL with the id of each receiver (see
+## User Events). Batches hold DISPATCH_LOCK_ID while they run, so across all
+## processes notification ids become visible in increasing order and a
+## stream's cursor can never step over one that is committed later.
+##
+
+DISPATCHER_CONFIG = {
+    'enabled': os.environ.get('NOTIFICATION_DISPATCHER', 'on') == 'on',
+    'batch_size': int(os.environ.get('DISPATCHER_BATCH_SIZE', 500)),
+    'flush_interval': float(os.environ.get('DISPATCHER_FLUSH_INTERVAL', 1)),
+    'retry_interval': float(os.environ.get('DISPATCHER_RETRY_INTERVAL', 5))
+}
+
+class NotificationDispatcher:
+
+    def __init__(self, batch_size, flush_interval, retry_interval):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.pid = None
+
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._counters = {'batches': 0, 'dispatched': 0, 'errors': 0}
+
+    def start(self):
+        self.pid = os.getpid()
+        thread = threading.Thread(target=self._run, name='notification-dispatcher', daemon=True)
+        thread.start()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def dispatch_batch(self):
+        conn = db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(queries.LOCK_STATEMENT, (queries.DISPATCH_LOCK_ID,))
+            cur.execute(queries.DISPATCH_STATEMENT, (self.batch_size, queries.EVENTS_CHANNEL))
+            dispatched = cur.fetchone()[0]
+            # the notifications and their NOTIFYs are published together
+            conn.commit()
+        finally:
+            conn.close()
+
+        with self._lock:
+            self._counters['batches'] += 1
+            self._counters['dispatched'] += dispatched
+        return dispatched
+
+    def _run(self):
+        while True:
+            try:
+                self._wakeup.clear()
+                while self.dispatch_batch() >= self.batch_size:
+                    pass
+                self._wakeup.wait(self.flush_interval)
+
+            except (Exception, psycopg2.DatabaseError) as error:
+                logger.error(f'notification dispatcher - error: {error}')
+                with self._lock:
+                    self._counters['errors'] += 1
+                time.sleep(self.retry_interval)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+notification_dispatcher = NotificationDispatcher(DISPATCHER_CONFIG['batch_size'], DISPATCHER_CONFIG['flush_interval'], DISPATCHER_CONFIG['retry_interval'])
+
+########## User Events ##########
+##
+## Pushes a user's notifications to GET /users/<user_id>/events (Server-Sent
+## Events) as soon as the dispatcher commits them, instead of clients polling
+## the notifications table.
+##
+## Each serving process has one EventBroker thread, started by the first
+## subscriber, that LISTENs on EVENTS_CHANNEL over its own connection and
+## wakes the streams subscribed to the notified users, however many streams
+## there are. A woken stream reads the user's notifications after its cursor,
+## the last notification_id it sent, which is also the SSE event id, so a
+## client that reconnects with Last-Event-ID receives exactly the ones it
+## missed. Streams end after max_duration and the client reconnects.
+##
+
+EVENTS_CONFIG = {
+    'keepalive': float(os.environ.get('EVENTS_KEEPALIVE', 15)),
+    'max_duration': float(os.environ.get('EVENTS_MAX_DURATION', 300)),
+    'batch_size': int(os.environ.get('EVENTS_BATCH_SIZE', 100)),
+    'retry_interval': float(os.environ.get('EVENTS_RETRY_INTERVAL', 5)),
+    # streams per process; each holds a gunicorn thread, so by default half of WEB_THREADS
+    'max_streams': int(os.environ.get('EVENTS_MAX_STREAMS', max(1, int(os.environ.get('WEB_THREADS', 4)) // 2)))
+}
+
+# the streams are an admission lane, so subscribers beyond max_streams are answered 503
+ADMISSION_LIMITS.setdefault('get_user_events', EVENTS_CONFIG['max_streams'])
+
+class EventBroker:
+
+    def __init__(self, keepalive, retry_interval):
+        self.keepalive = keepalive
+        self.retry_interval = retry_interval
+        self.pid = None
+
+        self._lock = threading.Lock()
+        self._subscribers = {}  # user_id -> set of threading.Event
+        self._counters = {'notifies': 0, 'wakeups': 0, 'reconnects': 0, 'errors': 0}
+
+    def subscribe(self, user_id):
+        # the returned event is set whenever user_id may have new notifications
+        event = threading.Event()
+        with self._lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self._subscribers = {}
+                thread = threading.Thread(target=self._run, name='event-broker', daemon=True)
+                thread.start()
+            self._subscribers.setdefault(user_id, set()).add(event)
+        return event
+
+    def unsubscribe(self, user_id, event):
+        with self._lock:
+            events = self._subscribers.get(user_id)
+            if events is not None:
+                events.discard(event)
+                if not events:
+                    del self._subscribers[user_id]
+
+    def _wake(self, user_ids=None):
+        # user_ids=None wakes everyone
+        with self._lock:
+            for user_id, events in self._subscribers.items():
+                if user_ids is None or user_id in user_ids:
+                    for event in events:
+                        event.set()
+                        self._counters['wakeups'] += 1
+
+    def _listen(self):
+        conn = psycopg2.connect(**DB_CONFIG)
+        try:
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute(f'LISTEN {queries.EVENTS_CHANNEL}')
+            # anything committed while we were not listening
+            self._wake()
+
+            while True:
+                if select.select([conn], [], [], self.keepalive) == ([], [], []):
+                    # nothing for a while, make sure the connection is still there
+                    cur.execute('SELECT 1')
+                    continue
+
+                conn.poll()
+                user_ids = set()
+                while conn.notifies:
+                    user_ids.add(int(conn.notifies.pop(0).payload))
+                with self._lock:
+                    self._counters['notifies'] += len(user_ids)
+                self._wake(user_ids)
+        finally:
+            conn.close()
+
+    def _run(self):
+        while True:
+            try:
+                self._listen()
+            except (Exception, psycopg2.DatabaseError) as error:
+                logger.error(f'event broker - error: {error}')
+                with self._lock:
+                    self._counters['errors'] += 1
+                time.sleep(self.retry_interval)
+                with self._lock:
+                    self._counters['reconnects'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['users'] = len(self._subscribers)
+            stats['streams'] = sum(len(events) for events in self._subscribers.values())
+        return stats
+
+
+event_broker = EventBroker(EVENTS_CONFIG['keepalive'], EVENTS_CONFIG['retry_interval'])
+
+def latest_notification_id(user_id):
+    conn = db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT coalesce(max(notification_id), 0) FROM notifications WHERE receiver_user_id = %s', (user_id,))
+        return cur.fetchone()[0]
+    finally:
+        conn.close()
+
+register_statement('get_user_events', 'SELECT notification_id, notification_type, message_content, sender_user_id, notification_time FROM notifications '
+                                      'WHERE receiver_user_id = %s AND notification_id > %s ORDER BY notification_id LIMIT %s')
+
+def fetch_user_events(user_id, after):
+    conn = db_connection()
+    try:
+        cur = conn.cursor()
+        execute_statement(cur, 'get_user_events', (user_id, after, EVENTS_CONFIG['batch_size']))
+        return cur.fetchall()
+    finally:
+        conn.close()
+
+def format_event(row):
+    data = {'notification_id': row[0], 'notification_type': row[1], 'message_content': row[2], 'sender_user_id': row[3], 'notification_time': row[4]}
+    return f'id: {row[0]}\nevent: notification\ndata: {app.json.dumps(data)}\n\n'
+
+@app.route('/users/<int:user_id>/events', methods=['GET'])
+def get_user_events(user_id):
+    logger.info(f'GET /users/{user_id}/events')
+
+    # EventSource sends Last-Event-ID when it reconnects; ?after= is for other clients
+    cursor = flask.request.headers.get('Last-Event-ID', flask.request.args.get('after'))
+    if cursor is not None and not cursor.isdigit():
+        response = {'status': StatusCodes['api_error'], 'results': 'Last-Event-ID must be a notification id'}
+        return flask.jsonify(response)
+
+    # subscribe before reading the cursor, so nothing committed in between is missed
+    event = event_broker.subscribe(user_id)
+    try:
+        cursor = int(cursor) if cursor is not None else latest_notification_id(user_id)
+    except Exception:
+        event_broker.unsubscribe(user_id, event)
+        raise
+
+    def generate(cursor):
+        deadline = time.monotonic() + EVENTS_CONFIG['max_duration']
+        try:
+            yield f'retry: {int(EVENTS_CONFIG["retry_interval"] * 1000)}\n\n'
+            while time.monotonic() < deadline:
+                event.clear()
+                rows = fetch_user_events(user_id, cursor)
+                for row in rows:
+                    cursor = row[0]
+                    yield format_event(row)
+                if len(rows) == EVENTS_CONFIG['batch_size']:
+                    continue
+                if not event.wait(min(EVENTS_CONFIG['keepalive'], max(0, deadline - time.monotonic()))):
+                    yield ': keepalive\n\n'
+        except (Exception, psycopg2.DatabaseError) as error:
+            # the client reconnects from its last event id
+            logger.error(f'GET /users/{user_id}/events - stream error: {error}')
+        finally:
+            finish()
+
+    # the stream keeps its admission slot (and its thread) until it ends
+    release = release_on_close()
+
+    def finish():
+        event_broker.unsubscribe(user_id, event)
+        release()
+
+    response = flask.Response(generate(cursor), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # also covers streams that are never iterated (e.g. the client went away)
+    response.call_on_close(finish)
+    return response
+
+
+########## Bid Archive ##########
+##
+## bids and notifications are partitioned (migrations/0006). bids_live holds
+## the bids of open auctions, the only ones the bid and cancel endpoints read
+## (they filter on NOT archived), and bids_archive all the others;
+## notifications has one partition per month.
+##
+## Every interval the maintenance thread moves the bids of closed and
+## cancelled auctions to bids_archive, then packs them out of bids_archive
+## into one row of compressed arrays per auction in bids_archive_packed
+## (migrations/0007), batch_size auctions per transaction for both, and
+## creates the notifications partitions up to months_ahead months from now,
+## first moving any rows of those months out of notifications_default.
+## Each transaction takes MAINTENANCE_LOCK_ID, so while one process is doing
+## the work the others skip their run.
+##
+
+MAINTENANCE_CONFIG = {
+    'enabled': os.environ.get('MAINTENANCE_JOB', 'on') == 'on',
+    'interval': float(os.environ.get('MAINTENANCE_INTERVAL', 300)),
+    'batch_size': int(os.environ.get('ARCHIVE_BATCH_SIZE', 100)),
+    'months_ahead': int(os.environ.get('NOTIFICATION_MONTHS_AHEAD', 2)),
+    'retry_interval': float(os.environ.get('MAINTENANCE_RETRY_INTERVAL', 60))
+}
+
+def next_month(month):
+    return (month + timedelta(days=32)).replace(day=1)
+
+class MaintenanceJob:
+
+    def __init__(self, interval, batch_size, months_ahead, retry_interval):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.months_ahead = months_ahead
+        self.retry_interval = retry_interval
+        self.pid = None
+
+        self._lock = threading.Lock()
+        self._counters = {'runs': 0, 'skipped': 0, 'archived_auctions': 0, 'archived_bids': 0,
+                          'packed_auctions': 0, 'packed_bids': 0, 'partitions': 0, 'errors': 0}
+
+    def start(self):
+        self.pid = os.getpid()
+        thread = threading.Thread(target=self._run, name='maintenance', daemon=True)
+        thread.start()
+
+    def _try_lock(self, cur):
+        cur.execute(queries.TRY_LOCK_STATEMENT, (queries.MAINTENANCE_LOCK_ID,))
+        return cur.fetchone()[0]
+
+    def _move_batch(self, statement, counter):
+        # (auctions, bids) moved, None if another process holds the lock
+        conn = db_connection()
+        try:
+            cur = conn.cursor()
+            if not self._try_lock(cur):
+                return None
+            cur.execute(statement, (self.batch_size,))
+            moved = cur.fetchone()
+            conn.commit()
+        finally:
+            conn.close()
+
+        with self._lock:
+            self._counters[f'{counter}_auctions'] += moved[0]
+            self._counters[f'{counter}_bids'] += moved[1]
+        return moved
+
+    def archive_batch(self):
+        return self._move_batch(queries.ARCHIVE_STATEMENT, 'archived')
+
+    def pack_batch(self):
+        return self._move_batch(queries.PACK_STATEMENT, 'packed')
+
+    def _move_all(self, batch):
+        # bids moved by batch until it runs out, None if it was skipped
+        total = 0
+        while True:
+            moved = batch()
+            if moved is None:
+                with self._lock:
+                    self._counters['skipped'] += 1
+                return None
+            total += moved[1]
+            if moved[0] < self.batch_size:
+                return total
+
+    def create_partitions(self):
+        month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        months = set()
+        for _ in range(self.months_ahead + 1):
+            months.add(month)
+            month = next_month(month)
+
+        conn = db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(queries.PARTITIONS_QUERY)
+            existing = {row[0] for row in cur.fetchall()}
+            cur.execute(queries.UNPARTITIONED_MONTHS_QUERY)
+            months.update(row[0] for row in cur.fetchall())
+
+            created = []
+            for start in sorted(months):
+                partition = f'notifications_{start:%Y_%m}'
+                if partition in existing:
+                    continue
+                if not self._try_lock(cur):
+                    break
+                cur.execute(queries.PARTITION_EXISTS_QUERY, (partition,))
+                if cur.fetchone()[0]:
+                    conn.rollback()
+                    continue
+                for statement in queries.PARTITION_STATEMENTS:
+                    cur.execute(psycopg2.sql.SQL(statement).format(partition=psycopg2.sql.Identifier(partition),
+                                                                   start=psycopg2.sql.Literal(start), end=psycopg2.sql.Literal(next_month(start))))
+                conn.commit()
+                created.append(partition)
+        finally:
+            conn.close()
+
+        with self._lock:
+            self._counters['partitions'] += len(created)
+        return created
+
+    def run(self):
+        created = self.create_partitions()
+        if created:
+            logger.info(f'maintenance - created partitions {", ".join(created)}')
+
+        archived = self._move_all(self.archive_batch)
+        if archived:
+            logger.info(f'maintenance - archived {archived} bids')
+        if archived is not None:
+            packed = self._move_all(self.pack_batch)
+            if packed:
+                logger.info(f'maintenance - packed {packed} bids')
+
+        with self._lock:
+            self._counters['runs'] += 1
+
+    def _run(self):
+        while True:
+            try:
+                self.run()
+                time.sleep(self.interval)
+
+            except (Exception, psycopg2.DatabaseError) as error:
+                logger.error(f'maintenance - error: {error}')
+                with self._lock:
+                    self._counters['errors'] += 1
+                time.sleep(self.retry_interval)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+maintenance_job = MaintenanceJob(MAINTENANCE_CONFIG['interval'], MAINTENANCE_CONFIG['batch_size'], MAINTENANCE_CONFIG['months_ahead'], MAINTENANCE_CONFIG['retry_interval'])
+
+##
+## Background threads are started by the first request each serving process
+## handles (threads do not survive a fork, so this also covers workers)
+##
+
+_workers_lock = threading.Lock()
+
+@app.before_request
+def start_background_workers():
+    if EXPIRY_CONFIG['enabled'] and expiry_scheduler.pid != os.getpid():
+        with _workers_lock:
+            if expiry_scheduler.pid != os.getpid():
+                expiry_scheduler.start()
+
+    if DISPATCHER_CONFIG['enabled'] and notification_dispatcher.pid != os.getpid():
+        with _workers_lock:
+            if notification_dispatcher.pid != os.getpid():
+                notification_dispatcher.start()
+
+    if MAINTENANCE_CONFIG['enabled'] and maintenance_job.pid != os.getpid():
+        with _workers_lock:
+            if maintenance_job.pid != os.getpid():
+                maintenance_job.start()
+
+    if (isinstance(response_cache, LocalCache) or response_cache is not None and replica_set.replicas) and CACHE_BROADCAST_CONFIG['enabled'] and cache_broadcaster.pid != os.getpid():
+        with _workers_lock:
+            if cache_broadcaster.pid != os.getpid():
+                cache_broadcaster.start()
+
+    if replica_set.replicas and replica_set.pid != os.getpid():
+        with _workers_lock:
+            if replica_set.pid != os.getpid():
+                replica_set.start()
+
+
+##
+## Server process lifecycle, called by the production server (gunicorn.conf.py)
+## in every worker after it is forked, and when the worker exits
+##
+
+def init_worker():
+    global _pool
+    _pool = None  # connections must never be shared with the parent process
+    replica_set.reset()
+    wait_for_database(DB_READY_TIMEOUT)
+    get_pool()
+    start_background_workers()
+
+def shutdown_worker():
+    if _pool is not None:
+        _pool.closeall()
+
+
+########## Readiness ##########
+@app.route('/ready', methods=['GET'])
+def readiness():
+    conn = None
+    try:
+        # a database that is down fails here, which is "not ready" too
+        conn = db_connection()
+        cur = conn.cursor()
+        cur.execute('SELECT 1')
+        response = {'status': StatusCodes['success'], 'results': 'ready'}
+        code = StatusCodes['success']
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /ready - error: {error}')
+        response = {'status': StatusCodes['unavailable'], 'errors': str(error)}
+        code = StatusCodes['unavailable']
+    finally:
+        if conn is not None:
+            conn.close()
+    return flask.jsonify(response), code
+
+
+########## Metrics ##########
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+
+    # current pool state as gauges
+    if _pool is not None:
+        for name, value in _pool.stats().items():
+            lines.append(f'# TYPE db_pool_{name} gauge')
+            lines.append(f'db_pool_{name} {value}')
+
+    admission_stats = admission_controller.stats()
+    for name in ('active', 'waiting'):
+        lines.append(f'# TYPE http_admission_{name} gauge')
+        for endpoint, stats in sorted(admission_stats.items()):
+            lines.append(f'http_admission_{name}{format_labels({"endpoint": endpoint})} {stats[name]}')
+
+    replica_stats = replica_set.stats()
+    for name in sorted({name for stats in replica_stats.values() for name in stats}):
+        lines.append(f'# TYPE db_replica_{name} gauge')
+        for replica, stats in replica_stats.items():
+            value = stats.get(name)
+            lines.append(f'db_replica_{name}{format_labels({"replica": replica})} {"NaN" if value is None else float(value)}')
+
+    return flask.Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+########## Pool Statistics ##########
+@app.route('/pool/stats', methods=['GET'])
+def get_pool_stats():
+    logger.info('GET /pool/stats')
+    stats = get_pool().stats()
+    if replica_set.replicas:
+        stats['replicas'] = replica_set.stats()
+    response = {'status': StatusCodes['success'], 'results': stats}
+    return flask.jsonify(response)
+
+
+########## Cache Statistics ##########
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    logger.info('GET /cache/stats')
+    stats = response_cache.stats() if response_cache is not None else {'backend': 'off'}
+    if cache_broadcaster.pid == os.getpid():
+        stats['broadcast'] = cache_broadcaster.stats()
+    response = {'status': StatusCodes['success'], 'results': stats}
+    return flask.jsonify(response)
+
+
+########## Event Statistics ##########
+@app.route('/events/stats', methods=['GET'])
+def get_event_stats():
+    logger.info('GET /events/stats')
+    response = {'status': StatusCodes['success'], 'results': event_broker.stats()}
+    return flask.jsonify(response)
+
+
+########## Maintenance Statistics ##########
+@app.route('/maintenance/stats', methods=['GET'])
+def get_maintenance_stats():
+    logger.info('GET /maintenance/stats')
+    response = {'status': StatusCodes['success'], 'results': maintenance_job.stats()}
+    return flask.jsonify(response)
+
+
+########## Admission Statistics ##########
+@app.route('/admission/stats', methods=['GET'])
+def get_admission_stats():
+    logger.info('GET /admission/stats')
+    response = {'status': StatusCodes['success'], 'results': admission_controller.stats()}
+    return flask.jsonify(response)
+
+
+########## Coalescing Statistics ##########
+@app.route('/coalescing/stats', methods=['GET'])
+def get_coalescing_stats():
+    logger.info('GET /coalescing/stats')
+    response = {'status': StatusCodes['success'], 'results': single_flight.stats()}
+    return flask.jsonify(response)
+
+
 ##########################################################
 ## MAIN
 ##########################################################
 if __name__ == "__main__":
 
-    # Set up the logging
-    logging.basicConfig(filename="logs/log_file.log")
-    logger = logging.getLogger('logger')
-    logger.setLevel(logging.DEBUG)
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
-
-    # create formatter
-    formatter = logging.Formatter('%(asctime)s [%(levelname)s]:  %(message)s', '%H:%M:%S')
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
+    # logging is set up on import (see LOGGING)
 
-    time.sleep(1) # just to let the DB start before this print :-)
+    # development server; see gunicorn.conf.py for the production one (SERVER_MODE=production)
+    wait_for_database(DB_READY_TIMEOUT)
 
     logger.info("\n---------------------------------------------------------------\n" + 
                   "API v1.1 online: http://localhost:8080/users/\n\n")
@@ -0,0 +1,46 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Production server configuration
+##
+## gunicorn -c gunicorn.conf.py demo-proj:app
+##
+## Pre-forks one worker process per CPU, each serving requests from a few
+## threads (the endpoints spend most of their time waiting on PostgreSQL).
+## Every worker opens its own connection pool after the fork and only starts
+## accepting requests once the database answers. Workers are recycled after
+## max_requests requests, and a HUP signal restarts them gracefully.
+
+import multiprocessing, os, sys
+
+bind = os.environ.get('WEB_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 4))
+
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.environ.get('WEB_MAX_REQUESTS_JITTER', 1000))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+# must stay above DB_READY_TIMEOUT, workers wait for the database before accepting requests
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+
+# import the app in each worker, so HUP reloads the code
+preload_app = False
+
+accesslog = os.environ.get('WEB_ACCESS_LOG')  # e.g. '-' for stdout
+errorlog = '-'
+
+# several processes cannot rotate the same log file, so workers log to the
+# console unless LOG_FILE is set explicitly
+os.environ.setdefault('LOG_FILE', '')
+
+
+def app_module(worker):
+    return sys.modules[worker.app.app_uri.split(':')[0]]
+
+def post_worker_init(worker):
+    app_module(worker).init_worker()
+
+def worker_exit(server, worker):
+    app_module(worker).shutdown_worker()
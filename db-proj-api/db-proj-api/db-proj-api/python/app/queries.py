@@ -0,0 +1,305 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## SQL shared by demo-proj.py and demo-proj-async.py
+##
+## Both apps import the statements and query builders from here, so an
+## endpoint runs the same SQL whichever variant serves it. psycopg2 and
+## psycopg 3 take the same %s / %(name)s placeholders; arrays are passed as
+## Python lists. DDL cannot take parameters, so the {partition}, {start} and
+## {end} fields of PARTITION_STATEMENTS are filled in by each app with its
+## driver's sql.Identifier and sql.Literal.
+
+import re
+
+
+##########################################################
+## USERS
+##########################################################
+
+USERS_QUERY = 'SELECT user_id, username, password, email, role FROM users ORDER BY user_id'
+
+USERS_PAGE_QUERY = 'SELECT user_id, username, password, email, role FROM users WHERE user_id > %s ORDER BY user_id LIMIT %s'
+
+USER_QUERY = 'SELECT * FROM users where username = %s'
+
+ADD_USER_STATEMENT = """
+    WITH new_user AS (
+        INSERT INTO users (username, password, email, role)
+        VALUES (%(username)s, %(password)s, %(email)s, %(role)s)
+        RETURNING user_id, username, role
+    ),
+    seller AS (
+        INSERT INTO sellers (users_user_id, seller_name)
+        SELECT user_id, username FROM new_user WHERE role = 'Seller'
+    ),
+    buyer AS (
+        INSERT INTO buyers (users_user_id, buyer_name)
+        SELECT user_id, username FROM new_user WHERE role = 'Buyer'
+    )
+    SELECT user_id FROM new_user
+"""
+
+UPDATE_CITY_STATEMENT = 'UPDATE users SET city = %s WHERE username = %s'
+
+
+##########################################################
+## AUCTIONS
+##########################################################
+
+CREATE_AUCTION_STATEMENT = 'INSERT INTO auctions (title, description, end_time, status) VALUES (%s, %s, %s, %s) RETURNING auction_id, end_time'
+
+OPEN_AUCTIONS_QUERY = "SELECT auction_id, title, description, end_time, status FROM auctions WHERE status = 'open' ORDER BY auction_id"
+
+# 'open' stays a literal, so the prepared plan can use the open-auction partial index
+OPEN_AUCTIONS_PAGE_QUERY = "SELECT auction_id, title, description, end_time, status FROM auctions WHERE status = 'open' AND auction_id > %s ORDER BY auction_id LIMIT %s"
+
+AUCTION_EXISTS_QUERY = 'SELECT 1 FROM auctions WHERE auction_id = %s'
+
+ADD_ITEM_STATEMENT = 'INSERT INTO items (item_name, minimum_price, auctions_auction_id, sellers_users_user_id) VALUES (%s, %s, %s, %s) RETURNING item_id'
+
+def prefix_tsquery(text):
+    # 'red la' -> 'red & la:*', words stripped of tsquery operators
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    return ' & '.join(words[:-1] + [words[-1] + ':*'])
+
+def search_query(text, prefix, auction_id, title, description, after, limit):
+    # (sql, values) of one page of results, plus one row to tell if there is a next page
+    conditions = []
+    values = []
+
+    if text:
+        sql_query = 'SELECT auction_id, title, description, end_time, status, ts_rank(search_vector, query.q) AS rank FROM auctions, '
+        if prefix:
+            sql_query += '(SELECT to_tsquery(\'english\', %s) AS q) query'
+            values.append(prefix_tsquery(text) or '')
+        else:
+            sql_query += '(SELECT websearch_to_tsquery(\'english\', %s) AS q) query'
+            values.append(text)
+        conditions.append('search_vector @@ query.q')
+        order = 'rank DESC, auction_id DESC'
+    else:
+        sql_query = 'SELECT auction_id, title, description, end_time, status, 0 AS rank FROM auctions'
+        order = 'auction_id DESC'
+
+    if auction_id:
+        conditions.append('auction_id = %s')
+        values.append(auction_id)
+    if title:
+        conditions.append('title ILIKE %s')  # Case-insensitive search using ILIKE, served by the trigram index
+        values.append(f'{title}%' if prefix else f'%{title}%')
+    if description:
+        conditions.append('description ILIKE %s')
+        values.append(f'%{description}%')
+
+    # continue after the last row of the previous page
+    if after is not None and text:
+        conditions.append('(ts_rank(search_vector, query.q), auction_id) < (%s::real, %s)')
+        values.extend(after)
+    elif after is not None:
+        conditions.append('auction_id < %s')
+        values.append(after[1])
+
+    # Join conditions with AND clause, best matches first
+    sql_query += ' WHERE ' + ' AND '.join(conditions) + f' ORDER BY {order} LIMIT %s'
+    values.append(limit + 1)
+
+    return sql_query, values
+
+AUCTION_SUMMARY_QUERY = ('SELECT a.auction_id, a.title, a.status, a.end_time, a.current_bid, a.current_bidder_id, coalesce(s.bid_count, 0), s.last_bid_time '
+                         'FROM auctions a LEFT JOIN auction_summary s ON s.auction_id = a.auction_id WHERE a.auction_id = %s')
+
+TOP_AUCTIONS_QUERY = ('SELECT a.auction_id, a.title, a.status, a.end_time, a.current_bid, a.current_bidder_id, s.bid_count, s.last_bid_time '
+                      'FROM auction_summary s JOIN auctions a ON a.auction_id = s.auction_id '
+                      "WHERE a.status = 'open' ORDER BY s.bid_count DESC, s.auction_id DESC LIMIT %s")
+
+# the bids still in bids, then the packed ones (see PACK_STATEMENT)
+AUCTION_BIDS_QUERY = """
+    SELECT bid_id, bid_amount, bid_time, buyers_users_user_id, items_item_id FROM bids
+    WHERE auctions_auction_id = %(auction_id)s AND bid_id > %(after)s
+    UNION ALL
+    SELECT b.bid_id, b.bid_amount, b.bid_time, b.buyer_id, b.item_id
+    FROM bids_archive_packed p, unnest(p.bid_ids, p.bid_amounts, p.bid_times, p.buyer_ids, p.item_ids) AS b (bid_id, bid_amount, bid_time, buyer_id, item_id)
+    WHERE p.auction_id = %(auction_id)s AND b.bid_id > %(after)s
+    ORDER BY bid_id LIMIT %(limit)s
+"""
+
+CLOSE_AUCTION_STATEMENT = """
+    WITH auction AS (
+        SELECT auction_id, end_time, status FROM auctions WHERE auction_id = %(auction_id)s
+    ),
+    closed AS (
+        UPDATE auctions a
+        SET status = 'closed', winner_user_id = a.current_bidder_id, winning_amount = a.current_bid
+        FROM auction
+        WHERE a.auction_id = auction.auction_id AND a.status = 'open' AND auction.end_time < %(now)s
+        RETURNING a.auction_id
+    )
+    SELECT EXISTS (SELECT 1 FROM closed), auction.status FROM auction
+"""
+
+CANCEL_AUCTION_STATEMENT = """
+    WITH cancelled AS (
+        UPDATE auctions SET status = 'cancelled' WHERE auction_id = %(auction_id)s
+    ),
+    notified AS (
+        INSERT INTO notification_outbox (message_content, notification_type, sender_user_id, receiver_user_id)
+        SELECT DISTINCT %(message)s::varchar, 'Auction Cancelled'::varchar, NULL::bigint, buyers_users_user_id
+        FROM bids WHERE auctions_auction_id = %(auction_id)s AND NOT archived
+        RETURNING receiver_user_id
+    )
+    SELECT count(*) FROM notified
+"""
+
+EXPIRE_STATEMENT = ("UPDATE auctions SET status = 'closed', winner_user_id = current_bidder_id, winning_amount = current_bid "
+                    "WHERE status = 'open' AND end_time <= %s RETURNING auction_id")
+
+# the open auctions ending before a horizon (demo-proj.py keeps them in a heap)
+EXPIRING_AUCTIONS_QUERY = "SELECT end_time, auction_id FROM auctions WHERE status = 'open' AND end_time <= %s"
+
+# the next one to end (demo-proj-async.py sleeps until then)
+NEXT_END_TIME_QUERY = "SELECT min(end_time) FROM auctions WHERE status = 'open'"
+
+
+##########################################################
+## BIDS
+##########################################################
+
+# the text of an outbid notification, from previous_bid and auction_id
+# columns: the same for a single bid and a batch, amounts with two decimals
+OUTBID_MESSAGE = "format('Your bid of $%%s has been outbid in auction %%s', to_char(previous_bid, 'FM999999999990.00'), auction_id)"
+
+PLACE_BID_STATEMENT = f"""
+    WITH bid AS (
+        UPDATE auctions a
+        SET current_bid = %(bid_amount)s, current_bidder_id = %(buyer_id)s
+        FROM (SELECT auction_id, current_bid, current_bidder_id
+              FROM auctions WHERE auction_id = %(auction_id)s FOR UPDATE) prev
+        WHERE a.auction_id = prev.auction_id
+          AND a.status = 'open'
+          AND (prev.current_bid IS NULL OR %(bid_amount)s > prev.current_bid)
+        RETURNING a.auction_id, prev.current_bid AS previous_bid, prev.current_bidder_id AS previous_bidder_id
+    ),
+    new_bid AS (
+        INSERT INTO bids (bid_amount, bid_time, items_item_id, auctions_auction_id, buyers_users_user_id)
+        SELECT %(bid_amount)s, NOW(), %(item_id)s, auction_id, %(buyer_id)s FROM bid
+        RETURNING bid_id
+    ),
+    summary AS (
+        INSERT INTO auction_summary (auction_id, bid_count, last_bid_time)
+        SELECT auction_id, 1, NOW() FROM bid
+        ON CONFLICT (auction_id) DO UPDATE SET bid_count = auction_summary.bid_count + 1, last_bid_time = EXCLUDED.last_bid_time
+    ),
+    outbid AS (
+        INSERT INTO notification_outbox (message_content, notification_type, sender_user_id, receiver_user_id)
+        SELECT {OUTBID_MESSAGE}, 'Outbid', %(buyer_id)s, previous_bidder_id
+        FROM bid
+        WHERE previous_bidder_id IS NOT NULL AND previous_bidder_id <> %(buyer_id)s
+    )
+    SELECT a.status, a.current_bid, (SELECT bid_id FROM new_bid), bid.previous_bidder_id
+    FROM auctions a LEFT JOIN bid ON true
+    WHERE a.auction_id = %(auction_id)s
+"""
+
+# the auctions of a batch, locked in a fixed order so concurrent batches cannot deadlock
+BATCH_LOCK_QUERY = 'SELECT auction_id, status, current_bid, current_bidder_id FROM auctions WHERE auction_id = ANY(%s) ORDER BY auction_id FOR UPDATE'
+
+# the multi-row writes of a batch, one array per column
+BATCH_STATEMENTS = {
+    'bids': 'INSERT INTO bids (bid_amount, bid_time, items_item_id, auctions_auction_id, buyers_users_user_id) '
+            'SELECT amount, NOW(), item_id, auction_id, buyer_id FROM unnest(%s::float8[], %s::integer[], %s::integer[], %s::bigint[]) AS v (amount, item_id, auction_id, buyer_id) '
+            'RETURNING bid_id',
+    'auctions': 'UPDATE auctions SET current_bid = v.current_bid, current_bidder_id = v.current_bidder_id '
+                'FROM unnest(%s::integer[], %s::float8[], %s::bigint[]) AS v (auction_id, current_bid, current_bidder_id) WHERE auctions.auction_id = v.auction_id',
+    'summary': 'INSERT INTO auction_summary (auction_id, bid_count, last_bid_time) SELECT auction_id, bids, NOW() FROM unnest(%s::integer[], %s::bigint[]) AS v (auction_id, bids) '
+               'ON CONFLICT (auction_id) DO UPDATE SET bid_count = auction_summary.bid_count + EXCLUDED.bid_count, last_bid_time = EXCLUDED.last_bid_time',
+    'outbid': 'INSERT INTO notification_outbox (message_content, notification_type, sender_user_id, receiver_user_id) '
+              f"SELECT {OUTBID_MESSAGE}, 'Outbid', sender_user_id, receiver_user_id "
+              'FROM unnest(%s::float8[], %s::integer[], %s::bigint[], %s::bigint[]) AS v (previous_bid, auction_id, sender_user_id, receiver_user_id)'
+}
+
+
+##########################################################
+## BACKGROUND JOBS
+##########################################################
+
+DISPATCH_LOCK_ID = 3160
+MAINTENANCE_LOCK_ID = 3161
+EVENTS_CHANNEL = 'user_events'
+
+LOCK_STATEMENT = 'SELECT pg_advisory_xact_lock(%s)'
+TRY_LOCK_STATEMENT = 'SELECT pg_try_advisory_xact_lock(%s)'
+
+DISPATCH_STATEMENT = """
+    WITH batch AS (
+        DELETE FROM notification_outbox
+        WHERE outbox_id IN (SELECT outbox_id FROM notification_outbox ORDER BY outbox_id LIMIT %s FOR UPDATE SKIP LOCKED)
+        RETURNING message_content, notification_type, sender_user_id, receiver_user_id, created_at
+    ),
+    inserted AS (
+        INSERT INTO notifications (message_content, notification_type, sender_user_id, receiver_user_id, notification_time, users_user_id)
+        SELECT message_content, notification_type, sender_user_id, receiver_user_id, created_at, receiver_user_id FROM batch
+        RETURNING receiver_user_id
+    )
+    SELECT count(*) FROM inserted, pg_notify(%s, inserted.receiver_user_id::text)
+"""
+
+ARCHIVE_STATEMENT = """
+    WITH finished AS (
+        SELECT DISTINCT b.auctions_auction_id AS auction_id
+        FROM bids_live b JOIN auctions a ON a.auction_id = b.auctions_auction_id
+        WHERE a.status IN ('closed', 'cancelled')
+        LIMIT %s
+    ),
+    moved AS (
+        UPDATE bids SET archived = true
+        WHERE NOT archived AND auctions_auction_id IN (SELECT auction_id FROM finished)
+        RETURNING auctions_auction_id
+    )
+    SELECT count(DISTINCT auctions_auction_id), count(*) FROM moved
+"""
+
+# the bids of up to %s archived auctions out of bids_archive into one
+# compressed row per auction (migrations/0007), appended to the auction's row
+# if it has one already
+PACK_STATEMENT = """
+    WITH archived AS (
+        SELECT DISTINCT auctions_auction_id AS auction_id FROM bids_archive LIMIT %s
+    ),
+    moved AS (
+        DELETE FROM bids_archive
+        WHERE auctions_auction_id IN (SELECT auction_id FROM archived)
+        RETURNING bid_id, bid_amount, bid_time, items_item_id, buyers_users_user_id, auctions_auction_id
+    ),
+    packed AS (
+        INSERT INTO bids_archive_packed (auction_id, bid_ids, bid_amounts, bid_times, item_ids, buyer_ids)
+        SELECT auctions_auction_id, array_agg(bid_id ORDER BY bid_id), array_agg(bid_amount ORDER BY bid_id), array_agg(bid_time ORDER BY bid_id),
+               array_agg(items_item_id ORDER BY bid_id), array_agg(buyers_users_user_id ORDER BY bid_id)
+        FROM moved GROUP BY auctions_auction_id
+        ON CONFLICT (auction_id) DO UPDATE SET
+            bid_ids = bids_archive_packed.bid_ids || EXCLUDED.bid_ids,
+            bid_amounts = bids_archive_packed.bid_amounts || EXCLUDED.bid_amounts,
+            bid_times = bids_archive_packed.bid_times || EXCLUDED.bid_times,
+            item_ids = bids_archive_packed.item_ids || EXCLUDED.item_ids,
+            buyer_ids = bids_archive_packed.buyer_ids || EXCLUDED.buyer_ids
+    )
+    SELECT count(DISTINCT auctions_auction_id), count(*) FROM moved
+"""
+
+PARTITIONS_QUERY = "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'notifications'::regclass"
+
+# rows that arrived before their month had a partition
+UNPARTITIONED_MONTHS_QUERY = "SELECT DISTINCT date_trunc('month', notification_time) FROM notifications_default"
+
+# checked again under MAINTENANCE_LOCK_ID, another process may have created it since PARTITIONS_QUERY
+PARTITION_EXISTS_QUERY = 'SELECT to_regclass(%s) IS NOT NULL'
+
+PARTITION_STATEMENTS = [
+    'CREATE TABLE {partition} (LIKE notifications INCLUDING DEFAULTS)',
+    'WITH moved AS (DELETE FROM notifications_default WHERE notification_time >= {start} AND notification_time < {end} RETURNING *) '
+    'INSERT INTO {partition} SELECT * FROM moved',
+    'ALTER TABLE notifications ATTACH PARTITION {partition} FOR VALUES FROM ({start}) TO ({end})'
+]
@@ -0,0 +1,109 @@
+## ITCS 3160-0002, Spring 2024
+## Marco Vieira, marco.vieira@charlotte.edu
+## University of North Carolina at Charlotte
+
+## Fixtures of the API tests
+##
+##   pip install pytest
+##   python -m pytest python/tests
+##
+## The apps are loaded from python/app with the background jobs and the
+## response cache turned off, so nothing changes the database behind a test;
+## the tests of those pieces start their own. The unit tests need no
+## database. The endpoint and contract tests run against the database of DB_HOST,
+## DB_PORT and DB_NAME (the app settings; with the compose setup, DB_HOST=
+## localhost) and are skipped when it cannot be reached. The contract tests
+## also need the packages of demo-proj-async.py.
+
+import asyncio, importlib.util, os, sys, time, uuid
+
+import psycopg2
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+sys.path.insert(0, APP_DIR)
+
+for name, value in (('LOG_FILE', ''), ('EXPIRY_SCHEDULER', 'off'), ('NOTIFICATION_DISPATCHER', 'off'), ('MAINTENANCE_JOB', 'off'),
+                    ('CACHE_BACKEND', 'off'), ('DB_READY_TIMEOUT', '2')):
+    os.environ.setdefault(name, value)
+
+
+def load_app(filename, module_name):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(APP_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope='session')
+def app():
+    return load_app('demo-proj.py', 'demo_proj')
+
+
+@pytest.fixture(scope='session')
+def async_app():
+    for package in ('quart', 'psycopg', 'psycopg_pool'):
+        pytest.importorskip(package)
+    return load_app('demo-proj-async.py', 'demo_proj_async')
+
+
+@pytest.fixture(scope='session')
+def database(app):
+    # an autocommit connection for setting up and checking the data
+    try:
+        conn = psycopg2.connect(connect_timeout=2, **app.DB_CONFIG)
+    except psycopg2.OperationalError as error:
+        pytest.skip(f'database not available: {error}')
+    conn.autocommit = True
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def client(app, database):
+    return app.app.test_client()
+
+
+class AsyncClient:
+    # the test client of demo-proj-async.py, driven from synchronous tests on
+    # one event loop (the pool opened by start_serving belongs to it)
+
+    def __init__(self, app):
+        self.loop = asyncio.new_event_loop()
+        self.test_app = app.test_app()
+        self.loop.run_until_complete(self.test_app.__aenter__())
+        self.client = self.test_app.test_client()
+
+    def open(self, path, method='GET', json=None):
+        async def request():
+            response = await self.client.open(path, method=method, json=json)
+            return response.status_code, await response.get_json()
+        return self.loop.run_until_complete(request())
+
+    def close(self):
+        self.loop.run_until_complete(self.test_app.__aexit__(None, None, None))
+        self.loop.close()
+
+
+@pytest.fixture(scope='session')
+def async_client(async_app, database):
+    client = AsyncClient(async_app.app)
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def tag():
+    # a suffix that keeps the users and auctions of a test apart
+    return uuid.uuid4().hex[:8]
+
+
+@pytest.fixture
+def wait_until():
+    # polls condition() until it is true, for what background threads do
+    def wait(condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            assert time.monotonic() < deadline, 'timed out'
+            time.sleep(0.01)
+    return wait
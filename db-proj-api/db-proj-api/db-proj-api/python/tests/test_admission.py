@@ -0,0 +1,119 @@
+## AdmissionController and SingleFlight of demo-proj.py, and how the two
+## meet on a coalesced route
+
+import threading, time
+
+import pytest
+
+
+def test_requests_over_the_limit_wait_for_a_slot(app):
+    controller = app.AdmissionController({'place_bid': 1}, 8, 4, 5)
+    assert controller.acquire('place_bid') is None
+    threading.Timer(0.1, controller.release, ('place_bid',)).start()
+
+    assert controller.acquire('place_bid') is None
+    stats = controller.stats()['place_bid']
+    assert (stats['admitted'], stats['queued'], stats['active']) == (2, 1, 1)
+
+
+def test_requests_are_shed_when_the_queue_is_full(app):
+    controller = app.AdmissionController({'place_bid': 1}, 8, 0, 5)
+    controller.acquire('place_bid')
+
+    assert controller.acquire('place_bid') == 'queue_full'
+    assert controller.stats()['place_bid']['shed_queue_full'] == 1
+
+
+def test_requests_are_shed_when_their_wait_runs_out(app):
+    controller = app.AdmissionController({'place_bid': 1}, 8, 4, 0.05)
+    controller.acquire('place_bid')
+
+    assert controller.acquire('place_bid') == 'deadline'
+    stats = controller.stats()['place_bid']
+    assert (stats['shed_deadline'], stats['waiting'], stats['active']) == (1, 0, 1)
+
+
+def test_default_limit_and_unlimited_endpoints(app):
+    controller = app.AdmissionController({'get_user': 0}, 2, 0, 5)
+
+    assert [controller.acquire('get_user') for _ in range(5)] == [None] * 5
+    assert [controller.acquire('add_users') for _ in range(3)] == [None, None, 'queue_full']
+    assert list(controller.stats()) == ['add_users']
+
+
+def test_identical_calls_share_one_execution(app, wait_until):
+    flight = app.SingleFlight()
+    started, finish = threading.Event(), threading.Event()
+    results = []
+
+    def fn():
+        started.set()
+        finish.wait(5)
+        return object()
+
+    def call():
+        results.append(flight.do('get_user', 'key', fn))
+
+    threads = [threading.Thread(target=call)]
+    threads[0].start()
+    started.wait(5)
+    threads += [threading.Thread(target=call) for _ in range(3)]
+    for thread in threads[1:]:
+        thread.start()
+    wait_until(lambda: flight.stats()['get_user']['coalesced'] == 3)
+    finish.set()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(leader for leader, _ in results) == [False, False, False, True]
+    assert len({id(result) for _, result in results}) == 1
+    assert flight.stats() == {'get_user': {'executed': 1, 'coalesced': 3}}
+
+
+def test_an_error_is_raised_once_and_not_remembered(app):
+    flight = app.SingleFlight()
+
+    def fail():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        flight.do('get_user', 'key', fail)
+    assert flight.do('get_user', 'key', lambda: 'ok') == (True, 'ok')
+    assert flight.stats()['get_user']['executed'] == 2
+
+
+def test_only_the_request_running_a_coalesced_view_is_admitted(app, client, tag, monkeypatch):
+    # one slot and no queue: any follower that asked for a slot would be shed
+    username = f'poller {tag}'
+    client.post('/users/', json={'username': username, 'role': 'Buyer'})
+    monkeypatch.setattr(app, 'admission_controller', app.AdmissionController({'get_user': 1}, 8, 0, 5))
+    before = app.single_flight.stats().get('get_user', {'executed': 0, 'coalesced': 0})
+
+    admitted = []
+    admit = app.admit
+
+    def slow_admit(endpoint):
+        # keeps the leader in flight while the others arrive
+        admitted.append(endpoint)
+        response = admit(endpoint)
+        time.sleep(0.3)
+        return response
+
+    monkeypatch.setattr(app, 'admit', slow_admit)
+
+    statuses = []
+    def poll():
+        statuses.append(app.app.test_client().get(f'/users/{username}/').status_code)
+
+    threads = [threading.Thread(target=poll) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    after = app.single_flight.stats()['get_user']
+    assert statuses == [200] * 5
+    assert after['executed'] - before['executed'] == len(admitted)
+    assert after['coalesced'] - before['coalesced'] == 5 - len(admitted)
+    assert len(admitted) < 5, admitted
+    assert app.admission_controller.stats()['get_user']['shed_queue_full'] == 0
@@ -0,0 +1,51 @@
+## PUT /auctions/close/<id>/ on auctions that cannot be closed
+
+import pytest
+
+
+@pytest.fixture
+def ended(client, database, tag):
+    # an open auction whose end time has passed, with one bid
+    client.post('/users/', json={'username': f'bidder {tag}', 'role': 'Buyer'})
+    client.post('/users/', json={'username': f'seller {tag}', 'role': 'Seller'})
+    buyer = client.get(f'/users/bidder {tag}/').get_json()['results']['user_id']
+    seller = client.get(f'/users/seller {tag}/').get_json()['results']['user_id']
+    auction_id = client.post('/auctions/', json={'title': f'ended {tag}', 'description': 'old', 'end_time': '2030-01-01 00:00:00', 'status': 'open'}).get_json()['results']['auction_id']
+    item_id = client.post('/auctions/add_item', json={'auction_id': auction_id, 'item_name': 'lamp', 'minimum_price': 1, 'sellers_user_id': seller}).get_json()['item_id']
+    client.post('/auctions/bid', json={'auctions_auction_id': auction_id, 'items_item_id': item_id, 'buyers_user_id': buyer, 'bid_amount': 10})
+    database.cursor().execute("UPDATE auctions SET end_time = '2020-01-01' WHERE auction_id = %s", (auction_id,))
+    return auction_id, buyer
+
+
+def winner(database, auction_id):
+    cur = database.cursor()
+    cur.execute('SELECT status, winner_user_id, winning_amount FROM auctions WHERE auction_id = %s', (auction_id,))
+    return cur.fetchone()
+
+
+def test_closing_an_auction_that_does_not_exist_is_an_error(client):
+    assert client.put('/auctions/close/999999999/').get_json() == {'status': 400, 'results': 'Auction 999999999 does not exist'}
+
+
+def test_an_auction_is_closed_once(client, database, ended):
+    auction_id, buyer = ended
+
+    assert client.put(f'/auctions/close/{auction_id}/').get_json()['status'] == 200
+    assert winner(database, auction_id) == ('closed', buyer, 10)
+    assert client.put(f'/auctions/close/{auction_id}/').get_json() == {'status': 400, 'results': f'Auction {auction_id} is not open'}
+
+
+def test_a_cancelled_auction_cannot_be_closed(client, database, ended):
+    auction_id, buyer = ended
+    client.put(f'/auctions/cancel/{auction_id}/')
+
+    assert client.put(f'/auctions/close/{auction_id}/').get_json() == {'status': 400, 'results': f'Auction {auction_id} is not open'}
+    assert winner(database, auction_id) == ('cancelled', None, None)
+
+
+def test_an_auction_cannot_be_closed_before_its_end_time(client, database, ended):
+    auction_id, buyer = ended
+    database.cursor().execute("UPDATE auctions SET end_time = '2030-01-01' WHERE auction_id = %s", (auction_id,))
+
+    assert client.put(f'/auctions/close/{auction_id}/').get_json() == {'status': 400, 'results': 'Auction cannot be closed yet'}
+    assert winner(database, auction_id) == ('open', None, None)
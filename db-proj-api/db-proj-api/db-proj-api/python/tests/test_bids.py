@@ -0,0 +1,68 @@
+## Bids through POST /auctions/bid and POST /auctions/bids/batch
+
+
+def create_auction(client, database, tag):
+    cur = database.cursor()
+    users = []
+    for role in ('Buyer', 'Buyer', 'Seller'):
+        username = f'{role} {len(users)} {tag}'
+        client.post('/users/', json={'username': username, 'role': role})
+        users.append(client.get(f'/users/{username}/').get_json()['results']['user_id'])
+    auction = client.post('/auctions/', json={'title': f'lamp {tag}', 'description': 'red lamp', 'end_time': '2030-01-01 00:00:00', 'status': 'open'})
+    auction_id = auction.get_json()['results']['auction_id']
+    item = client.post('/auctions/add_item', json={'auction_id': auction_id, 'item_name': 'lamp', 'minimum_price': 1, 'sellers_user_id': users[2]})
+    cur.close()
+    return auction_id, item.get_json()['item_id'], users[0], users[1]
+
+
+def outbid_messages(database, user_id):
+    # still in the outbox, the dispatcher is off in the tests
+    cur = database.cursor()
+    cur.execute("SELECT message_content FROM notification_outbox WHERE receiver_user_id = %s AND notification_type = 'Outbid' ORDER BY outbox_id", (user_id,))
+    return [row[0] for row in cur.fetchall()]
+
+
+def test_outbid_message_is_the_same_for_single_and_batched_bids(client, database, tag):
+    auction_id, item_id, buyer, rival = create_auction(client, database, tag)
+    bid = {'auctions_auction_id': auction_id, 'items_item_id': item_id}
+
+    client.post('/auctions/bid', json=dict(bid, bid_amount=12, buyers_user_id=buyer))
+    client.post('/auctions/bid', json=dict(bid, bid_amount=13, buyers_user_id=rival))
+    client.post('/auctions/bids/batch', json={'bids': [dict(bid, bid_amount=14, buyers_user_id=buyer), dict(bid, bid_amount=14.5, buyers_user_id=rival)]})
+
+    assert outbid_messages(database, buyer) == [f'Your bid of $12.00 has been outbid in auction {auction_id}',
+                                                f'Your bid of $14.00 has been outbid in auction {auction_id}']
+    assert outbid_messages(database, rival) == [f'Your bid of $13.00 has been outbid in auction {auction_id}']
+
+
+def test_batch_rejects_ids_that_are_not_integers(client, database, tag):
+    auction_id, item_id, buyer, rival = create_auction(client, database, tag)
+    bid = {'auctions_auction_id': auction_id, 'items_item_id': item_id, 'buyers_user_id': buyer, 'bid_amount': 10}
+
+    response = client.post('/auctions/bids/batch', json=[dict(bid, auctions_auction_id=str(auction_id)), dict(bid, buyers_user_id=True), bid])
+    body = response.get_json()
+
+    assert body['status'] == 200
+    assert [result['status'] for result in body['results']] == ['rejected', 'rejected', 'accepted']
+    assert body['results'][0]['reason'] == 'auctions_auction_id, buyers_user_id and items_item_id must be integers'
+
+
+def test_history_is_kept_when_the_bids_are_archived_and_packed(app, client, database, tag):
+    auction_id, item_id, buyer, rival = create_auction(client, database, tag)
+    bid = {'auctions_auction_id': auction_id, 'items_item_id': item_id}
+    for amount, user in ((10, buyer), (11, rival), (12.5, buyer)):
+        client.post('/auctions/bid', json=dict(bid, bid_amount=amount, buyers_user_id=user))
+    client.put(f'/auctions/cancel/{auction_id}/')
+    history = client.get(f'/auctions/{auction_id}/bids').get_json()
+    page = client.get(f'/auctions/{auction_id}/bids?limit=2').get_json()
+
+    app.maintenance_job.run()
+
+    cur = database.cursor()
+    cur.execute('SELECT bid_amounts FROM bids_archive_packed WHERE auction_id = %s', (auction_id,))
+    assert cur.fetchone()[0] == [10, 11, 12.5]
+    cur.execute('SELECT count(*) FROM bids WHERE auctions_auction_id = %s', (auction_id,))
+    assert cur.fetchone()[0] == 0
+    assert client.get(f'/auctions/{auction_id}/bids').get_json() == history
+    assert client.get(f'/auctions/{auction_id}/bids?limit=2').get_json() == page
+    assert client.get(f'/auctions/{auction_id}/bids?after={page["next_after"]}').get_json()['results'] == history['results'][2:]
@@ -0,0 +1,147 @@
+## LocalCache, the replica a cache miss is read from, and the invalidations
+## CacheBroadcaster sends between processes
+
+import json, select, time
+
+import flask
+import psycopg2
+import pytest
+
+
+def test_entries_are_kept_until_they_expire(app):
+    cache = app.LocalCache(10, 0.05)
+    generation, value = cache.lookup('users', 'bob')
+    assert (generation, value) == (0, None)
+    cache.store('users', generation, 'bob', b'{}')
+
+    assert cache.lookup('users', 'bob') == (0, b'{}')
+    time.sleep(0.1)
+    assert cache.lookup('users', 'bob') == (0, None)
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['expirations'], stats['entries']) == (1, 2, 1, 0)
+
+
+def test_the_least_recently_used_entry_is_evicted(app):
+    cache = app.LocalCache(2, 60)
+    cache.store('users', 0, 'a', 'a')
+    cache.store('users', 0, 'b', 'b')
+    cache.lookup('users', 'a')
+    cache.store('users', 0, 'c', 'c')
+
+    assert [cache.lookup('users', key)[1] for key in ('a', 'b', 'c')] == ['a', None, 'c']
+    assert cache.stats()['evictions'] == 1
+
+
+def test_a_read_from_before_an_invalidation_is_not_stored(app):
+    cache = app.LocalCache(10, 60)
+    cache.store('auctions', 0, 'list', 'old')
+    generation, _ = cache.lookup('auctions', 'other')
+    cache.invalidate('auctions')
+    cache.store('auctions', generation, 'other', 'stale')
+
+    assert cache.lookup('auctions', 'list') == (1, None)
+    assert cache.lookup('auctions', 'other') == (1, None)
+
+
+def test_delete_drops_one_entry(app):
+    cache = app.LocalCache(10, 60)
+    cache.store('auction', 0, '7|json', 'seven')
+    cache.store('auction', 0, '8|json', 'eight')
+    cache.delete('auction', '7|json')
+
+    assert cache.lookup('auction', '7|json')[1] is None
+    assert cache.lookup('auction', '8|json')[1] == 'eight'
+
+
+class FakePool:
+
+    def __init__(self):
+        self.conn = object()
+
+    def getconn(self):
+        return self.conn
+
+    def putconn(self, conn):
+        pass
+
+    def stats(self):
+        return {'in_use': 0}
+
+
+def replica_for(app, replicas, cache_entry):
+    # where replicas sends a read from inside a request, None for the primary
+    with app.app.test_request_context('/users/bob/'):
+        if cache_entry is not None:
+            flask.g.cache_generation = 0
+            flask.g.cache_entry = cache_entry
+        conn = replicas.connection()
+        return None if conn is None else conn._conn
+
+
+@pytest.fixture
+def replicas(app):
+    replicas = app.ReplicaSet(['replica-1'], 10, 5)
+    replica = replicas.replicas[0]
+    replica.healthy, replica.pool, replica.lag = True, FakePool(), 0
+    return replicas
+
+
+def test_cache_misses_are_read_from_a_replica_in_sync(app, replicas):
+    replica = replicas.replicas[0]
+    replicas.invalidated('users', 'bob')
+    replica.synced_at = time.monotonic()
+
+    assert replica_for(app, replicas, ('users', 'bob')) is replica.pool.conn
+    assert replica_for(app, replicas, None) is replica.pool.conn
+
+
+def test_cache_misses_go_to_the_primary_until_the_replica_has_the_write(app, replicas):
+    replica = replicas.replicas[0]
+    replica.synced_at = time.monotonic()
+    replicas.invalidated('users', 'bob')
+
+    assert replica_for(app, replicas, ('users', 'bob')) is None
+    assert replica_for(app, replicas, ('users', 'alice')) is replica.pool.conn
+    replicas.invalidated('users')
+    assert replica_for(app, replicas, ('users', 'alice')) is None
+    # reads that are not stored do not wait for the replica
+    assert replica_for(app, replicas, None) is replica.pool.conn
+
+
+@pytest.fixture
+def broadcaster(app, database, monkeypatch, wait_until):
+    # a listening broadcaster for this process's local cache
+    cache = app.LocalCache(100, 60)
+    monkeypatch.setattr(app, 'response_cache', cache)
+    broadcaster = app.CacheBroadcaster(0.2, 0.1)
+    broadcaster.start()
+    # it invalidates everything once it is listening
+    wait_until(lambda: cache.lookup('users', 'any')[0] > 0)
+    return broadcaster, cache
+
+
+def test_invalidations_from_other_processes_are_applied(app, database, broadcaster, wait_until):
+    broadcaster, cache = broadcaster
+    cache.store('auction', cache.lookup('auction', '7|json')[0], '7|json', 'seven')
+    generation = cache.lookup('auctions', 'list')[0]
+
+    database.cursor().execute('SELECT pg_notify(%s, %s)', (app.CACHE_CHANNEL, json.dumps([['auction', 7], ['auctions', None]])))
+
+    wait_until(lambda: cache.lookup('auction', '7|json')[1] is None and cache.lookup('auctions', 'list')[0] > generation)
+    assert broadcaster.stats()['received'] == 2
+
+
+def test_invalidations_are_sent_to_other_processes(app, database, broadcaster, wait_until):
+    broadcaster, cache = broadcaster
+    listener = psycopg2.connect(**app.DB_CONFIG)
+    try:
+        listener.autocommit = True
+        listener.cursor().execute(f'LISTEN {app.CACHE_CHANNEL}')
+
+        broadcaster.publish('users', 'bob')
+        assert select.select([listener], [], [], 5)[0]
+        listener.poll()
+        assert [json.loads(notify.payload) for notify in listener.notifies] == [[['users', 'bob']]]
+        wait_until(lambda: broadcaster.stats()['sent'] == 1)
+    finally:
+        listener.close()
@@ -0,0 +1,151 @@
+## The same requests sent to demo-proj.py and demo-proj-async.py must get the
+## same responses. The write flow runs once per app on its own users and
+## auction, so the ids, the tag in the names and the bid times are replaced
+## by placeholders before comparing; error texts come from two different
+## drivers and only their presence is compared.
+
+import re
+
+import pytest
+
+# the kind of id under each key (the write flow pages through bids only);
+# only auction ids appear in messages and paths
+ID_KINDS = {'user_id': 'user', 'outbid_user_id': 'user', 'leader_user_id': 'user', 'buyer_user_id': 'user',
+            'auction_id': 'auction', 'item_id': 'item', 'bid_id': 'bid', 'next_after': 'bid'}
+TIME_KEYS = ('bid_time', 'last_bid_time')
+
+
+class Run:
+    # the responses of one app, with the ids it handed out named in order
+
+    def __init__(self, request, tag):
+        self.request = request
+        self.tag = tag
+        self.names = {kind: {} for kind in set(ID_KINDS.values())}
+        self.responses = []
+
+    def __call__(self, method, path, json=None):
+        status, body = self.request(method, path, json)
+        self._name_ids(body)
+        self.responses.append((method, self.normalize(path), status, self.normalize(body)))
+        return body
+
+    def _name_ids(self, value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                names = self.names.get(ID_KINDS.get(key))
+                if names is not None and isinstance(item, int) and item not in names:
+                    names[item] = f'<{ID_KINDS[key]} {len(names)}>'
+                self._name_ids(item)
+        elif isinstance(value, list):
+            for item in value:
+                self._name_ids(item)
+
+    def normalize(self, value, key=None):
+        if key == 'errors':
+            return '<error>'
+        if key in TIME_KEYS and value is not None:
+            return '<time>'
+        if key in ID_KINDS and isinstance(value, int):
+            return self.names[ID_KINDS[key]].get(value, value)
+        if isinstance(value, dict):
+            return {key: self.normalize(item, key) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.normalize(item) for item in value]
+        if isinstance(value, str):
+            value = value.replace(self.tag, '<tag>')
+            for auction_id, name in self.names['auction'].items():
+                value = re.sub(rf'\b{auction_id}\b', name, value)
+        return value
+
+
+@pytest.fixture
+def requests(client, async_client):
+    def sync_request(method, path, json=None):
+        response = client.open(path, method=method, json=json)
+        return response.status_code, response.get_json()
+
+    def async_request(method, path, json=None):
+        return async_client.open(path, method=method, json=json)
+
+    return sync_request, async_request
+
+
+def write_flow(call, tag):
+    call('POST', '/users/', {'username': f'buyer {tag}', 'role': 'Buyer'})
+    call('POST', '/users/', {'username': f'rival {tag}', 'role': 'Buyer'})
+    call('POST', '/users/', {'username': f'seller {tag}', 'role': 'Seller'})
+    call('POST', '/users/', {'username': f'buyer {tag}', 'role': 'Buyer'})
+    call('POST', '/users/', {'role': 'Buyer'})
+    call('PUT', f'/users/buyer {tag}', {'city': 'Charlotte'})
+    call('PUT', f'/users/buyer {tag}', {})
+    buyer = call('GET', f'/users/buyer {tag}/')['results']['user_id']
+    rival = call('GET', f'/users/rival {tag}/')['results']['user_id']
+    seller = call('GET', f'/users/seller {tag}/')['results']['user_id']
+
+    auction = call('POST', '/auctions/', {'title': f'lamp {tag}', 'description': 'red lamp', 'end_time': '2030-01-01 00:00:00', 'status': 'open'})['results']['auction_id']
+    call('POST', '/auctions/', {'title': f'lamp {tag}'})
+    item = call('POST', '/auctions/add_item', {'auction_id': auction, 'item_name': 'lamp', 'minimum_price': 1, 'sellers_user_id': seller})['item_id']
+    call('POST', '/auctions/add_item', {'auction_id': auction})
+
+    bid = {'auctions_auction_id': auction, 'buyers_user_id': buyer, 'items_item_id': item}
+    call('POST', '/auctions/bid', dict(bid, bid_amount=10))
+    call('POST', '/auctions/bid', dict(bid, bid_amount=5))
+    call('POST', '/auctions/bid', dict(bid, bid_amount=12.5, buyers_user_id=rival))
+    call('POST', '/auctions/bid', dict(bid, auctions_auction_id=999999999, bid_amount=50))
+    call('POST', '/auctions/bid', {'auctions_auction_id': auction})
+    call('POST', '/auctions/bids/batch', {'bids': [dict(bid, bid_amount=20), dict(bid, bid_amount=15, buyers_user_id=rival), dict(bid, bid_amount='x'),
+                                                   dict(bid, bid_amount=30, auctions_auction_id=999999999), dict(bid, bid_amount=25.5, buyers_user_id=rival),
+                                                   dict(bid, bid_amount=26, items_item_id='1')]})
+    call('POST', '/auctions/bids/batch', [])
+    call('GET', f'/auctions/{auction}/summary')
+    call('GET', f'/auctions/{auction}/bids')
+    call('GET', f'/auctions/{auction}/bids?limit=2')
+    call('GET', f'/auctions/search/?q=lamp {tag}')
+
+    call('PUT', f'/auctions/close/{auction}/')
+    call('PUT', f'/auctions/cancel/{auction}/')
+    call('POST', '/auctions/bid', dict(bid, bid_amount=100))
+    call('PUT', f'/auctions/close/{auction}/')
+    ended = call('POST', '/auctions/', {'title': f'ended {tag}', 'description': 'old', 'end_time': '2020-01-01 00:00:00', 'status': 'open'})['results']['auction_id']
+    call('PUT', f'/auctions/close/{ended}/')
+    call('PUT', f'/auctions/close/{ended}/')
+    call('PUT', '/auctions/close/999999999/')
+    call('GET', '/auctions/999999999/summary')
+    call('GET', '/auctions/999999999/bids')
+
+
+def test_writes(requests, tag):
+    sync_run, async_run = Run(requests[0], 'sync' + tag), Run(requests[1], 'async' + tag)
+    write_flow(sync_run, 'sync' + tag)
+    write_flow(async_run, 'async' + tag)
+
+    for expected, actual in zip(sync_run.responses, async_run.responses):
+        assert actual == expected
+    assert len(async_run.responses) == len(sync_run.responses)
+
+
+def test_reads(requests, database, tag):
+    cur = database.cursor()
+    cur.execute("SELECT min(auction_id), min(username) FROM auctions, users")
+    auction, username = cur.fetchone()
+    cur.execute("SELECT title FROM auctions WHERE title ~ '^\\w+' ORDER BY auction_id LIMIT 1")
+    word = re.match(r'\w+', (cur.fetchone() or ('lamp',))[0]).group()
+
+    paths = ['/users/?limit=3', '/users/?after=2&limit=x', '/users/?limit=0', f'/users/{username}/', f'/users/nobody {tag}/',
+             '/auctions/list?limit=5', '/auctions/list?after=x', '/auctions/search/', f'/auctions/search/?q={word}&limit=2',
+             f'/auctions/search/?q={word[:2]}&prefix=true&limit=2', f'/auctions/search/?title={word}&limit=3', '/auctions/search/?title=a&cursor=zz',
+             f'/auctions/{auction}/summary', '/auctions/top?limit=3', '/auctions/top?limit=0', f'/auctions/{auction}/bids?limit=2',
+             f'/auctions/{auction}/bids?limit=-1', '/ready']
+
+    sync_run, async_run = Run(requests[0], tag), Run(requests[1], tag)
+    for path in paths:
+        body = sync_run('GET', path)
+        async_run('GET', path)
+        assert async_run.responses[-1] == sync_run.responses[-1]
+
+        # and the next page of a search
+        if body.get('next_cursor'):
+            sync_run('GET', f'{path}&cursor={body["next_cursor"]}')
+            async_run('GET', f'{path}&cursor={body["next_cursor"]}')
+            assert async_run.responses[-1] == sync_run.responses[-1]
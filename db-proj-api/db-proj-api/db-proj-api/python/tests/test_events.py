@@ -0,0 +1,71 @@
+## NotificationDispatcher and EventBroker: notifications move from the outbox
+## to notifications and wake the streams of their receivers
+
+import os
+
+import pytest
+
+
+def test_subscribers_are_woken_for_their_own_user_only(app):
+    broker = app.EventBroker(15, 5)
+    broker.pid = os.getpid()  # no listening thread
+    alice, bob, bob_again = broker.subscribe(1), broker.subscribe(2), broker.subscribe(2)
+
+    broker._wake({2})
+    assert (alice.is_set(), bob.is_set(), bob_again.is_set()) == (False, True, True)
+    assert broker.stats() == {'notifies': 0, 'wakeups': 2, 'reconnects': 0, 'errors': 0, 'users': 2, 'streams': 3}
+
+    broker.unsubscribe(2, bob)
+    broker.unsubscribe(2, bob_again)
+    broker._wake()
+    assert alice.is_set()
+    assert broker.stats()['users'] == 1
+
+
+@pytest.fixture
+def receiver(client, tag):
+    client.post('/users/', json={'username': f'receiver {tag}', 'role': 'Buyer'})
+    return client.get(f'/users/receiver {tag}/').get_json()['results']['user_id']
+
+
+def queue_notification(database, user_id, message):
+    database.cursor().execute("INSERT INTO notification_outbox (message_content, notification_type, sender_user_id, receiver_user_id) VALUES (%s, 'Outbid', NULL, %s)",
+                              (message, user_id))
+
+
+def test_the_dispatcher_moves_the_outbox_to_notifications(app, database, receiver, tag):
+    queue_notification(database, receiver, f'first {tag}')
+    queue_notification(database, receiver, f'second {tag}')
+    dispatcher = app.NotificationDispatcher(500, 1, 5)
+
+    assert dispatcher.dispatch_batch() >= 2
+    cur = database.cursor()
+    cur.execute('SELECT message_content FROM notifications WHERE receiver_user_id = %s ORDER BY notification_id', (receiver,))
+    assert [row[0] for row in cur.fetchall()] == [f'first {tag}', f'second {tag}']
+    cur.execute('SELECT count(*) FROM notification_outbox WHERE receiver_user_id = %s', (receiver,))
+    assert cur.fetchone()[0] == 0
+    assert dispatcher.stats()['batches'] == 1
+
+
+def test_the_dispatcher_drains_the_outbox_a_batch_at_a_time(app, database, receiver, tag):
+    for n in range(3):
+        queue_notification(database, receiver, f'{n} {tag}')
+    dispatcher = app.NotificationDispatcher(1, 1, 5)
+
+    batches = [dispatcher.dispatch_batch() for _ in range(3)]
+    assert batches == [1, 1, 1]
+
+
+def test_dispatched_notifications_wake_the_receivers_stream(app, database, receiver, tag, wait_until):
+    broker = app.EventBroker(0.2, 0.1)
+    event = broker.subscribe(receiver)
+    # it wakes everyone once it is listening
+    assert event.wait(5)
+    event.clear()
+
+    queue_notification(database, receiver, f'pushed {tag}')
+    app.NotificationDispatcher(500, 1, 5).dispatch_batch()
+
+    assert event.wait(5)
+    wait_until(lambda: broker.stats()['notifies'] >= 1)
+    assert app.fetch_user_events(receiver, 0)[-1][2] == f'pushed {tag}'
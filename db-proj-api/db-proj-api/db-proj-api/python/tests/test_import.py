@@ -0,0 +1,52 @@
+## The streaming import path: copy_rows turns records into CSV for COPY,
+## ChunkReader hands it to copy_expert, POST /users/import puts them together
+
+import csv, io
+
+
+def test_chunk_reader_reads_across_chunks(app):
+    reader = app.ChunkReader(iter(['ab', 'cde', '', 'f']))
+
+    assert reader.read(4) == 'abcd'
+    assert reader.readline(1) == 'e'
+    assert reader.read() == 'f'
+    assert reader.read(10) == ''
+
+
+def test_valid_records_are_written_with_their_line(app):
+    records = [(2, {'username': ' bob ', 'role': 'Buyer'}, None), (3, {'username': '', 'role': 'Buyer'}, None), (4, None, 'Invalid JSON')]
+    rejects = {'count': 0, 'rows': []}
+
+    rows = list(csv.reader(io.StringIO(''.join(app.copy_rows(iter(records), app.check_user, rejects))), quoting=csv.QUOTE_NONNUMERIC))
+
+    assert rows == [[2, 'bob', '', '', 'Buyer']]
+    assert rejects == {'count': 2, 'rows': [{'line': 3, 'reason': 'username is required'}, {'line': 4, 'reason': 'Invalid JSON'}]}
+
+
+def test_rejects_are_counted_past_the_reported_ones(app, monkeypatch):
+    monkeypatch.setattr(app, 'IMPORT_MAX_REJECTS', 2)
+    records = [(line, {'title': 'lamp', 'end_time': 'soon'}, None) for line in range(5)]
+    rejects = {'count': 0, 'rows': []}
+
+    assert ''.join(app.copy_rows(iter(records), app.check_auction, rejects)) == ''
+    assert rejects['count'] == 5
+    assert [row['line'] for row in rejects['rows']] == [0, 1]
+
+
+def test_large_imports_are_yielded_in_chunks(app):
+    records = ((line, {'username': f'user {line}', 'role': 'Buyer'}, None) for line in range(5000))
+    chunks = list(app.copy_rows(records, app.check_user, {'count': 0, 'rows': []}))
+
+    assert len(chunks) > 1
+    assert all(len(chunk) < 65536 + 100 for chunk in chunks)
+    assert ''.join(chunks).count('\n') == 5000
+
+
+def test_import_users_reports_the_rejected_lines(client, tag):
+    body = f'username,role\nbob {tag},Buyer\n,Buyer\nbob {tag},Seller\nann {tag},Seller,extra\n'
+
+    result = client.post('/users/import', data=body, content_type='text/csv').get_json()
+
+    assert (result['status'], result['imported'], result['rejected']) == (200, 1, 3)
+    assert [row['line'] for row in result['results']] == [3, 4, 5]
+    assert client.get(f'/users/bob {tag}/').get_json()['results']['role'] == 'Buyer'
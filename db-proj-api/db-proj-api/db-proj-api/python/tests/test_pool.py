@@ -0,0 +1,139 @@
+## ConnectionPool of demo-proj.py, on stand-in connections, and GET /ready
+## when the database is down
+
+import threading, time
+
+import psycopg2
+import pytest
+
+
+class FakeCursor:
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query, params=None):
+        if self.conn.broken:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.closed = False
+        self.broken = False
+        self.autocommit = False
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def get_transaction_status(self):
+        return self.status
+
+    def close(self):
+        self.closed = True
+
+
+def make_pool(app, **config):
+    opened = []
+
+    def connect():
+        opened.append(FakeConnection())
+        return opened[-1]
+
+    settings = dict(min_size=0, max_size=2, timeout=0.1, max_idle=60, check_after=60)
+    settings.update(config)
+    return app.ConnectionPool(connect, **settings), opened
+
+
+def test_idle_connections_are_handed_out_most_recently_used_first(app):
+    pool, opened = make_pool(app)
+    first, second = pool.getconn(), pool.getconn()
+    pool.putconn(first)
+    pool.putconn(second)
+
+    assert pool.getconn() is second
+    assert pool.getconn() is first
+    assert len(opened) == 2
+
+
+def test_checkout_times_out_when_every_connection_is_in_use(app):
+    pool, opened = make_pool(app, max_size=1)
+    pool.getconn()
+
+    with pytest.raises(app.PoolTimeout):
+        pool.getconn()
+    stats = pool.stats()
+    assert (stats['timeouts'], stats['in_use'], stats['opened']) == (1, 1, 1)
+
+
+def test_a_waiting_checkout_gets_the_connection_given_back(app):
+    pool, opened = make_pool(app, max_size=1, timeout=5)
+    conn = pool.getconn()
+    threading.Timer(0.1, pool.putconn, (conn,)).start()
+
+    assert pool.getconn() is conn
+    assert pool.stats()['waits'] == 1
+
+
+def test_a_failed_open_gives_the_slot_back(app):
+    def connect():
+        raise psycopg2.OperationalError('connection refused')
+    pool = app.ConnectionPool(connect, min_size=0, max_size=1, timeout=0.1, max_idle=60, check_after=60)
+
+    for _ in range(2):
+        with pytest.raises(psycopg2.OperationalError):
+            pool.getconn()
+    assert pool.stats()['in_use'] == 0
+
+
+def test_broken_idle_connections_are_replaced(app):
+    pool, opened = make_pool(app, check_after=0)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    conn.broken = True
+
+    replacement = pool.getconn()
+    assert replacement is not conn and conn.closed
+    assert pool.stats()['failed_checks'] == 1
+
+
+def test_connections_come_back_out_of_their_transaction(app):
+    pool, opened = make_pool(app)
+    conn = pool.getconn()
+    conn.status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+    conn.autocommit = True
+    pool.putconn(conn)
+
+    assert (conn.rollbacks, conn.autocommit) == (1, False)
+
+
+def test_idle_connections_above_min_size_are_evicted(app):
+    pool, opened = make_pool(app, min_size=1, max_idle=0.05)
+    first, second = pool.getconn(), pool.getconn()
+    pool.putconn(first)
+    pool.putconn(second)
+    time.sleep(0.1)
+
+    assert pool.getconn() is second
+    assert first.closed
+    assert pool.stats()['evicted'] == 1
+
+
+def test_ready_answers_503_when_the_database_is_down(app, monkeypatch):
+    def connect():
+        raise psycopg2.OperationalError('connection refused')
+    monkeypatch.setattr(app, '_pool', app.ConnectionPool(connect, min_size=0, max_size=1, timeout=0.1, max_idle=60, check_after=60))
+
+    response = app.app.test_client().get('/ready')
+    assert response.status_code == 503
+    assert response.get_json() == {'status': 503, 'errors': 'connection refused'}
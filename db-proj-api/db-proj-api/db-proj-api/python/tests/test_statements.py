@@ -0,0 +1,55 @@
+## Registered statements: the %s / %(name)s placeholders rewritten for
+## PREPARE, and executing them prepared
+
+import psycopg2
+import pytest
+
+
+def test_positional_parameters_are_numbered_in_order(app):
+    statement = app.Statement('s', 'SELECT * FROM bids WHERE auctions_auction_id = %s AND bid_id > %s LIMIT %s')
+
+    assert statement.prepare_sql == 'PREPARE s AS SELECT * FROM bids WHERE auctions_auction_id = $1 AND bid_id > $2 LIMIT $3'
+    assert (statement.param_count, statement.param_names) == (3, [])
+
+
+def test_named_parameters_keep_one_number_each(app):
+    statement = app.Statement('s', "UPDATE auctions SET status = %(status)s WHERE auction_id = %(auction_id)s AND status <> %(status)s AND title LIKE 'a%%'")
+
+    assert statement.prepare_sql == "PREPARE s AS UPDATE auctions SET status = $1 WHERE auction_id = $2 AND status <> $1 AND title LIKE 'a%'"
+    assert (statement.param_count, statement.param_names) == (2, ['status', 'auction_id'])
+
+
+@pytest.fixture
+def preparing(app, database):
+    conn = psycopg2.connect(connection_factory=app.PreparingConnection, **app.DB_CONFIG)
+    yield conn
+    conn.close()
+
+
+def test_statements_are_prepared_once_per_connection(app, preparing):
+    statement = app.Statement('test_named', "SELECT %(word)s || '%%', %(n)s::int + 1, %(word)s")
+    cur = preparing.cursor()
+
+    for n in (1, 2):
+        statement.execute(cur, {'n': n, 'word': 'up'})
+        assert cur.fetchone() == ('up%', n + 1, 'up')
+    cur.execute("SELECT count(*) FROM pg_prepared_statements WHERE name = 'test_named'")
+    assert cur.fetchone()[0] == 1
+    assert preparing.prepared == {'test_named'}
+
+
+def test_statements_run_as_plain_sql_when_preparing_is_off(app, preparing, monkeypatch):
+    monkeypatch.setitem(app.PREPARED_CONFIG, 'enabled', False)
+    statement = app.Statement('test_plain', 'SELECT %s::int * 2')
+    cur = preparing.cursor()
+
+    statement.execute(cur, (21,))
+    assert cur.fetchone() == (42,)
+    assert preparing.prepared == set()
+
+
+def test_every_registered_statement_prepares(app, preparing):
+    cur = preparing.cursor()
+    for statement in app.STATEMENTS.values():
+        cur.execute(statement.prepare_sql)
+    preparing.rollback()